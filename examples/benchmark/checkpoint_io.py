@@ -0,0 +1,62 @@
+import sys
+sys.path.append ('../../..')
+import os, time, tempfile
+import numpy as np
+from mrh.my_dmet import chkfile
+
+# Time checkpoint writes and reads for fake DMET/LASSCF states of realistic size.
+# Usage: python checkpoint_io.py [nao] [norbs_amo frag 1] [norbs_amo frag 2] ...
+# Compares the old np.append chain with the list-and-concatenate npy writer, the HDF5 writer,
+# and lazy loading of a single fragment.  Defaults resemble a large basis LASSCF calculation
+# with one big and several small active spaces.
+
+nao = int (sys.argv[1]) if len (sys.argv) > 1 else 600
+norbs_amo = [int (n) for n in sys.argv[2:]] if len (sys.argv) > 2 else [16, 8, 6, 6, 4, 0]
+nrep = 3
+
+rng = np.random.default_rng (0)
+mat = rng.random ((nao, nao))
+frags = [(n, rng.random ((nao, n)), rng.random ((n, n)), rng.random ((n, n, n, n))) for n in norbs_amo]
+nbytes = 8 * (2 + nao**2 + sum (1 + nao*n + n**2 + n**4 for n in norbs_amo))
+print ("nao = {}; norbs_amo = {}; {:.1f} MB of checkpoint data".format (nao, norbs_amo, nbytes / 1e6))
+
+def save_np_append (fname):
+    chkdata = mat.flatten (order='C')
+    chkdata = np.append (np.asarray ([nao, 0.0]), chkdata)
+    for n, ao2amo, oneRDM_amo, twoCDM_amo in frags:
+        chkdata = np.append (chkdata, [n])
+        chkdata = np.append (chkdata, ao2amo.flatten (order='C'))
+        chkdata = np.append (chkdata, oneRDM_amo.flatten (order='C'))
+        chkdata = np.append (chkdata, twoCDM_amo.flatten (order='C'))
+    np.save (fname, chkdata)
+
+def best_of (fn, *args):
+    t = []
+    for i in range (nrep):
+        t0 = time.time ()
+        fn (*args)
+        t.append (time.time () - t0)
+    return min (t)
+
+with tempfile.TemporaryDirectory () as tmpdir:
+    fnpy = os.path.join (tmpdir, 'bench.chk.npy')
+    fh5 = os.path.join (tmpdir, 'bench.chk.h5')
+    ifrag = int (np.argmax (norbs_amo))
+    results = [('save, np.append chain (old)', best_of (save_np_append, fnpy)),
+               ('save, npy', best_of (lambda: chkfile.save_chkfile (fnpy, nao, 0.0, mat, iter (frags)))),
+               ('save, h5', best_of (lambda: chkfile.save_chkfile (fh5, nao, 0.0, mat, iter (frags)))),
+               ('save, h5 + gzip', best_of (lambda: chkfile.save_chkfile (fh5 + '.gz.h5', nao, 0.0, mat, iter (frags), compression='gzip'))),
+               ('full load, npy', best_of (lambda: list (chkfile.chkfile_reader (fnpy).iter_fragments ()))),
+               ('full load, h5', best_of (lambda: list (chkfile.chkfile_reader (fh5).iter_fragments ()))),
+               ('load fragment {}, npy'.format (ifrag), best_of (chkfile.load_chkfile_fragment, fnpy, ifrag)),
+               ('load fragment {}, h5'.format (ifrag), best_of (chkfile.load_chkfile_fragment, fh5, ifrag))]
+    for f, n in zip (chkfile.chkfile_reader (fh5).iter_fragments (), frags):
+        assert (all (np.array_equal (a, b) for a, b in zip (f[1:], n[1:])))
+    for f, n in zip (chkfile.chkfile_reader (fnpy).iter_fragments (), frags):
+        assert (all (np.array_equal (a, b) for a, b in zip (f[1:], n[1:])))
+    print ("File sizes: npy {:.1f} MB; h5 {:.1f} MB; h5 + gzip {:.1f} MB".format (os.path.getsize (fnpy) / 1e6, os.path.getsize (fh5) / 1e6,
+        os.path.getsize (fh5 + '.gz.h5') / 1e6))
+
+for label, t in results:
+    print ("{:>32s}: {:9.4f} s".format (label, t))
+
@@ -0,0 +1,175 @@
+import sys, os
+sys.path.append (os.path.join (os.path.dirname (os.path.abspath (__file__)), '..', '..', '..')) # absolute: workloads chdir
+import json, time, subprocess, tempfile, resource, platform
+from contextlib import contextmanager
+import numpy as np
+
+# Reduced-size (minimal-basis) versions of the examples/lasscf workloads, timed phase by phase.
+# Usage:
+#   python dmet_workloads.py [workload ...] [--json out.json] [--basis basis]
+#       Run the named workloads (default: all), each in its own process so that peak memory is per workload,
+#       print a table, and optionally write the results as JSON. --basis replaces the default minimal basis
+#       (e.g., --basis 6-31g for the basis of the examples/lasscf calculations themselves).
+#   python dmet_workloads.py --compare old.json new.json
+#       Compare two JSON files (e.g., from two commits) phase by phase.
+# Phases: scf (whole-molecule RHF), localization (localintegrals setup), schmidt, impham (impurity Hamiltonian
+# construction), solve (impurity solvers), corrpot (correlation-potential fit), wm_core_scf (LASSCF whole-molecule core SCF).
+# Everything a workload writes (moldens, checkpoints, logs) goes into a temporary directory.
+# Each LASSCF workload also has a *_diis version with DIIS extrapolation of the active orbitals (dmet kwarg orb_diis),
+# for comparing the numbers of orbital iterations and impurity solves.
+
+lasscf_dir = os.path.join (os.path.dirname (os.path.abspath (__file__)), '..', 'lasscf')
+basis = 'sto-3g'
+phases = ('scf', 'localization', 'schmidt', 'impham', 'solve', 'corrpot', 'wm_core_scf')
+
+@contextmanager
+def working_directory (dirname):
+    cwd = os.getcwd ()
+    os.chdir (dirname)
+    try:
+        yield
+    finally:
+        os.chdir (cwd)
+
+def me2n2_mol ():
+    with working_directory (os.path.join (lasscf_dir, 'me2n2')):
+        sys.path.insert (0, os.getcwd ())
+        import me2n2_struct
+        return me2n2_struct.structure (1.24414799, basis)
+
+def c2h4n4_mol ():
+    with working_directory (os.path.join (lasscf_dir, 'c2h4n4')):
+        sys.path.insert (0, os.getcwd ())
+        import c2h4n4_struct
+        return c2h4n4_struct.structure (0.0, 0.0, basis, symmetry=False)
+
+def c2h6n4_mol ():
+    with working_directory (os.path.join (lasscf_dir, 'c2h6n4')):
+        sys.path.insert (0, os.getcwd ())
+        import c2h6n4_struct
+        return c2h6n4_struct.structure (0.0, 0.0, basis, symmetry=False)
+
+def fench6_mol ():
+    from pyscf import gto
+    with open (os.path.join (lasscf_dir, 'fench6', 'FeNCH_LS.xyz'), 'r') as f:
+        carts = f.read ()
+    return gto.M (atom = carts, basis = basis, charge = 2, spin = 0, verbose = 0)
+
+# name: (molecule, dmet kwargs, fragments as (atom list, solver, name))
+workloads = {
+    'me2n2_lasscf': (me2n2_mol, {'doLASSCF': True, 'nelec_int_thresh': 1e-5},
+        [(list (range (2)), 'CASSCF(4,4)', 'N2'), (list (range (2,6)), 'RHF', 'Me1'), (list (range (6,10)), 'RHF', 'Me2')]),
+    'me2n2_casdmet': (me2n2_mol, {'nelec_int_thresh': 1e-5},
+        [(list (range (2)), 'CASSCF(4,4)', 'N2'), (list (range (2,6)), 'RHF', 'Me1'), (list (range (6,10)), 'RHF', 'Me2')]),
+    'c2h4n4_lasscf': (c2h4n4_mol, {'doLASSCF': True, 'nelec_int_thresh': 1e-3},
+        [(list (range (3)), 'CASSCF(4,4)', 'N2Ha'), (list (range (3,7)), 'RHF', 'C2H2'), (list (range (7,10)), 'CASSCF(4,4)', 'N2Hb')]),
+    'c2h6n4_lasscf': (c2h6n4_mol, {'doLASSCF': True, 'nelec_int_thresh': 1e-3},
+        [(list (range (3)), 'CASSCF(4,4)', 'N2Ha'), (list (range (3,9)), 'RHF', 'C2H4'), (list (range (9,12)), 'CASSCF(4,4)', 'N2Hb')]),
+    'fench6_lasscf': (fench6_mol, {'doLASSCF': True, 'nelec_int_thresh': 1e-4},
+        [([0], 'CASSCF(6,5)', 'Fe'), ([1, 7, 8], 'dummy RHF', 'NCHa'), ([2, 13, 14], 'dummy RHF', 'NCHb'),
+         ([3, 9, 10], 'dummy RHF', 'NCHc'), ([4, 11, 12], 'dummy RHF', 'NCHd'), ([5, 17, 18], 'dummy RHF', 'NCHe'),
+         ([6, 15, 16], 'dummy RHF', 'NCHf')])
+    }
+workloads.update ({name + '_diis': (get_mol, dict (dmet_kwargs, orb_diis=True), frag_specs)
+    for name, (get_mol, dmet_kwargs, frag_specs) in list (workloads.items ()) if dmet_kwargs.get ('doLASSCF', False)})
+
+def run_workload (name):
+    ''' Run one workload in this process and return its results as a dict '''
+    from pyscf import scf
+    from mrh.my_dmet import localintegrals, dmet
+    from mrh.my_dmet.fragments import make_fragment_atom_list
+    get_mol, dmet_kwargs, frag_specs = workloads[name]
+    timings = {}
+    mol = get_mol ()
+    mol.verbose = 0
+    with tempfile.TemporaryDirectory () as tmpdir, working_directory (tmpdir):
+        t0 = time.time ()
+        mf = scf.RHF (mol)
+        mf.kernel ()
+        if not mf.converged:
+            mf = mf.newton ()
+            mf.kernel ()
+        t1 = time.time ()
+        myInts = localintegrals.localintegrals (mf, range (mol.nao_nr ()), 'meta_lowdin')
+        t2 = time.time ()
+        timings['scf'] = t1 - t0
+        timings['localization'] = t2 - t1
+        frags = [make_fragment_atom_list (myInts, atoms, solver, name=fname) for atoms, solver, fname in frag_specs]
+        for f in frags: f.mol_output = name + '_' + f.frag_name + '.log'
+        mydmet = dmet (myInts, frags, calcname=name, **dmet_kwargs)
+        if mydmet.doLASSCF: mydmet.generate_frag_cas_guess (mf.mo_coeff)
+        energy = mydmet.doselfconsistent ()
+        t3 = time.time ()
+    timings.update (mydmet.timings)
+    return {'energy': float (energy), 'total': t3 - t0, 'timings': timings, 'nao': int (mol.nao_nr ()),
+            'niter_corrpot': int (mydmet.niter_corrpot), 'niter_orbs': int (mydmet.niter_orbs), 'nsolves': int (mydmet.nsolves),
+            'eri_strategy': getattr (myInts, 'eri_strategy', None),
+            'peak_rss_mb': resource.getrusage (resource.RUSAGE_SELF).ru_maxrss / 1e3} # ru_maxrss is in kB on Linux
+
+def run_in_subprocess (name):
+    with tempfile.NamedTemporaryFile (suffix='.json') as f:
+        subprocess.run ([sys.executable, os.path.abspath (__file__), '--worker', name, f.name, basis],
+            stdout=subprocess.DEVNULL, check=True)
+        return json.load (open (f.name, 'r'))
+
+def get_commit ():
+    try:
+        return subprocess.run (['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname (os.path.abspath (__file__))).stdout.strip ()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results (results):
+    fmt = "{:>20s} " + " ".join (["{:>12s}"] * (len (phases) + 1)) + " {:>10s} {:>6s} {:>6s} {:>7s}"
+    print (fmt.format ('workload', *(phases + ('total',)), 'peak MB', 'corrp', 'orbs', 'solves'))
+    fmt = "{:>20s} " + " ".join (["{:12.2f}"] * (len (phases) + 1)) + " {:10.0f} {:6d} {:6d} {:7d}"
+    for name, r in results.items ():
+        print (fmt.format (name, *([r['timings'].get (p, 0.0) for p in phases] + [r['total']]), r['peak_rss_mb'],
+            r['niter_corrpot'], r['niter_orbs'], r['nsolves']))
+
+def compare (fname_old, fname_new):
+    old, new = json.load (open (fname_old, 'r')), json.load (open (fname_new, 'r'))
+    print ("Ratio new/old: {} ({}) vs. {} ({})".format (fname_new, new['commit'], fname_old, old['commit']))
+    print ("{:>20s} ".format ('workload') + " ".join (["{:>12s}".format (p) for p in phases + ('total', 'peak MB')]) + " {:>14s}".format ('dE'))
+    for name in new['workloads']:
+        if name not in old['workloads']: continue
+        r_old, r_new = old['workloads'][name], new['workloads'][name]
+        vals_old = [r_old['timings'].get (p, 0.0) for p in phases] + [r_old['total'], r_old['peak_rss_mb']]
+        vals_new = [r_new['timings'].get (p, 0.0) for p in phases] + [r_new['total'], r_new['peak_rss_mb']]
+        ratios = ["{:12.2f}".format (n / o) if o > 0.01 else "{:>12s}".format ('-') for n, o in zip (vals_new, vals_old)]
+        print ("{:>20s} ".format (name) + " ".join (ratios) + " {:14.2e}".format (r_new['energy'] - r_old['energy']))
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args[:1] == ['--worker']:
+        if len (args) > 3: basis = args[3]
+        with open (args[2], 'w') as f:
+            json.dump (run_workload (args[1]), f)
+        sys.exit (0)
+    if args[:1] == ['--compare']:
+        compare (args[1], args[2])
+        sys.exit (0)
+    if '--basis' in args:
+        idx = args.index ('--basis')
+        basis = args[idx+1]
+        args = args[:idx] + args[idx+2:]
+    fname_json = None
+    if '--json' in args:
+        idx = args.index ('--json')
+        fname_json = args[idx+1]
+        args = args[:idx] + args[idx+2:]
+    names = args if len (args) else list (workloads.keys ())
+    results = {}
+    for name in names:
+        print ("Running {}...".format (name))
+        sys.stdout.flush ()
+        results[name] = run_in_subprocess (name)
+    print_results (results)
+    if fname_json is not None:
+        import pyscf
+        with open (fname_json, 'w') as f:
+            json.dump ({'commit': get_commit (), 'date': time.strftime ('%Y-%m-%d %H:%M:%S'), 'host': platform.node (),
+                'python': platform.python_version (), 'numpy': np.__version__, 'pyscf': pyscf.__version__,
+                'basis': basis, 'workloads': results}, f, indent=2)
+        print ("Results written to {}".format (fname_json))
+
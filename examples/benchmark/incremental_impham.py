@@ -0,0 +1,51 @@
+import sys
+sys.path.append ('../../..')
+import numpy as np
+from pyscf import gto, scf, ao2mo
+from mrh.my_dmet import localintegrals
+
+# Check the incremental impurity Hamiltonian (localintegrals.update_dmet_tei and update_dmet_cderi) against full rebuilds
+# with dmet_tei and dmet_cderi, for random impurity bases in the localized space of a density-fitted RHF calculation.
+# Usage: python incremental_impham.py [nimp] [nchange] [seed]
+# Each trial starts from a random orthonormal impurity basis of nimp orbitals and either extends it by nchange random
+# directions, contracts it by nchange orbitals while rotating the rest, or rotates it within its own span.
+# All differences should be at the level of the CDERI compression threshold or below.
+
+nimp = int (sys.argv[1]) if len (sys.argv) > 1 else 12
+nchange = int (sys.argv[2]) if len (sys.argv) > 2 else 2
+seed = int (sys.argv[3]) if len (sys.argv) > 3 else 0
+
+mol = gto.M (atom = 'N 0 0 0; N 0 0 1.1; H 0 1 -0.5; H 0 -1 1.6', basis = '6-31g', verbose = 0)
+mf = scf.RHF (mol).density_fit ()
+mf.kernel ()
+myInts = localintegrals.localintegrals (mf, range (mol.nao_nr ()), 'meta_lowdin')
+norbs = myInts.norbs_tot
+assert (nimp + nchange <= norbs), "only {} localized orbitals".format (norbs)
+rng = np.random.default_rng (seed)
+
+def random_orth (nrow, ncol):
+    return np.linalg.qr (rng.standard_normal ((nrow, ncol)))[0]
+
+def eri_from_cderi (CDERI):
+    return np.dot (CDERI.T, CDERI)
+
+loc2full = random_orth (norbs, nimp + nchange)
+trials = {'extend': (loc2full[:,:nimp], loc2full),
+          'contract': (loc2full, np.dot (loc2full, random_orth (nimp + nchange, nimp))),
+          'rotate': (loc2full[:,:nimp], np.dot (loc2full[:,:nimp], random_orth (nimp, nimp)))}
+
+for name, (loc2old, loc2new) in trials.items ():
+    nnew = loc2new.shape[1]
+    max_frac = 1.0
+    TEI_old = myInts.dmet_tei (loc2old, symmetry=8)
+    TEI_ref = myInts.dmet_tei (loc2new, symmetry=8)
+    TEI = myInts.update_dmet_tei (TEI_old, loc2old, loc2new, max_frac=max_frac)
+    err_tei = np.amax (np.abs (TEI - TEI_ref))
+    CDERI_old, aux2c_old = myInts.dmet_cderi (loc2old, return_aux=True)
+    CDERI_ref = myInts.dmet_cderi (loc2new)
+    CDERI = myInts.update_dmet_cderi (CDERI_old, aux2c_old, loc2old, loc2new, max_frac=max_frac)[0]
+    # The compressed auxiliary bases are only defined up to a rotation, so compare the ERIs they give
+    err_cderi = np.amax (np.abs (eri_from_cderi (CDERI) - eri_from_cderi (CDERI_ref)))
+    err_df = np.amax (np.abs (eri_from_cderi (CDERI) - ao2mo.restore (4, TEI_ref, nnew)))
+    print ("{}: {} -> {} orbitals; max |dTEI| = {:.2e}, max |dERI(CDERI)| = {:.2e}, max |ERI(CDERI) - TEI| = {:.2e}".format (
+        name, loc2old.shape[1], nnew, err_tei, err_cderi, err_df))
@@ -0,0 +1,40 @@
+import sys
+sys.path.append ('../../../..')
+from pyscf import scf
+from mrh.my_dmet import localintegrals, dmet
+from mrh.my_dmet.fragments import make_fragment_atom_list
+from mrh.my_dmet.pes_scan import pes_scan
+import numpy as np
+import me2n2_struct
+
+# LASSCF potential energy curve of Me2N2 along r_nn, carrying active orbitals, CI vectors, and density matrices
+# from each point to the next in memory.
+# Usage: python lasscf_scan.py [extrapolation order]
+extrapolate = int (sys.argv[1]) if len (sys.argv) > 1 else 0
+basis = '6-31g'
+r_nn_list = np.arange (1.0, 2.01, 0.1)
+
+def build_dmet (r_nn, warm_start):
+    mol = me2n2_struct.structure (r_nn, basis)
+    mf = scf.RHF (mol)
+    mf.kernel ()
+    if not mf.converged:
+        mf = mf.newton ()
+        mf.kernel ()
+    myInts = localintegrals.localintegrals(mf, range(mol.nao_nr ()), 'meta_lowdin')
+    calcname = 'me2n2_lasscf_r{:2.0f}'.format (r_nn*10)
+    N2 = make_fragment_atom_list (myInts, list (range(2)), 'CASSCF(4,4)', name="N2")
+    Me1 = make_fragment_atom_list (myInts, list (range(2,6)), 'RHF', name='Me1')
+    Me2 = make_fragment_atom_list (myInts, list (range(6,10)), 'RHF', name='Me2')
+    N2.mol_output = calcname + '_N2.log'
+    Me1.mol_output = calcname + '_Me1.log'
+    Me2.mol_output = calcname + '_Me2.log'
+    me2n2_dmet = dmet (myInts, [N2, Me1, Me2], calcname=calcname, doLASSCF=True, nelec_int_thresh=1e-5)
+    if not warm_start: me2n2_dmet.generate_frag_cas_guess (mf.mo_coeff)
+    return me2n2_dmet
+
+scan = pes_scan (build_dmet, extrapolate=extrapolate)
+energies = scan.kernel (r_nn_list, coords=r_nn_list)
+for r_nn, e in zip (r_nn_list, energies):
+    print ("----Energy: {:.1f} {:.8f}".format (r_nn, e))
+
@@ -0,0 +1,208 @@
+''' Checkpoint files for DMET/LASSCF calculations
+
+    Two formats are supported, selected by the file extension:
+        *.h5 (or *.hdf5, *.chk): one HDF5 file with header attributes and one group per fragment.
+            Every array is its own chunked dataset, so writing streams fragment by fragment and
+            a single fragment can be read back without touching the others.
+        *.npy: the legacy flat array (nao_nr, chempot, 1RDM or umat, norbs_amo in frag 1,
+            loc2amo of frag 1, oneRDM_amo of frag 1, twoCDMimp_amo of frag 1, norbs_amo in frag 2, ...)
+
+    Both writers go through a temporary file in the destination directory, fsync'd before os.replace,
+    so an interrupted write (or the node going down right afterwards) never clobbers the previous checkpoint.
+
+    save_fragment_state and load_fragment_state keep one fragment's impurity solution in its own
+    pickle file, together with a key describing the impurity problem it solves, so that an
+    interrupted iteration can be resumed without re-solving the fragments it had already finished.
+'''
+
+import os
+import numpy as np
+from mrh.util.io import warnings
+
+CHK_FORMAT_VERSION = 1
+H5_EXTENSIONS = ('.h5', '.hdf5', '.chk')
+
+def is_h5_chkfile (fname):
+    return os.path.splitext (fname)[1].lower () in H5_EXTENSIONS
+
+def _tmpname (fname):
+    head, tail = os.path.split (os.path.abspath (fname))
+    return os.path.join (head, '.{}.{}.tmp'.format (tail, os.getpid ()))
+
+def _fsync_path (fname):
+    fd = os.open (fname, os.O_RDONLY)
+    try:
+        os.fsync (fd)
+    finally:
+        os.close (fd)
+
+def _chunks (shape, target_bytes=1<<20):
+    ''' Chunk along the leading index so that a chunk is about target_bytes in size '''
+    if len (shape) == 0 or 0 in shape: return None
+    rowsize = 8 * int (np.prod (shape[1:]))
+    nrows = max (1, min (shape[0], target_bytes // max (rowsize, 1)))
+    return tuple ([nrows] + list (shape[1:]))
+
+def save_chkfile (fname, nao, chempot, mat, frags, compression=None):
+    ''' Write a checkpoint.
+
+        Args:
+            fname: str
+                Destination file; format chosen by extension
+            nao: int
+                Number of AOs
+            chempot: float
+            mat: ndarray of shape (nao,nao)
+                Whole-molecule 1RDM (LASSCF) or correlation potential (DMET) in the AO basis
+            frags: iterable
+                Yields, for each fragment, a tuple (norbs_amo, ao2amo, oneRDM_amo, twoCDMimp_amo).
+                Consumed lazily, so only one fragment's arrays need to exist at a time.
+
+        Kwargs:
+            compression: str or None
+                HDF5 filter for the fragment datasets (e.g., 'gzip'); ignored for .npy
+    '''
+    if not (is_h5_chkfile (fname) or fname.endswith ('.npy')): fname += '.npy' # Same as np.save
+    tmpname = _tmpname (fname)
+    try:
+        if is_h5_chkfile (fname):
+            _save_h5 (tmpname, nao, chempot, mat, frags, compression)
+            _fsync_path (tmpname) # h5py doesn't expose the descriptor, so sync the closed file
+        else:
+            with open (tmpname, 'wb') as f:
+                _save_npy (f, nao, chempot, mat, frags)
+                f.flush ()
+                os.fsync (f.fileno ())
+        os.replace (tmpname, fname)
+    finally:
+        if os.path.exists (tmpname): os.remove (tmpname)
+
+def _save_h5 (fname, nao, chempot, mat, frags, compression):
+    import h5py
+    with h5py.File (fname, 'w') as f:
+        f.attrs['format_version'] = CHK_FORMAT_VERSION
+        f.attrs['nao'] = nao
+        f.attrs['chempot'] = chempot
+        f.create_dataset ('mat', data=np.asarray (mat).reshape (nao, nao), chunks=_chunks ((nao, nao)))
+        ifrag = 0
+        for norbs_amo, ao2amo, oneRDM_amo, twoCDM_amo in frags:
+            g = f.create_group ('fragments/{}'.format (ifrag))
+            g.attrs['norbs_amo'] = norbs_amo
+            for key, arr, shape in (('ao2amo', ao2amo, (nao, norbs_amo)),
+                                    ('oneRDM_amo', oneRDM_amo, (norbs_amo, norbs_amo)),
+                                    ('twoCDMimp_amo', twoCDM_amo, (norbs_amo,)*4)):
+                arr = np.asarray (arr).reshape (shape)
+                g.create_dataset (key, data=arr, chunks=_chunks (shape),
+                    compression=(compression if arr.size else None))
+            ifrag += 1
+        f.attrs['nfrags'] = ifrag
+
+def _save_npy (fobj, nao, chempot, mat, frags):
+    # Assemble the pieces in a list and concatenate once, instead of np.append'ing onto a growing buffer
+    chkdata = [np.asarray ([nao, chempot], dtype=np.float64), np.asarray (mat).ravel (order='C')]
+    for norbs_amo, ao2amo, oneRDM_amo, twoCDM_amo in frags:
+        chkdata.append (np.asarray ([norbs_amo], dtype=np.float64))
+        chkdata.extend ([np.asarray (arr).ravel (order='C') for arr in (ao2amo, oneRDM_amo, twoCDM_amo)])
+    np.save (fobj, np.concatenate (chkdata))
+
+class chkfile_reader:
+    ''' Read a checkpoint written by save_chkfile (or by older versions of dmet.save_checkpoint).
+        The header (nao, chempot, mat) is read on construction; fragment data is only read when
+        load_fragment is called.  For the legacy .npy format, the flat array is memory-mapped and
+        the fragment offsets are found by walking the norbs_amo markers, which doesn't read the
+        fragment arrays themselves. '''
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.is_h5 = is_h5_chkfile (fname)
+        if self.is_h5:
+            import h5py
+            with h5py.File (fname, 'r') as f:
+                self.nao = int (f.attrs['nao'])
+                self.chempot = float (f.attrs['chempot'])
+                self.mat = f['mat'][()]
+                self.nfrags = int (f.attrs['nfrags'])
+                self.norbs_amo = [int (f['fragments/{}'.format (i)].attrs['norbs_amo']) for i in range (self.nfrags)]
+        else:
+            self._data = np.load (fname, mmap_mode='r')
+            self.nao = int (round (self._data[0]))
+            self.chempot = float (self._data[1])
+            nao2 = self.nao**2
+            self.mat = np.array (self._data[2:2+nao2]).reshape (self.nao, self.nao, order='C')
+            self.norbs_amo = []
+            self._offsets = []
+            offset = 2 + nao2
+            while offset < self._data.shape[0]:
+                namo = int (round (self._data[offset]))
+                self.norbs_amo.append (namo)
+                self._offsets.append (offset+1)
+                offset += 1 + self.nao*namo + namo**2 + namo**4
+            assert (offset == self._data.shape[0]), "Malformed checkpoint file {}".format (fname)
+            self.nfrags = len (self.norbs_amo)
+
+    def load_fragment (self, ifrag):
+        ''' Returns norbs_amo, ao2amo, oneRDM_amo, twoCDMimp_amo for fragment number ifrag '''
+        namo = self.norbs_amo[ifrag]
+        if self.is_h5:
+            import h5py
+            with h5py.File (self.fname, 'r') as f:
+                g = f['fragments/{}'.format (ifrag)]
+                return namo, g['ao2amo'][()], g['oneRDM_amo'][()], g['twoCDMimp_amo'][()]
+        i = self._offsets[ifrag]
+        j = i + self.nao*namo
+        ao2amo = np.array (self._data[i:j]).reshape (self.nao, namo, order='C')
+        i, j = j, j + namo**2
+        oneRDM_amo = np.array (self._data[i:j]).reshape (namo, namo, order='C')
+        i, j = j, j + namo**4
+        twoCDM_amo = np.array (self._data[i:j]).reshape (namo, namo, namo, namo, order='C')
+        return namo, ao2amo, oneRDM_amo, twoCDM_amo
+
+    def iter_fragments (self):
+        for ifrag in range (self.nfrags):
+            yield self.load_fragment (ifrag)
+
+def load_chkfile_fragment (fname, ifrag):
+    ''' Read only one fragment's active-space data out of a checkpoint file '''
+    return chkfile_reader (fname).load_fragment (ifrag)
+
+def save_fragment_state (fname, key, state):
+    ''' Pickle one fragment's solved state (a dict) along with the key (a dict of the inputs it is valid for) to fname,
+        through a temporary file and os.replace, fsync'd so that it survives the node going down right afterwards '''
+    import pickle
+    tmpname = _tmpname (fname)
+    try:
+        with open (tmpname, 'wb') as f:
+            pickle.dump ({'format_version': CHK_FORMAT_VERSION, 'key': key, 'state': state}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush ()
+            os.fsync (f.fileno ())
+        os.replace (tmpname, fname)
+    finally:
+        if os.path.exists (tmpname): os.remove (tmpname)
+
+def load_fragment_state (fname, key, atol=1e-8):
+    ''' The state saved in fname by save_fragment_state, if the file exists and its key matches key (arrays to within atol);
+        otherwise None '''
+    import pickle
+    if not os.path.exists (fname): return None
+    try:
+        with open (fname, 'rb') as f:
+            data = pickle.load (f)
+    except Exception as e:
+        warnings.warn ("Unreadable fragment state file {} ignored: {}".format (fname, e), RuntimeWarning)
+        return None
+    if not _keys_match (data.get ('key', {}), key, atol): return None
+    return data['state']
+
+def _keys_match (key0, key1, atol):
+    if set (key0.keys ()) != set (key1.keys ()): return False
+    for k in key1:
+        v0, v1 = key0[k], key1[k]
+        if isinstance (v1, np.ndarray) or isinstance (v0, np.ndarray):
+            if v0 is None or v1 is None: return False
+            v0, v1 = np.asarray (v0), np.asarray (v1)
+            if v0.shape != v1.shape or not np.allclose (v0, v1, atol=atol, rtol=0): return False
+        elif isinstance (v1, float) and isinstance (v0, float):
+            if abs (v0 - v1) > atol: return False
+        elif v0 != v1:
+            return False
+    return True
@@ -85,8 +85,7 @@ def debug_Etot (dmet_obj):
         fname    = "{0} + {1} + {2} + {3}".format (f[0].frag_name, f[1].frag_name, f[2].frag_name, f[3].frag_name) 
         loc2frag = [i.loc2frag for i in f]
         TEI      = dmet_obj.ints.general_tei (loc2frag)
-        twoRDM_i = [0.25 * i.get_twoCDM(*loc2frag) for i in f]
-        E2_i     = [0.5 * np.einsum ('ijkl,ijkl->', TEI, twoRDM) for twoRDM in twoRDM_i]
+        E2_i     = [0.125 * i.get_twoCDM_store ().contract_eri (TEI, *loc2frag) for i in f]
         E2      += sum(E2_i)
         print ("debug_Etot :: fragments {0} E2 = {1}".format (fname, sum(E2_i)))
         for E, i in zip (E2_i, f):
@@ -1,4 +1,4 @@
-import re, sys
+import re, sys, time
 import numpy as np
 import scipy as sp 
 from math import floor, ceil
@@ -9,11 +9,12 @@ from pyscf.symm.addons import symmetrize_space, label_orb_symm
 from pyscf.lib import logger
 from pyscf.tools import molden
 from mrh.my_dmet import pyscf_rhf, pyscf_mp2, pyscf_cc, pyscf_casscf, qcdmethelper, pyscf_fci #, chemps2
+from mrh.my_dmet.rhf import impurity_mf_context
 from mrh.util import params
 from mrh.util.basis import *
 from mrh.util.io import prettyprint_ndarray as prettyprint
-from mrh.util.io import warnings
-from mrh.util.rdm import Schmidt_decomposition_idempotent_wrapper, idempotize_1RDM, get_1RDM_from_OEI, get_2RDM_from_2CDM, get_2CDM_from_2RDM, Schmidt_decompose_1RDM
+from mrh.util.io import warnings, async_writer
+from mrh.util.rdm import Schmidt_decomposition_idempotent_wrapper, idempotize_1RDM, get_1RDM_from_OEI, get_2RDM_from_2CDM, get_2CDM_from_2RDM, Schmidt_decompose_1RDM, Schmidt_tracker, twoCDM_store
 from mrh.util.tensors import symmetrize_tensor
 from mrh.util.my_math import is_close_to_integer
 from mrh.my_pyscf.tools.jmol import cas_mo_energy_shift_4_jmol
@@ -48,6 +49,18 @@ def make_fragment_atom_list (ints, frag_atom_list, solver_name, **kwargs):
 def make_fragment_orb_list (ints, frag_orb_list, solver_name, **kwargs):
     return fragment_object (ints, frag_orb_list, solver_name, **kwargs)
 
+def _versioned_basis (name):
+    ''' Property for one of the fragment's basis matrices. Assigning to it bumps its version number in
+        self._basis_versions, which invalidates the transformation matrices cached by _cached_transform.
+        The matrices must be reassigned, not modified in place, for this to work. '''
+    key = '_' + name
+    def fget (self):
+        return self.__dict__[key]
+    def fset (self, value):
+        self.__dict__[key] = value
+        self._basis_versions[name] = self._basis_versions.get (name, 0) + 1
+    return property (fget, fset)
+
 def dummy_rhf (frag, oneRDM_imp, chempot_imp):
     ''' Skip solving the impurity problem and assume the trial and impurity wave functions are the same. '''
     assert (np.amax (np.abs (chempot_imp)) < 1e-10)
@@ -60,8 +73,19 @@ def dummy_rhf (frag, oneRDM_imp, chempot_imp):
 
 class fragment_object:
 
+    loc2emb  = _versioned_basis ('loc2emb')
+    loc2frag = _versioned_basis ('loc2frag')
+    loc2amo  = _versioned_basis ('loc2amo')
+    loc2mo   = _versioned_basis ('loc2mo')
+    loc2symm = _versioned_basis ('loc2symm')
+
     def __init__ (self, ints, frag_orb_list, solver_name, **kwargs): #active_orb_list, name, norbs_bath_max=None, idempotize_thresh=0.0, mf_attr={}, corr_attr={}):
 
+        # Versions of the basis matrices and the transformation matrices built from them (see _cached_transform)
+        self._basis_versions = {}
+        self._transform_cache = {}
+        self.transform_cache_stats = {'hits': 0, 'misses': 0}
+
         # Kwargs
         self.active_orb_list = []
         self.frozen_orb_list = [] 
@@ -79,6 +103,7 @@ class fragment_object:
         self.mol_output = None
         self.debug_energy = False
         self.imp_maxiter = None # Currently only does anything for casscf solver
+        self.imp_conv_tol = None # Set by the dmet tolerance schedule; loosens (never tightens) the casscf and fci solver tolerances
         self.quasidirect = True # Currently only does anything for rhf (in development)
         self.project_cderi = False
         self.mf_attr = {}
@@ -91,6 +116,14 @@ class fragment_object:
         self.wfnsym = None
         self.quasifrag_ovlp = True
         self.quasifrag_gradient = False
+        self.schmidt_tracking = False
+        self.schmidt_tracking_thresh = 0.1
+        self.cderi_compression = 'svd'
+        self.cderi_max_rank = None
+        self.verbose = False
+        self.incremental_impham = False # After expand_active_space or refragmentation, update the previous impurity ERIs/CDERI
+                                        # instead of rebuilding them if the impurity basis only gained or lost a few orbitals
+        self.incremental_impham_max_frac = 0.25
         for key in kwargs:
             if key in self.__dict__:
                 self.__dict__[key] = kwargs[key]
@@ -104,6 +137,11 @@ class fragment_object:
 
         # To be assigned by the DMET main object
         self.filehead = None
+        self.equiv_rep = None # Fragment of which this one is a symmetry-equivalent copy
+        self.equiv_map = None # Localized-basis orthogonal matrix carrying equiv_rep onto this fragment
+
+        # Reuse the previous embedding basis in the Schmidt decomposition if requested
+        self.schmidt_tracker = Schmidt_tracker (self.schmidt_tracking_thresh, verbose=self.verbose) if self.schmidt_tracking else None
 
         # Assign solver function
         solver_function_map = {
@@ -143,6 +181,8 @@ class fragment_object:
         self.loc2tbc        = []
         self.E2froz_tbc     = []
         self.imp_cache      = []
+        self.imp_mf_ctx     = impurity_mf_context ()
+        self.output_writer  = async_writer (enabled=False) # dmet swaps in its own
         
         # Impurity Hamiltonian
         self.Ecore_frag   = 0.0  # In case this exists
@@ -151,6 +191,10 @@ class fragment_object:
         self.impham_OEI_S = None
         self.impham_TEI   = None
         self.impham_CDERI = None
+        self.impham_CDERI_aux = None
+        self.impham_basis = None # The loc2imp of impham_TEI or impham_CDERI
+        self.impham_update_pending = False # Set by the dmet object when it changes the active spaces
+        self.impham_TEI_fiii = None
 
         # Point-group symmetry information
         self.groupname = 'C1'
@@ -243,37 +287,55 @@ class fragment_object:
     def mo2loc (self):
         return self.loc2mo.conjugate ().T
 
+    # Products of two basis matrices are cached until either basis is reassigned (or norbs_imp changes);
+    # the adjoints are views of the cached arrays, which are read-only
+    def _cached_transform (self, name, bases, build, imp=True):
+        key = tuple ([self._basis_versions.get (basis, 0) for basis in bases])
+        if imp: key += (self.norbs_imp,)
+        if name in self._transform_cache and self._transform_cache[name][0] == key:
+            self.transform_cache_stats['hits'] += 1
+            return self._transform_cache[name][1]
+        self.transform_cache_stats['misses'] += 1
+        result = build ()
+        for arr in (result if isinstance (result, list) else [result]):
+            arr.flags.writeable = False
+        self._transform_cache[name] = (key, result)
+        return result
+
+    def reset_transform_cache_stats (self):
+        self.transform_cache_stats = {'hits': 0, 'misses': 0}
+
     @property
     def imp2frag (self):
-        return np.dot (self.imp2loc, self.loc2frag)
+        return self._cached_transform ('imp2frag', ('loc2emb', 'loc2frag'), lambda: np.dot (self.imp2loc, self.loc2frag))
 
     @property
     def frag2imp (self):
-        return np.dot (self.frag2loc, self.loc2imp)
+        return self.imp2frag.conjugate ().T
 
     @property
     def amo2imp (self):
-        return np.dot (self.amo2loc, self.loc2imp)
+        return self.imp2amo.conjugate ().T
 
     @property
     def imp2amo (self):
-        return np.dot (self.imp2loc, self.loc2amo)
+        return self._cached_transform ('imp2amo', ('loc2emb', 'loc2amo'), lambda: np.dot (self.imp2loc, self.loc2amo))
 
     @property
     def mo2imp (self):
-        return np.dot (self.mo2loc, self.loc2imp)
+        return self.imp2mo.conjugate ().T
 
     @property
     def imp2mo (self):
-        return np.dot (self.imp2loc, self.loc2mo)
+        return self._cached_transform ('imp2mo', ('loc2emb', 'loc2mo'), lambda: np.dot (self.imp2loc, self.loc2mo))
 
     @property
     def amo2frag (self):
-        return np.dot (self.amo2loc, self.loc2frag)
+        return self.frag2amo.conjugate ().T
 
     @property
     def frag2amo (self):
-        return np.dot (self.frag2loc, self.loc2amo)
+        return self._cached_transform ('frag2amo', ('loc2frag', 'loc2amo'), lambda: np.dot (self.frag2loc, self.loc2amo), imp=False)
 
     @property
     def symm2loc (self):
@@ -281,7 +343,8 @@ class fragment_object:
 
     @property
     def imp2symm (self):
-        return [orthonormalize_a_basis (np.dot (self.imp2loc, loc2ir)) for loc2ir in self.loc2symm]
+        return list (self._cached_transform ('imp2symm', ('loc2emb', 'loc2symm'),
+            lambda: [orthonormalize_a_basis (np.dot (self.imp2loc, loc2ir)) for loc2ir in self.loc2symm]))
 
     @property
     def is_frag_orb (self):
@@ -420,7 +483,7 @@ class fragment_object:
             print ("DMET Schmidt decomposition of {0} fragment".format (self.frag_name))
             self.loc2emb, norbs_bath, self.nelec_imp, self.oneRDMfroz_loc, emb_labels = Schmidt_decomposition_idempotent_wrapper (oneRDM_loc,
                 self.loc2frag, self.norbs_bath_max, symmetry=self.loc2symm, fock_helper=self.ints.activeFOCK, enforce_symmetry=self.enforce_symmetry,
-                idempotize_thresh=self.idempotize_thresh, bath_tol=self.bath_tol, num_zero_atol=params.num_zero_atol)
+                idempotize_thresh=self.idempotize_thresh, bath_tol=self.bath_tol, num_zero_atol=params.num_zero_atol, tracker=self.schmidt_tracker)
             self.norbs_imp = self.norbs_frag + norbs_bath
             self.Schmidt_done = True
             self.impham_built = False
@@ -483,7 +546,7 @@ class fragment_object:
         oneRDMa_loc = oneRDM_loc - oneRDMi_loc
         self.loc2emb, norbs_bath, self.nelec_imp, self.oneRDMfroz_loc, emb_labels = Schmidt_decomposition_idempotent_wrapper (oneRDMi_loc, loc2wfrag,
             self.norbs_bath_max, symmetry=self.loc2symm, enforce_symmetry=self.enforce_symmetry, bath_tol=self.bath_tol, fock_helper=self.ints.activeFOCK,
-            idempotize_thresh=self.idempotize_thresh, num_zero_atol=params.num_zero_atol)
+            idempotize_thresh=self.idempotize_thresh, num_zero_atol=params.num_zero_atol, tracker=self.schmidt_tracker)
         self.norbs_imp = self.norbs_frag + norbs_qfrag + norbs_bath
         self.Schmidt_done = True
         oneRDMacore_loc = project_operator_into_subspace (oneRDMa_loc, self.loc2core)
@@ -500,7 +563,9 @@ class fragment_object:
             norbs_virtbath = min (norbs_bath_xtra, loc2virtbath.shape[1])
             if self.add_virtual_bath and norbs_virtbath:
                 print ("Adding {} virtual bath orbitals".format (norbs_virtbath))
-                self.loc2emb[:,self.norbs_imp:][:,:norbs_virtbath] = loc2virtbath[:,:norbs_virtbath]
+                loc2emb = self.loc2emb.copy ()
+                loc2emb[:,self.norbs_imp:][:,:norbs_virtbath] = loc2virtbath[:,:norbs_virtbath]
+                self.loc2emb = loc2emb
                 self.norbs_imp += norbs_virtbath
                 self.loc2emb = get_complete_basis (self.loc2imp, symmetry=self.loc2symm, enforce_symmetry=self.enforce_symmetry)
                 emb_labels = assign_blocks_weakly (self.loc2emb, self.loc2symm)
@@ -695,7 +760,8 @@ class fragment_object:
             my_ene = -svals_fock
         if self.molden_missing_aos:
             ao2molden = np.dot (self.ints.ao2loc, loc2virtbath)
-            molden.from_mo (self.ints.mol, self.filehead + self.frag_name + '_missing_AOs.molden', ao2molden, ene=my_ene, occ=my_occ)
+            fname = self.filehead + self.frag_name + '_missing_AOs.molden'
+            self.output_writer.submit (fname, molden.from_mo, self.ints.mol, fname, ao2molden, ene=my_ene, occ=my_occ)
             self.molden_missing_aos = False
         return loc2virtbath
 
@@ -712,10 +778,14 @@ class fragment_object:
         virtbath2loc = loc2virtbath.conjugate ().T
         grad = virtbath2loc @ fock @ oneRDM_loc @ loc2occ
         if self.norbs_as > 0:
-            eri = self.ints.general_tei ([loc2virtbath, self.loc2amo, self.loc2amo, self.loc2amo])
             lamb = np.tensordot (self.amo2loc @ loc2occ, self.twoCDMimp_amo, axes=(0,0))
-            print (eri.shape, lamb.shape)
-            grad += np.tensordot (eri, lamb, axes=((1,2,3),(1,2,3))) # axes=3 is INCORRECT!
+            if getattr (self.ints, 'with_df', None) is not None:
+                # sum_abc (v a|b c) lamb_oabc = sum_Pa (P|v a) [sum_bc (P|b c) lamb_oabc]; the four-index block is never formed
+                z = np.tensordot (self.ints.general_cderi (self.loc2amo, self.loc2amo), lamb, axes=((1,2),(2,3))) # P,o,a
+                grad += np.tensordot (self.ints.general_cderi (loc2virtbath, self.loc2amo), z, axes=((0,2),(0,2)))
+            else:
+                eri = self.ints.general_tei ([loc2virtbath, self.loc2amo, self.loc2amo, self.loc2amo])
+                grad += np.tensordot (eri, lamb, axes=((1,2,3),(1,2,3)))
         return 2 * grad, occ_labels
             
 
@@ -728,15 +798,17 @@ class fragment_object:
 
     # Impurity Hamiltonian
     ###############################################################################################################################
-    def construct_impurity_hamiltonian (self, xtra_CONST=0.0):
+    def construct_impurity_hamiltonian (self, xtra_CONST=0.0, core_jk=None):
+        ''' core_jk, if given, is (loc_rhf_jk_bis (oneRDMfroz_loc), loc_rhf_k_bis (oneSDMfroz_loc)) computed in advance '''
         self.warn_check_Schmidt ("construct_impurity_hamiltonian")
+        JKcore, Kcore = (None, None) if core_jk is None else core_jk
         if self.imp_solver_name == "dummy RHF":
             self.E2_frag_core = 0
             self.impham_built = True
             self.imp_solved   = False
             return
-        self.impham_OEI_C = self.ints.dmet_fock (self.loc2emb, self.norbs_imp, self.oneRDMfroz_loc)
-        self.impham_OEI_S = -self.ints.dmet_k (self.loc2emb, self.norbs_imp, self.oneSDMfroz_loc) / 2
+        self.impham_OEI_C = self.ints.dmet_fock (self.loc2emb, self.norbs_imp, self.oneRDMfroz_loc, JKloc=JKcore)
+        self.impham_OEI_S = -self.ints.dmet_k (self.loc2emb, self.norbs_imp, self.oneSDMfroz_loc, Kloc=Kcore) / 2
         if self.imp_solver_name == "RHF" and self.quasidirect:
             ao2imp = np.dot (self.ints.ao2loc, self.loc2imp)
             def my_jk (mol, dm, hermi=1):
@@ -746,21 +818,38 @@ class fragment_object:
                 vk_basis     = represent_operator_in_basis (vk_ao, ao2imp)
                 return vj_basis, vk_basis
             self.impham_TEI = None 
-            #self.impham_TEI_fiii = None # np.empty ([self.norbs_frag] + [self.norbs_imp for i in range (3)], dtype=np.float64)
             self.impham_get_jk = my_jk
         elif self.project_cderi:
             self.impham_TEI = None
             self.impham_get_jk = None
-            self.impham_CDERI = self.ints.dmet_cderi (self.loc2emb, self.norbs_imp)
+            CDERI = None
+            if self.impham_update_pending and self.impham_CDERI is not None and self.impham_basis is not None:
+                CDERI = self.ints.update_dmet_cderi (self.impham_CDERI, self.impham_CDERI_aux, self.impham_basis, self.loc2imp,
+                    max_frac=self.incremental_impham_max_frac, verbose=self.verbose)
+            if CDERI is None:
+                CDERI = self.ints.dmet_cderi (self.loc2emb, self.norbs_imp, compression=self.cderi_compression,
+                    max_rank=self.cderi_max_rank, return_aux=True)
+            self.impham_CDERI, self.impham_CDERI_aux = CDERI
+            self.impham_basis = self.loc2imp.copy ()
         else:
-            f = self.loc2frag
-            i = self.loc2imp
-            self.impham_TEI = self.ints.dmet_tei (self.loc2emb, self.norbs_imp, symmetry=8) 
-            #self.impham_TEI_fiii = self.ints.general_tei ([f, i, i, i])
+            TEI = None
+            if self.impham_update_pending and self.impham_TEI is not None and self.impham_basis is not None:
+                TEI = self.ints.update_dmet_tei (self.impham_TEI, self.impham_basis, self.loc2imp,
+                    max_frac=self.incremental_impham_max_frac, verbose=self.verbose)
+            self.impham_TEI = self.ints.dmet_tei (self.loc2emb, self.norbs_imp, symmetry=8) if TEI is None else TEI
+            self.impham_CDERI = self.impham_CDERI_aux = None
             self.impham_get_jk = None
+            self.impham_basis = self.loc2imp.copy ()
+        self.impham_update_pending = False
+        # (f i|i i) for the energy of solvers that return the whole impurity 2CDM; CASSCF needs (f a|a a) in the active orbitals
+        # that come out of the solver instead, and RHF has no cumulant
+        self.impham_TEI_fiii = None
+        if self.active_space is None and self.imp_solver_name != 'RHF' and self.impham_CDERI is None:
+            self.impham_TEI_fiii = self.get_impham_TEI_fiii ()
 
         # Constant contribution to energy from core 2CDMs
-        self.impham_CONST = (self.ints.dmet_const (self.loc2emb, self.norbs_imp, self.oneRDMfroz_loc, self.oneSDMfroz_loc)
+        self.impham_CONST = (self.ints.dmet_const (self.loc2emb, self.norbs_imp, self.oneRDMfroz_loc, self.oneSDMfroz_loc,
+                                                   JKloc=JKcore, Kloc=Kcore)
                              + self.ints.const () + xtra_CONST + sum (self.E2froz_tbc))
         self.E2_frag_core = 0
 
@@ -812,6 +901,31 @@ class fragment_object:
         '''
 
 
+    solved_state_keys = ('oneRDM_loc', 'oneSDM_loc', 'twoCDM_imp', 'E_imp', 'loc2mo', 'loc2amo', 'loc2amo_guess', 'oneRDMas_loc',
+        'oneSDMas_loc', 'twoCDMimp_amo', 'E2_cum', 'ci_as', 'ci_as_orb', 'imp_cache', 'active_orb_list', 'frozen_orb_list',
+        'nelec_frag', 'E_frag', 'S2_frag', 'fno_evals', 'loc2fno')
+
+    def get_resume_key (self, chempot_frag):
+        ''' Everything the impurity solution depends on, apart from the localized integrals: if these are the same, a stored
+            solution can be used in place of calling solve_impurity_problem '''
+        self.warn_check_impham ("get_resume_key")
+        return {'solver': self.imp_solver_method, 'imp_conv_tol': self.imp_conv_tol, 'nelec_imp': self.nelec_imp,
+                'target_MS': self.target_MS, 'chempot_frag': chempot_frag, 'loc2imp': np.asarray (self.loc2imp),
+                'impham_CONST': self.impham_CONST, 'impham_OEI_C': self.impham_OEI_C, 'impham_OEI_S': self.impham_OEI_S}
+
+    def get_solved_state (self):
+        ''' The results of solve_impurity_problem, as a dict which set_solved_state can put back '''
+        self.warn_check_imp_solve ("get_solved_state")
+        return {key: getattr (self, key) for key in self.solved_state_keys if hasattr (self, key)}
+
+    def set_solved_state (self, state):
+        ''' Put back results from get_solved_state instead of calling solve_impurity_problem for the same impurity problem '''
+        self.warn_check_impham ("set_solved_state")
+        for key, val in state.items (): setattr (self, key, val)
+        self.imp_solved = True
+        print ("Impurity results for {0} resumed from a stored solution: E_imp = {1}, E_frag = {2}, nelec_frag = {3}, S2_frag = {4}".format (
+            self.frag_name, self.E_imp, self.E_frag, self.nelec_frag, self.S2_frag))
+
     def load_amo_guess_from_casscf_molden (self, moldenfile, norbs_cmo, norbs_amo):
         ''' Use moldenfile from whole-molecule casscf calculation to guess active orbitals '''
         print ("Attempting to load guess active orbitals from {}".format (moldenfile))
@@ -835,8 +949,9 @@ class fragment_object:
         frag2ano = loc2ano[self.frag_orb_list,:]
         oneRDMano_frag = represent_operator_in_basis (oneRDMwm_ano, frag2ano.conjugate ().T)
         evals, evecs = matrix_eigen_control_options (oneRDMano_frag, sort_vecs=-1, only_nonzero_vals=False)
-        self.loc2amo = np.zeros ((self.norbs_tot, self.active_space[1]))
-        self.loc2amo[self.frag_orb_list,:] = evecs[:,:self.active_space[1]]
+        loc2amo = np.zeros ((self.norbs_tot, self.active_space[1]))
+        loc2amo[self.frag_orb_list,:] = evecs[:,:self.active_space[1]]
+        self.loc2amo = loc2amo
         #norbs_occ = norbs_cmo + norbs_amo
         #mo_coeff = np.load (npyfile)
         #amo_coeff = mo_coeff[:,norbs_cmo:norbs_occ]
@@ -847,10 +962,11 @@ class fragment_object:
         no_occ, no_coeff = matrix_eigen_control_options (self.oneRDMas_loc, sort_vecs=-1, only_nonzero_vals=True)
         no_coeff = np.dot (self.ints.ao2loc, no_coeff)
         matrix = np.insert (no_coeff, 0, no_occ, axis=0)
-        np.save (npyfile, matrix)
+        self.output_writer.submit (npyfile, np.save, npyfile, matrix)
 
     def load_amo_guess_for_pes_scan (self, npyfile):
         print ("Loading amo guess from npyfile")
+        self.output_writer.flush ()
         matrix = np.load (npyfile)
         no_occ = matrix[0,:]
         print ("NO occupancies: {}".format (no_occ))
@@ -954,6 +1070,20 @@ class fragment_object:
         self.warn_check_imp_solve ("get_nelec_frag")
         return np.trace (self.get_oneRDM_frag ())
 
+    def get_impham_TEI_fiii (self, loc2bas=None):
+        ''' (f i|j k) with f in the fragment and i, j, k in loc2bas (default: the impurity), in the basis loc2bas '''
+        loc2bas = self.loc2imp if loc2bas is None else loc2bas
+        norbs = [self.norbs_frag] + [loc2bas.shape[1] for i in range (3)]
+        imp2bas = np.dot (self.imp2loc, loc2bas)
+        mo_coeffs = [self.imp2frag, imp2bas, imp2bas, imp2bas]
+        if isinstance (self.impham_TEI, np.ndarray):
+            return ao2mo.incore.general (self.impham_TEI, mo_coeffs, compact=False).reshape (*norbs)
+        elif isinstance (self.impham_CDERI, np.ndarray):
+            with_df = copy.copy (self.ints.with_df)
+            with_df._cderi = self.impham_CDERI
+            return with_df.ao2mo (mo_coeffs, compact=False).reshape (*norbs)
+        return self.ints.general_tei ([self.loc2frag, loc2bas, loc2bas, loc2bas])
+
     def get_E_frag (self):
         self.warn_check_imp_solve ("get_E_frag")
 
@@ -985,35 +1115,20 @@ class fragment_object:
         # Remember that non-overlapping fragments are now, by necessity, ~contained~ within the impurity!
         if self.norbs_as > 0:
             L_fiii = np.tensordot (self.frag2amo, self.twoCDMimp_amo, axes=1)
-            if isinstance (self.impham_TEI, np.ndarray):
-                mo_coeffs = [self.imp2frag, self.imp2amo, self.imp2amo, self.imp2amo]
-                norbs = [self.norbs_frag, self.norbs_as, self.norbs_as, self.norbs_as]
-                V_fiii = ao2mo.incore.general (self.impham_TEI, mo_coeffs, compact=False).reshape (*norbs)
-            elif isinstance (self.impham_CDERI, np.ndarray):
-                with_df = copy.copy (self.ints.with_df)
-                with_df._cderi = self.impham_CDERI
-                mo_coeffs = [self.imp2frag, self.imp2amo, self.imp2amo, self.imp2amo]
-                norbs = [self.norbs_frag, self.norbs_as, self.norbs_as, self.norbs_as]
-                V_fiii = with_df.ao2mo (mo_coeffs, compact=False).reshape (*norbs)
-            else:
-                V_fiii = self.ints.general_tei ([self.loc2frag, self.loc2amo, self.loc2amo, self.loc2amo])
+            V_fiii = self.get_impham_TEI_fiii (self.loc2amo)
             E2 = 0.5 * np.tensordot (V_fiii, L_fiii, axes=4)
         elif isinstance (self.twoCDM_imp, np.ndarray):
-            L_iiif = np.tensordot (self.twoCDM_imp, self.imp2frag, axes=1)
-            if isinstance (self.impham_TEI, np.ndarray):
-                V_iiif = ao2mo.restore (1, self.impham_TEI, self.norbs_imp)
-                V_iiif = np.tensordot (V_iiif, self.imp2frag, axes=1) 
-                E2 = 0.5 * np.tensordot (V_iiif, L_iiif, axes=4)
-            elif isinstance (self.impham_CDERI, np.ndarray):
+            if isinstance (self.impham_CDERI, np.ndarray):
                 raise NotImplementedError ("No opportunity to test this yet.")
                 # It'll be something like:
                 # (P|ii) * L_iiif -> R^P_if
                 # (P|ii) * u^i_f -> (P|if)
                 # (P|if) * R^P_if -> E2
                 # But factors of 2 abound especially with the orbital-pair compacting of CDERI
-            else:
-                V_iiif = self.ints.general_tei ([self.loc2frag, self.loc2imp, self.loc2imp, self.loc2imp])
-                E2 = 0.5 * np.tensordot (V_iiif, L_iiif, axes=4)
+            L_iiif = np.tensordot (self.twoCDM_imp, self.imp2frag, axes=1)
+            V_fiii = self.get_impham_TEI_fiii () if self.impham_TEI_fiii is None else self.impham_TEI_fiii
+            V_iiif = V_fiii.transpose (2,3,1,0) # (ij|kf) = (fk|ij)
+            E2 = 0.5 * np.tensordot (V_iiif, L_iiif, axes=4)
         if self.debug_energy:
             print ("get_E_frag {0} :: E2 = {1:.5f}".format (self.frag_name, float (E2)))
 
@@ -1035,7 +1150,7 @@ class fragment_object:
         return np.einsum ('fp,pq,qf->', self.frag2imp, exc_mat, self.imp2frag) 
 
     def get_twoRDM (self, *bases):
-        bases = bases if len (bases) == 4 else (basis[0] for i in range[4])
+        bases = bases if len (bases) == 4 else [bases[0] for i in range (4)]
         oneRDM_pq = represent_operator_in_basis (self.oneRDM_loc, bases[0], bases[1])
         oneRDM_rs = represent_operator_in_basis (self.oneRDM_loc, bases[2], bases[3])
         oneRDM_ps = represent_operator_in_basis (self.oneRDM_loc, bases[0], bases[3])
@@ -1045,14 +1160,12 @@ class fragment_object:
         return twoRDM + self.get_twoCDM (*bases)
 
     def get_twoCDM (self, *bases):
-        bases = bases if len (bases) == 4 else (bases[0] for i in range[4])
-        bra1_basis, ket1_basis, bra2_basis, ket2_basis = bases
-        twoCDM = np.zeros (tuple(basis.shape[1] for basis in bases))
-        for loc2tb, twoCDM_tb in zip (self.loc2tb_all, self.twoCDM_all):
-            tb2loc = np.conj (loc2tb.T)
-            tb2bs = (np.dot (tb2loc, basis) for basis in bases)
-            twoCDM += represent_operator_in_basis (twoCDM_tb, *tb2bs)
-        return twoCDM
+        return self.get_twoCDM_store ().project (*bases)
+
+    def get_twoCDM_store (self):
+        ''' The 2CDM of this fragment's calculation as a twoCDM_store, with each block left in its own basis; use its
+            contract_* methods instead of get_twoCDM when only a contraction is needed '''
+        return twoCDM_store (self.loc2tb_all, self.twoCDM_all)
 
     def get_oneRDM_frag (self):
         return represent_operator_in_basis (self.oneRDM_loc, self.loc2frag)
@@ -1107,7 +1220,7 @@ class fragment_object:
         if self.norbs_as > 0: ene = cas_mo_energy_shift_4_jmol (ene, self.norbs_imp, self.nelec_imp, self.norbs_as, self.nelec_as)
         ao2molden = self.ints.ao2loc @ loc2molden
 
-        molden.from_mo (mol, filename, ao2molden, ene=ene, occ=occ)
+        self.output_writer.submit (filename, molden.from_mo, mol, filename, ao2molden, ene=ene, occ=occ)
 
 
     ###############################################################################################################################
@@ -1117,6 +1230,25 @@ class fragment_object:
 
     # For interface with DMET
     ###############################################################################################################################
+    def copy_solution_from (self, rep, loc_map):
+        ''' Take the embedding basis and impurity solution of an equivalent fragment rep instead of solving for them. loc_map is the
+            orthogonal matrix in the localized basis that carries rep onto self, so that loc2x = loc_map @ rep.loc2x and
+            x_loc = loc_map @ rep.x_loc @ loc_map.T. Quantities in the impurity or active-orbital basis are the same for both. '''
+        for key in ('loc2frag', 'loc2emb', 'loc2amo', 'loc2mo', 'loc2fno', 'loc2amo_guess', 'ci_as_orb', 'impham_basis'):
+            val = getattr (rep, key, None)
+            if val is not None: setattr (self, key, np.dot (loc_map, val))
+        for key in ('oneRDM_loc', 'oneSDM_loc', 'oneRDMas_loc', 'oneSDMas_loc', 'oneRDMfroz_loc', 'oneSDMfroz_loc'):
+            setattr (self, key, represent_operator_in_basis (getattr (rep, key), loc_map.T))
+        self.loc2tbc = [np.dot (loc_map, loc2tb) for loc2tb in rep.loc2tbc]
+        for key in ('norbs_frag', 'norbs_imp', 'nelec_imp', 'nelec_frag', 'E_frag', 'E_imp', 'S2_frag', 'E2_frag_core', 'E2_cum',
+                    'Ecore_frag', 'fno_evals', 'twoCDM_imp', 'twoCDMimp_amo', 'twoCDMfroz_tbc', 'E2froz_tbc', 'ci_as',
+                    'impham_CONST', 'impham_OEI_C', 'impham_OEI_S', 'impham_TEI', 'impham_CDERI', 'impham_CDERI_aux', 'impham_get_jk',
+                    'Schmidt_done', 'impham_built', 'imp_solved'):
+            if hasattr (rep, key): setattr (self, key, getattr (rep, key))
+        self.impham_TEI_fiii = None
+        print ("Impurity results for {0} copied from equivalent fragment {1}: E_imp = {2}, E_frag = {3}, nelec_frag = {4}, S2_frag = {5}".format (
+            self.frag_name, rep.frag_name, self.E_imp, self.E_frag, self.nelec_frag, self.S2_frag))
+
     def get_errvec (self, dmet, mf_1RDM_loc):
         self.warn_check_imp_solve ("get_errvec")
         # Fragment natural-orbital basis matrix elements needed
@@ -1155,6 +1287,21 @@ class fragment_object:
         else:
             return rsp_1RDM_frag.flatten (order='F')
 
+    def get_rsp_1RDM_adjoint (self, dmet, weights):
+        ''' Adjoint of get_rsp_1RDM_elements: the matrix W in the local basis such that
+            np.dot (weights, self.get_rsp_1RDM_elements (dmet, rsp_1RDM)) == (W * rsp_1RDM).sum () for any rsp_1RDM '''
+        if dmet.altcostfunc:
+            raise RuntimeError("You shouldn't have gotten in to get_rsp_1RDM_adjoint if you're using the constrained-optimization cost function!")
+        if dmet.doDET_NO:
+            raise NotImplementedError ("Response adjoint in the fragment natural-orbital basis")
+        if dmet.incl_bath_errvec:
+            loc2bas = self.loc2imp
+            weights = weights.reshape (self.norbs_imp, self.norbs_imp, order='F')
+        else:
+            loc2bas = self.loc2frag
+            weights = np.diag (weights) if dmet.doDET else weights.reshape (self.norbs_frag, self.norbs_frag, order='F')
+        return represent_operator_in_basis (weights, loc2bas.conjugate ().T)
+
 
 
 
@@ -25,19 +25,23 @@ import scipy
 def construct_p_list( mol, pmol ):
 
     Norbs       = mol.nao_nr()
-    p_list      = np.zeros( [ Norbs ], dtype=int )
-    counter_mol = 0
+    plabels     = set( tuple( pitem[:4] ) for pitem in pmol.spheric_labels() )
+    p_list      = np.asarray( [ int( tuple( item[:4] ) in plabels ) for item in mol.spheric_labels() ], dtype=int )
     
-    for item in mol.spheric_labels():
-        for pitem in pmol.spheric_labels():
-            if (( pitem[0] == item[0] ) and ( pitem[1] == item[1] ) and ( pitem[2] == item[2] ) and ( pitem[3] == item[3] )):
-                p_list[ counter_mol ] = 1
-        counter_mol += 1
-    
-    assert( counter_mol == Norbs )
+    assert( len( p_list ) == Norbs )
     assert( np.sum( p_list ) == pmol.nao_nr() )
     return p_list
 
+def make_pmol( mol, pmol=None ):
+    ''' The minimal-basis (minao) version of mol. If pmol is a previous result for the same atoms (e.g., at another geometry),
+        it is moved to the geometry of mol instead of being built from scratch. '''
+    if pmol is not None and pmol.natm == mol.natm and all( pmol.atom_symbol( i ) == mol.atom_symbol( i ) for i in range( mol.natm ) ):
+        pmol.set_geom_( mol.atom_coords(), unit='Bohr' )
+        return pmol
+    pmol   = mol.copy()
+    pmol.build( False, False, basis='minao' )
+    return pmol
+
 def orthogonalize_iao( coeff, ovlp ):
 
     # Knizia, JCTC 9, 4834-4843, 2013 -- appendix C, third equation
@@ -47,39 +51,22 @@ def orthogonalize_iao( coeff, ovlp ):
     
 def resort_orbitals( mol, ao2loc ):
 
-    # Sort the orbitals according to the atom list
-    Norbs  = mol.nao_nr()
-    coords = np.zeros( [ Norbs, 3 ], dtype=float )
+    # Sort the orbitals according to the atom list (the nearest atom to each orbital's centroid; ties go to the first atom)
     rvec   = mol.intor( 'cint1e_r_sph', 3 )
-    for cart in range(3):
-        coords[ :, cart ] = np.diag( np.dot( np.dot( ao2loc.T, rvec[cart] ) , ao2loc ) )
-    atomid = np.zeros( [ Norbs ], dtype=int )
-    for orb in range( Norbs ):
-        min_id = 0
-        min_distance = np.linalg.norm( coords[ orb, : ] - mol.atom_coord( 0 ) )
-        for atom in range( 1, mol.natm ):
-            current_distance = np.linalg.norm( coords[ orb, : ] - mol.atom_coord( atom ) )
-            if ( current_distance < min_distance ):
-                min_distance = current_distance
-                min_id = atom
-        atomid[ orb ] = min_id
-    resort = []
-    for atom in range( 0, mol.natm ):
-        for orb in range( Norbs ):
-            if ( atomid[ orb ] == atom ):
-                resort.append( orb )
-    resort = np.array( resort )
+    coords = np.einsum( 'xij,ip,jp->px', rvec, ao2loc, ao2loc )
+    dists  = np.linalg.norm( coords[ :, None, : ] - mol.atom_coords()[ None, :, : ], axis=2 )
+    atomid = np.argmin( dists, axis=1 )
+    resort = np.argsort( atomid, kind='stable' )
     ao2loc = ao2loc[ :, resort ]
     return ao2loc
     
-def construct_iao( mol, mf ):
+def construct_iao( mol, mf, pmol=None ):
 
     Norbs = mol.nao_nr()
 
     # Knizia, JCTC 9, 4834-4843, 2013 -- appendix C
     ao2occ = mf.mo_coeff[ :, mf.mo_occ > 0.5 ]
-    pmol   = mol.copy()
-    pmol.build( False, False, basis='minao' )
+    pmol   = make_pmol( mol, pmol )
     S21    = gto.mole.intor_cross( 'cint1e_ovlp_sph', pmol, mol )
     S1     = mol.intor('cint1e_ovlp_sph')
     S2     = pmol.intor('cint1e_ovlp_sph')
@@ -93,10 +80,13 @@ def construct_iao( mol, mf ):
     ao2iao = orthogonalize_iao( A, S1 )
     return ( ao2iao , S1, pmol )
 
-def localize_iao( mol, mf ):
+def localize_iao( mol, mf, cache=None ):
+    ''' cache, if given, is a localintegrals.localization_cache from a previous geometry: its minimal-basis molecule and the
+        minimal-basis AO list are reused, and updated in place '''
 
     Norbs = mol.nao_nr()
-    ao2iao, S1, pmol = construct_iao( mol, mf )
+    pmol_prev = getattr( cache, 'pmol', None )
+    ao2iao, S1, pmol = construct_iao( mol, mf, pmol=pmol_prev )
     num_iao = ao2iao.shape[ 1 ]
 
     # Determine the complement of the IAO space
@@ -106,7 +96,10 @@ def localize_iao( mol, mf ):
     ao2com     = vecs[ :, : Norbs - num_iao ]
 
     # Redo the IAO contruction for the complement space
-    p_list = construct_p_list( mol, pmol ) # return array of length Norbs; 1 if similar bf in pmol; 0 otherwise
+    p_list = getattr( cache, 'p_list', None )
+    if ( pmol is not pmol_prev ) or ( p_list is None ) or ( len( p_list ) != Norbs ):
+        p_list = construct_p_list( mol, pmol ) # return array of length Norbs; 1 if similar bf in pmol; 0 otherwise
+    if cache is not None: cache.pmol, cache.p_list = pmol, p_list
     S31    = S1[  p_list == 0 , : ]
     S3     = S31[ : , p_list == 0 ]
     X      = np.linalg.solve( S3, np.dot( S31, ao2com ) )
@@ -18,7 +18,7 @@
 '''
 
 #import qcdmet_paths
-from pyscf import gto, scf, ao2mo, tools, lo
+from pyscf import gto, scf, ao2mo, tools, lo, lib
 from pyscf.lo import nao, orth, boys
 from pyscf.tools import molden
 from pyscf.lib import current_memory
@@ -33,21 +33,101 @@ from mrh.my_dmet import iao_helper
 import numpy as np
 import scipy
 from mrh.util.my_math import is_close_to_integer
-from mrh.util.rdm import get_1RDM_from_OEI
+from mrh.util.rdm import get_1RDM_from_OEI, twoCDM_store
 from mrh.util.basis import *
 from mrh.util.tensors import symmetrize_tensor
 from mrh.util.la import matrix_eigen_control_options, matrix_svd_control_options, is_matrix_eye
 from mrh.util import params
+from mrh.util.io import async_writer
 from math import sqrt
 import itertools
-import time, sys
+import time, sys, os, shutil, tempfile, weakref, pickle
 from functools import reduce, partial
 
 LINEAR_DEP_THR = getattr(__config__, 'df_df_DF_lindep', 1e-12)
 
+def _remove_quietly (fname):
+    try:
+        os.remove (fname)
+    except OSError:
+        pass
+
+def _fold_cderi_block (cderi, block, atol, max_rank=None):
+    ''' Compress the rows of cderi and block (both of shape (*, npair)) together into the rows sigma_k v_k^T of their thin SVD,
+        dropping singular values below atol and, if max_rank is given, all but the max_rank largest. The result has the same
+        (P|ij)(P|kl) contraction as the inputs, up to the truncation. The SVD comes from the eigendecomposition of whichever
+        Gram matrix (rows x rows or pairs x pairs) is smaller. '''
+    stack = np.append (cderi, block, axis=0)
+    rowspace = stack.shape[0] <= stack.shape[1]
+    gram = np.dot (stack, stack.T) if rowspace else np.dot (stack.T, stack)
+    evals, evecs = np.linalg.eigh (gram)
+    idx = np.argsort (evals)[::-1]
+    evals, evecs = evals[idx], evecs[:,idx]
+    # Eigenvalues of a Gram matrix below ~eps*max are noise, even when atol**2 is smaller than that
+    thresh = max (atol**2, len (evals) * np.finfo (np.float64).eps * evals[0]) if len (evals) else 0
+    nkeep = np.count_nonzero (evals > thresh)
+    if max_rank is not None: nkeep = min (nkeep, max_rank)
+    if rowspace: return np.dot (evecs[:,:nkeep].T, stack)
+    return (evecs[:,:nkeep] * np.sqrt (evals[:nkeep])).T
+
+def _split_basis_change (loc2old, loc2new, tol=1e-10):
+    ''' Write loc2new = [loc2old, loc2q] @ xtd2new, where loc2q is an orthonormal basis for the part of loc2new outside the span
+        of (orthonormal) loc2old, keeping only directions with singular values above tol. Returns loc2q, xtd2new. '''
+    old2new = np.dot (loc2old.conjugate ().T, loc2new)
+    resid = loc2new - np.dot (loc2old, old2new)
+    if resid.shape[1] == 0: return resid, old2new
+    lvecs, svals = matrix_svd_control_options (resid, sort_vecs=-1, only_nonzero_vals=False, full_matrices=False)[:2]
+    loc2q = lvecs[:,svals > tol]
+    return loc2q, np.append (old2new, np.dot (loc2q.conjugate ().T, loc2new), axis=0)
+
+class localization_cache:
+    ''' Localization state carried from one geometry to the next of a scan or optimization: pass the same object as loc_cache
+        to localintegrals at every geometry. Boys localization starts from the previous geometry's localized orbitals, rotated
+        into the new orbital space (the orthonormal orbitals of that space closest to them, Lowdin-style), instead of from
+        scratch; IAO localization reuses the minimal-basis molecule; and the columns of every kind of ao2loc are given the
+        signs of their counterparts at the previous geometry. Per-geometry wall times and Boys iteration counts are in stats. '''
+
+    def __init__(self):
+        self.mol    = None
+        self.ao2loc = None
+        self.pmol   = None
+        self.p_list = None
+        self.stats  = []
+
+    def get_crossovlp (self, mol, ao2orb):
+        ''' Overlap between the previous geometry's localized orbitals (rows) and ao2orb at the geometry of mol (columns) '''
+        return reduce (np.dot, (self.ao2loc.conjugate ().T, gto.mole.intor_cross ('int1e_ovlp', self.mol, mol), ao2orb))
+
+    def seed (self, mol, ao2orb):
+        ''' The orthonormal orbitals spanning the same space as ao2orb which are closest to the previous localized orbitals,
+            or None if there aren't any of the latter to compare to '''
+        if self.ao2loc is None or self.ao2loc.shape[1] != ao2orb.shape[1]: return None
+        lvecs, svals, rvecs = matrix_svd_control_options (self.get_crossovlp (mol, ao2orb).conjugate ().T, sort_vecs=-1,
+            only_nonzero_vals=False)
+        print ("Localization guess from previous geometry: smallest overlap singular value = {:.4f}".format (np.amin (svals)))
+        return np.dot (ao2orb, np.dot (lvecs, rvecs.conjugate ().T))
+
+    def align_signs (self, mol, ao2loc):
+        if self.ao2loc is None or self.ao2loc.shape[1] != ao2loc.shape[1]: return ao2loc
+        signs = np.sign (np.diag (self.get_crossovlp (mol, ao2loc)))
+        signs[signs == 0] = 1
+        return ao2loc * signs[None,:]
+
+    def store (self, mol, ao2loc, which, wall_time, niter=None):
+        self.stats.append ({'which': which, 'wall_time': wall_time, 'niter': niter})
+        msg = "Localization ({}) at geometry {}: {:.2f} seconds".format (which, len (self.stats) - 1, wall_time)
+        if niter is not None:
+            niter_cold = self.stats[0]['niter']
+            msg += "; {} Boys macro iterations".format (niter)
+            if niter_cold is not None and len (self.stats) > 1:
+                msg += " ({} saved compared to the first geometry)".format (niter_cold - niter)
+        print (msg)
+        self.mol, self.ao2loc = mol, ao2loc
+
 class localintegrals:
 
-    def __init__( self, the_mf, active_orbs, localizationtype, ao_rotation=None, use_full_hessian=True, localization_threshold=1e-6 ):
+    def __init__( self, the_mf, active_orbs, localizationtype, ao_rotation=None, use_full_hessian=True, localization_threshold=1e-6,
+            eri_strategy=None, eri_tmpdir=None, loc_cache=None ):
 
         assert (( localizationtype == 'meta_lowdin' ) or ( localizationtype == 'boys' ) or ( localizationtype == 'lowdin' ) or ( localizationtype == 'iao' ))
         self.num_mf_stab_checks = 0
@@ -55,11 +135,13 @@ class localintegrals:
         # Information on the full HF problem
         self.mol         = the_mf.mol
         self.max_memory  = the_mf.max_memory
+        self.eri_tmpdir  = lib.param.TMPDIR if eri_tmpdir is None else eri_tmpdir
         self.get_jk_ao   = partial (the_mf.get_jk, self.mol)
         self.get_veff_ao = partial (the_mf.get_veff, self.mol)
         self.get_k_ao    = partial (the_mf.get_k, self.mol)
         self.fullovlpao  = the_mf.get_ovlp
         self.fullEhf     = the_mf.e_tot
+        self.mf_xc       = getattr (the_mf, 'xc', None)
         self.fullRDM_ao  = np.asarray (the_mf.make_rdm1 ())
         if self.fullRDM_ao.ndim == 3:
             self.fullSDM_ao = self.fullRDM_ao[0] - self.fullRDM_ao[1]
@@ -81,6 +163,8 @@ class localintegrals:
         self.nelec_tot = int(np.rint( self.mol.nelectron - np.sum( the_mf.mo_occ[ self.active==0 ] ))) # Total number of electrons minus frozen part
 
         # Localize the orbitals
+        t_loc = time.time ()
+        boys_niter = None
         if (( self._which == 'meta_lowdin' ) or ( self._which == 'boys' )):
             if ( self._which == 'meta_lowdin' ):
                 assert( self.norbs_tot == self.mol.nao_nr() ) # Full active space required
@@ -94,11 +178,17 @@ class localintegrals:
             if ( self._which == 'boys' ):
                 old_verbose = self.mol.verbose
                 self.mol.verbose = 5
-                loc = boys.Boys (self.mol, self.ao2loc)
+                seed = None if loc_cache is None else loc_cache.seed (self.mol, self.ao2loc)
+                loc = boys.Boys (self.mol, self.ao2loc if seed is None else seed)
+                if seed is not None: loc.init_guess = None # Start from the seed itself
 #                loc = localizer.localizer( self.mol, self.ao2loc, self._which, use_full_hessian )
                 self.mol.verbose = old_verbose
 #                self.ao2loc = loc.optimize( threshold=localization_threshold )
-                self.ao2loc = loc.kernel ()
+                boys_niter = [0]
+                def count_iter (envs):
+                    boys_niter[0] += 1
+                self.ao2loc = loc.kernel (callback=count_iter)
+                boys_niter = boys_niter[0]
             self.TI_OK = False # Check yourself if OK, then overwrite
         if ( self._which == 'lowdin' ):
             assert( self.norbs_tot == self.mol.nao_nr() ) # Full active space required
@@ -109,11 +199,14 @@ class localintegrals:
             self.TI_OK  = False # Check yourself if OK, then overwrite
         if ( self._which == 'iao' ):
             assert( self.norbs_tot == self.mol.nao_nr() ) # Full active space assumed
-            self.ao2loc = iao_helper.localize_iao( self.mol, the_mf )
+            self.ao2loc = iao_helper.localize_iao( self.mol, the_mf, cache=loc_cache )
             if ( ao_rotation != None ):
                 self.ao2loc = np.dot( self.ao2loc, ao_rotation.T )
             self.TI_OK = False # Check yourself if OK, then overwrite
             #self.molden( 'dump.molden' ) # Debugging mode
+        if loc_cache is not None:
+            self.ao2loc = loc_cache.align_signs (self.mol, self.ao2loc)
+            loc_cache.store (self.mol, self.ao2loc, self._which, time.time () - t_loc, niter=boys_niter)
         assert( self.loc_ortho() < 1e-8 )
 
         # Stored inverse overlap matrix
@@ -144,39 +237,32 @@ class localintegrals:
         self.loc2idem       = np.eye (self.norbs_tot, dtype=self.activeOEI.dtype)
         self.nelec_idem     = self.nelec_tot
         self._eri           = None
+        self._eri_outcore   = None
         self.with_df        = None
+        self._cderi_loc     = None
+        self.wm_mf_ctx      = wm_rhf.impurity_mf_context ()
+        self.output_writer  = async_writer (enabled=False) # dmet swaps in its own
         assert (abs (np.trace (self.oneRDM_loc) - self.nelec_tot) < 1e-8), '{} {}'.format (np.trace (self.oneRDM_loc), self.nelec_tot)
         sys.stdout.flush ()
-        def _is_mem_enough ():
-            return 2*(self.norbs_tot**4)/1e6 + current_memory ()[0] < self.max_memory*0.95
-        # Unfortunately, there is currently no way to do the integral transformation directly on the antisymmetrized two-electron
-        # integrals, at least none already implemented in PySCF. Therefore the smallest possible memory footprint involves 
-        # two arrays of fourfold symmetry, which works out to roughly one half of an array with no symmetry
-        if hasattr (the_mf, 'with_df') and hasattr (the_mf.with_df, '_cderi') and the_mf.with_df._cderi is not None:
+        self.eri_strategy = self.plan_eri_strategy (the_mf, eri_strategy=eri_strategy)
+        if self.eri_strategy == 'df':
             print ("Found density-fitting three-center integrals scf object")
-            loc2ao = self.ao2loc.conjugate ().T
-            locOao = np.dot (loc2ao, self.ao_ovlp)
-            self.with_df = the_mf.with_df
-            self.with_df.loc2eri_bas = lambda x: np.dot (self.ao2loc, x)
-            self.with_df.loc2eri_op = lambda x: reduce (np.dot, (self.ao2loc, x, loc2ao))
-            self.with_df.eri2loc_bas = lambda x: np.dot (locOao, x)
-            self.with_df.eri2loc_op = lambda x: reduce (np.dot, (loc2ao, x, self.ao2loc))
-        elif the_mf._eri is not None:
+            self.with_df = self._tag_eri_bases (the_mf.with_df, ao_basis=True)
+            # J and K in the localized basis are only equivalent to get_veff_ao for Hartree--Fock
+            cderi_loc_size = 8 * self.with_df.get_naoaux () * self.norbs_tot * (self.norbs_tot + 1) / 2e6
+            if getattr (the_mf, 'xc', None) is None and cderi_loc_size + current_memory ()[0] < self.max_memory*0.5:
+                print ("Caching {:.0f}-MB three-center integrals in the localized basis for JK builds".format (cderi_loc_size))
+                self._cderi_loc = self._build_cderi_loc ()
+        elif self.eri_strategy == 'scf_eri':
             print ("Found eris on scf object")
-            loc2ao = self.ao2loc.conjugate ().T
-            locOao = np.dot (loc2ao, self.ao_ovlp)
-            self._eri = the_mf._eri
-            self._eri = tag_array (self._eri, loc2eri_bas = lambda x: np.dot (self.ao2loc, x))
-            self._eri = tag_array (self._eri, loc2eri_op = lambda x: reduce (np.dot, (self.ao2loc, x, loc2ao)))
-            self._eri = tag_array (self._eri, eri2loc_bas = lambda x: np.dot (locOao, x))
-            self._eri = tag_array (self._eri, eri2loc_op = lambda x: reduce (np.dot, (loc2ao, x, self.ao2loc)))
-        elif _is_mem_enough ():
+            self._eri = self._tag_eri_bases (the_mf._eri, ao_basis=True)
+        elif self.eri_strategy == 'incore':
             print ("Storing eris in memory")
             self._eri = ao2mo.restore (8, ao2mo.outcore.full_iofree (self.mol, self.ao2loc, compact=True), self.norbs_tot)
-            self._eri = tag_array (self._eri, loc2eri_bas = lambda x: x)
-            self._eri = tag_array (self._eri, loc2eri_op = lambda x: x)
-            self._eri = tag_array (self._eri, eri2loc_bas = lambda x: x)
-            self._eri = tag_array (self._eri, eri2loc_op = lambda x: x)
+            self._eri = self._tag_eri_bases (self._eri, ao_basis=False)
+        elif self.eri_strategy == 'outcore':
+            print ("Storing eris on disk in {}".format (self.eri_tmpdir))
+            self._eri_outcore = self._build_eri_outcore ()
         else:
             print ("Direct calculation")
         sys.stdout.flush ()
@@ -248,10 +334,268 @@ class localintegrals:
 
         return self.activeOEI + self.activeJKcorr + self.activeJKidem
         
+    def publish_shared (self, dirname=None):
+        ''' Write the arrays of this object to .npy files in a new directory (by default in /dev/shm, if it exists, so that the
+            files live in shared memory) together with a small pickled header holding everything else. attach_shared
+            memory-maps them read-only, so any number of processes on the node share one copy of the integrals.
+            The arrays are a snapshot: later changes to this object (e.g., by setup_wm_core_scf) are not seen by the
+            attached copies. Returns the directory name; remove it with release_shared when all workers are done. '''
+        t0, w0 = time.process_time (), time.time ()
+        if dirname is None:
+            tmpdir = '/dev/shm' if os.path.isdir ('/dev/shm') else self.eri_tmpdir
+            dirname = tempfile.mkdtemp (prefix='localintegrals', dir=tmpdir)
+        else:
+            os.makedirs (dirname)
+        header = {'mol': self.mol.dumps (), 'arrays': [], 'eri_ao_basis': self.eri_strategy == 'scf_eri',
+                  'eri_outcore_file': getattr (self, '_eri_outcore_file', None), 'df_cderi': None, 'df_auxbasis': None}
+        if self.with_df is not None:
+            header['df_auxbasis'] = self.with_df.auxbasis
+            if isinstance (self.with_df._cderi, np.ndarray):
+                np.save (os.path.join (dirname, 'df_cderi.npy'), self.with_df._cderi)
+                header['df_cderi'] = os.path.join (dirname, 'df_cderi.npy')
+            else: # Already on disk
+                header['df_cderi'] = self.with_df._cderi
+        nbytes = 0
+        for key, val in self.__dict__.items ():
+            if key in _SHARED_REBUILT_KEYS: continue
+            if isinstance (val, np.ndarray):
+                np.save (os.path.join (dirname, key + '.npy'), np.asarray (val))
+                header['arrays'].append (key)
+                nbytes += val.nbytes
+            else:
+                header[key] = val
+        if self._eri is not None:
+            np.save (os.path.join (dirname, '_eri.npy'), np.asarray (self._eri))
+            header['arrays'].append ('_eri')
+            nbytes += self._eri.nbytes
+        with open (os.path.join (dirname, 'header.pkl.tmp'), 'wb') as f:
+            pickle.dump (header, f)
+        os.replace (os.path.join (dirname, 'header.pkl.tmp'), os.path.join (dirname, 'header.pkl'))
+        print ("({}, {}) seconds to publish {:.0f} MB of localized integrals in {}".format (time.process_time () - t0, time.time () - w0,
+            nbytes / 1e6, dirname))
+        return dirname
+
+    def _tag_eri_bases (self, eri, ao_basis=True):
+        ''' Attach the functions that carry orbitals and operators between the localized basis and the basis of eri
+            (a with_df object or an eri array), which is the AO basis if ao_basis and the localized basis otherwise '''
+        if ao_basis:
+            loc2ao = self.ao2loc.conjugate ().T
+            locOao = np.dot (loc2ao, self.ao_ovlp)
+            tags = {'loc2eri_bas': lambda x: np.dot (self.ao2loc, x),
+                    'loc2eri_op': lambda x: reduce (np.dot, (self.ao2loc, x, loc2ao)),
+                    'eri2loc_bas': lambda x: np.dot (locOao, x),
+                    'eri2loc_op': lambda x: reduce (np.dot, (loc2ao, x, self.ao2loc))}
+        else:
+            tags = {'loc2eri_bas': lambda x: x, 'loc2eri_op': lambda x: x, 'eri2loc_bas': lambda x: x, 'eri2loc_op': lambda x: x}
+        if isinstance (eri, np.ndarray):
+            return tag_array (eri, **tags)
+        for key, fn in tags.items ():
+            setattr (eri, key, fn)
+        return eri
+
+    def plan_eri_strategy (self, the_mf, eri_strategy=None):
+        ''' Estimate the memory and disk footprints of every way of handling the two-electron integrals for the current
+            max_memory, print them, and pick one. eri_strategy forces a choice. Returns one of
+                'df': three-center integrals of a density-fitting scf object
+                'scf_eri': (ij|kl) in the AO basis held by the scf object
+                'incore': (ij|kl) in the localized basis with eightfold symmetry, in memory
+                'outcore': (ij|kl) in the localized basis with fourfold symmetry, memory-mapped from a file in eri_tmpdir
+                'direct': recompute from the AO integrals for every transformation '''
+        norbs = self.norbs_tot
+        npair = norbs * (norbs + 1) // 2
+        mem_free = self.max_memory*0.95 - current_memory ()[0]
+        try:
+            disk_free = shutil.disk_usage (self.eri_tmpdir).free / 1e6
+        except OSError:
+            disk_free = 0
+        has_df = hasattr (the_mf, 'with_df') and getattr (the_mf.with_df, '_cderi', None) is not None
+        # Unfortunately, there is currently no way to do the integral transformation directly on the antisymmetrized two-electron
+        # integrals, at least none already implemented in PySCF. Therefore the smallest possible memory footprint involves 
+        # two arrays of fourfold symmetry, which works out to roughly one half of an array with no symmetry
+        incore_mem = 2*(norbs**4)/1e6
+        # ao2mo.outcore writes an HDF5 file which is then copied row block by row block into the memory-mapped array,
+        # so the disk requirement briefly doubles. Only a block of rows is ever in memory.
+        outcore_disk = 2 * 8 * npair * npair / 1e6
+        outcore_mem = min (max (mem_free, 0), 8 * norbs * npair / 1e6 + 200)
+        # (name, available, memory (MB), disk (MB))
+        table = [('df', has_df, 8 * the_mf.with_df.get_naoaux () * npair / 1e6 if has_df else 0, 0),
+                 ('scf_eri', getattr (the_mf, '_eri', None) is not None, 0, 0),
+                 ('incore', incore_mem < mem_free, incore_mem, 0),
+                 ('outcore', outcore_disk < disk_free*0.9 and 8 * norbs * npair / 1e6 < mem_free, outcore_mem, outcore_disk),
+                 ('direct', True, 0, 0)]
+        print ("Two-electron integral strategies for {} localized orbitals (max_memory = {} MB, {:.0f} MB in use, {:.0f} MB free in {}):".format (
+            norbs, self.max_memory, current_memory ()[0], disk_free, self.eri_tmpdir))
+        print ("{:>8s} {:>9s} {:>12s} {:>12s}".format ('strategy', 'available', 'memory (MB)', 'disk (MB)'))
+        for name, avail, mem, disk in table:
+            print ("{:>8s} {:>9s} {:12.0f} {:12.0f}".format (name, str (bool (avail)), mem, disk))
+        if eri_strategy is None:
+            eri_strategy = [name for name, avail, mem, disk in table if avail][0]
+        else:
+            avail = dict ([(name, avail) for name, avail, mem, disk in table])
+            if eri_strategy not in avail:
+                raise RuntimeError ("Unknown ERI strategy {}; choose from {}".format (eri_strategy, list (avail.keys ())))
+            if not avail[eri_strategy] and eri_strategy in ('df', 'scf_eri'):
+                raise RuntimeError ("ERI strategy {} requested but the scf object doesn't support it".format (eri_strategy))
+            elif not avail[eri_strategy]:
+                print ("Warning: ERI strategy {} requested but it doesn't appear to fit within the available resources".format (eri_strategy))
+        print ("Chosen ERI strategy: {}".format (eri_strategy))
+        return eri_strategy
+
+    def _eri_outcore_nrows (self, rowsize, nmax):
+        ''' How many rows of rowsize doubles to read from disk at once '''
+        mem_avail = max (self.max_memory - current_memory ()[0], 0) * 0.3e6
+        return max (1, min (nmax, int (mem_avail / 8 / max (rowsize, 1))))
+
+    def _build_eri_outcore (self):
+        ''' (ij|kl) in the localized basis with i>=j and k>=l, as a read-only memory-mapped array of shape (npair, npair).
+            The file is written in row blocks and is removed when this object is garbage-collected. '''
+        import h5py
+        t0, w0 = time.process_time (), time.time ()
+        npair = self.norbs_tot*(self.norbs_tot+1)//2
+        fd, h5name = tempfile.mkstemp (suffix='.h5', prefix='loc_eri', dir=self.eri_tmpdir)
+        os.close (fd)
+        fd, npyname = tempfile.mkstemp (suffix='.npy', prefix='loc_eri', dir=self.eri_tmpdir)
+        os.close (fd)
+        weakref.finalize (self, _remove_quietly, npyname)
+        try:
+            ao2mo.outcore.full (self.mol, self.ao2loc, h5name, dataname='eri_loc', compact=True,
+                max_memory=max (self.max_memory - current_memory ()[0], 1000) * 0.5)
+            eri = np.lib.format.open_memmap (npyname, mode='w+', dtype=np.float64, shape=(npair, npair))
+            blksize = self._eri_outcore_nrows (npair, npair)
+            with h5py.File (h5name, 'r') as f:
+                dset = f['eri_loc']
+                for p0 in range (0, npair, blksize):
+                    p1 = min (npair, p0 + blksize)
+                    eri[p0:p1] = dset[p0:p1]
+            eri.flush ()
+            del eri
+        finally:
+            _remove_quietly (h5name)
+        self._eri_outcore_file = npyname
+        print ("({}, {}) seconds to write {:.0f}-MB eri file in the localized basis".format (time.process_time () - t0, time.time () - w0,
+            8 * npair * npair / 1e6))
+        return np.load (npyname, mmap_mode='r')
+
+    def _general_tei_outcore (self, loc2bas_list, compact=False):
+        ''' general_tei from the memory-mapped localized-basis eris, streamed from disk in blocks of rows i (all j <= i) of (ij|kl).
+            Each block is transformed over kl by ao2mo and contracted into the (I,KL,J) result, so only one block and the result
+            are in memory at a time. Returns the same shapes as ao2mo.incore.general. '''
+        c0, c1, c2, c3 = [np.asarray (l2b, dtype=np.float64) for l2b in loc2bas_list]
+        norbs = self.norbs_tot
+        n0, n1 = c0.shape[1], c1.shape[1]
+        sym01 = c0.shape == c1.shape and np.allclose (c0, c1)
+        klmosym, nkl, mokl, klslice = ao2mo.incore._conc_mos (c2, c3, compact=compact)
+        tril_i, tril_j = np.tril_indices (norbs)
+        rowcost = norbs * (norbs + 1) // 2 + norbs * (nkl + 1) + nkl * max (n0, n1, 1)
+        nrows_i = self._eri_outcore_nrows (norbs * rowcost, norbs)
+        TEI = np.zeros ((n0, nkl, n1), dtype=np.float64)
+        for i0 in range (0, norbs, nrows_i):
+            i1 = min (norbs, i0 + nrows_i)
+            p0, p1 = i0*(i0+1)//2, i1*(i1+1)//2
+            eri_kl = ao2mo._ao2mo.nr_e2 (np.ascontiguousarray (self._eri_outcore[p0:p1]), mokl, klslice, aosym='s2', mosym=klmosym)
+            # Unpack the pair index of this block into (i,j), j <= i, counting the diagonal once
+            idx_i, idx_j = tril_i[p0:p1], tril_j[p0:p1]
+            eri_kl[idx_i==idx_j] *= 0.5
+            eri_ikj = np.zeros ((i1-i0, nkl, i1), dtype=np.float64)
+            eri_ikj[idx_i-i0,:,idx_j] = eri_kl
+            TEI += np.dot (c0[i0:i1].T, np.dot (eri_ikj, c1[:i1]).reshape (i1-i0, -1)).reshape (n0, nkl, n1)
+            if not sym01:
+                TEI += np.dot (c1[i0:i1].T, np.dot (eri_ikj, c0[:i1]).reshape (i1-i0, -1)).reshape (n1, nkl, n0).transpose (2,1,0)
+        if sym01: TEI += TEI.transpose (2,1,0)
+        TEI = TEI.transpose (0,2,1)
+        if compact and sym01:
+            return np.ascontiguousarray (TEI[np.tril_indices (n0)])
+        return np.ascontiguousarray (TEI.reshape (n0*n1, nkl))
+
+    def _build_cderi_loc (self):
+        ''' (P|ij) in the localized basis with i>=j, as an array of shape (naux, norbs_tot*(norbs_tot+1)/2) '''
+        t0, w0 = time.process_time (), time.time ()
+        npair = self.norbs_tot*(self.norbs_tot+1)//2
+        cderi_loc = np.empty ((self.with_df.get_naoaux (), npair), dtype=self.ao2loc.dtype)
+        ijmosym, mij_pair, moij, ijslice = ao2mo.incore._conc_mos (self.ao2loc, self.ao2loc, compact=True)
+        b0 = 0
+        for eri1 in self.with_df.loop ():
+            b1 = b0 + eri1.shape[0]
+            eri2 = cderi_loc[b0:b1]
+            eri2 = ao2mo._ao2mo.nr_e2 (eri1, moij, ijslice, aosym='s2', mosym=ijmosym, out=eri2)
+            b0 = b1
+        print ("({}, {}) seconds to transform cderi into the localized basis".format (time.process_time () - t0, time.time () - w0))
+        return cderi_loc
+
+    def get_jk_loc (self, DMloc, with_j=True, with_k=True, eig_thresh=1e-12):
+        ''' J and K matrices of one or several density matrices built directly from the cached localized-basis three-center integrals.
+            K is built from the eigenvectors of DMloc with nonzero eigenvalues only, so its cost is proportional to the rank of DMloc
+            (i.e., to the number of orbitals in which the density is actually changing for an active-space or difference density). '''
+        dms = np.asarray (DMloc)
+        dms = dms.reshape (-1, self.norbs_tot, self.norbs_tot)
+        ndm, norbs = dms.shape[0], self.norbs_tot
+        naux = self._cderi_loc.shape[0]
+        vj = vk = None
+        if with_j:
+            idx = np.arange (norbs)
+            dm_tril = lib.pack_tril (dms + dms.transpose (0,2,1))
+            dm_tril[:,idx*(idx+1)//2+idx] *= .5
+            rho = np.dot (self._cderi_loc, dm_tril.T)
+            vj = lib.unpack_tril (np.dot (rho.T, self._cderi_loc))
+        if with_k:
+            vk = np.zeros ((ndm, norbs, norbs), dtype=dms.dtype)
+            factors = []
+            for dm in dms:
+                evals, evecs = np.linalg.eigh ((dm + dm.T) / 2)
+                idx = np.abs (evals) > eig_thresh
+                factors.append ((evals[idx], evecs[:,idx]))
+            nrank = max ([len (evals) for evals, evecs in factors] + [1])
+            blksize = max (1, min (naux, int ((self.max_memory - current_memory ()[0]) * 0.3e6 / 8 / (norbs * (norbs + nrank)))))
+            for p0 in range (0, naux, blksize):
+                p1 = min (naux, p0 + blksize)
+                cderi = lib.unpack_tril (self._cderi_loc[p0:p1])
+                for k, (evals, evecs) in enumerate (factors):
+                    if not len (evals): continue
+                    bc = np.dot (cderi, evecs).transpose (1,0,2) # (P|i n) -> i,P,n
+                    vk[k] += np.dot ((bc * evals[None,None,:]).reshape (norbs, -1), bc.reshape (norbs, -1).T)
+        if vj is not None and np.asarray (DMloc).ndim == 2: vj = vj[0]
+        if vk is not None and np.asarray (DMloc).ndim == 2: vk = vk[0]
+        return vj, vk
+
+    def get_jk_loc_batch (self, DMlocs, hermi=1):
+        ''' J and K matrices of a stack of density matrices in the localized basis from a single pass over the two-electron
+            integrals: the cached localized three-center integrals, the in-memory localized eris, or else pyscf's get_jk on the
+            stack of AO-basis densities (which also loops over the integrals only once for any number of densities).
+            Returns vj, vk with the same shape as DMlocs. '''
+        dms = np.asarray (DMlocs)
+        shape = dms.shape
+        dms = dms.reshape (-1, self.norbs_tot, self.norbs_tot)
+        if self._cderi_loc is not None and hermi == 1:
+            vj, vk = self.get_jk_loc (dms)
+        elif self._eri is not None and self.eri_strategy == 'incore':
+            vj, vk = dot_eri_dm (self._eri, dms, hermi=hermi)
+        else:
+            loc2ao = self.ao2loc.conjugate ().T
+            vj, vk = self.get_jk_ao (np.matmul (np.matmul (self.ao2loc, dms), loc2ao), hermi)
+            vj = np.matmul (np.matmul (loc2ao, np.asarray (vj).reshape (dms.shape[0], -1, self.ao2loc.shape[0])), self.ao2loc)
+            vk = np.matmul (np.matmul (loc2ao, np.asarray (vk).reshape (dms.shape[0], -1, self.ao2loc.shape[0])), self.ao2loc)
+        return np.asarray (vj).reshape (shape), np.asarray (vk).reshape (shape)
+
+    def loc_rhf_jk_k_batch (self, RDMlocs, SDMlocs):
+        ''' [loc_rhf_jk_bis (dm) for dm in RDMlocs], [loc_rhf_k_bis (dm) for dm in SDMlocs] from one pass over the integrals.
+            If the scf object isn't Hartree--Fock, loc_rhf_jk_bis isn't linear in the density, so RDMlocs are done one by one. '''
+        RDMlocs, SDMlocs = list (RDMlocs), list (SDMlocs)
+        nr = len (RDMlocs)
+        if nr + len (SDMlocs) == 0: return [], []
+        if self.mf_xc is None:
+            vj, vk = self.get_jk_loc_batch (RDMlocs + SDMlocs)
+            return [j - k/2 for j, k in zip (vj[:nr], vk[:nr])], list (vk[nr:])
+        JK = [self.loc_rhf_jk_bis (dm) for dm in RDMlocs]
+        K = list (self.get_jk_loc_batch (SDMlocs)[1]) if len (SDMlocs) else []
+        return JK, K
+
     def loc_rhf_jk_bis( self, DMloc ):
         '''    
             DMloc must be the spin-summed density matrix
         '''
+        if self._cderi_loc is not None:
+            vj, vk = self.get_jk_loc (DMloc)
+            return vj - vk/2
         DM_ao = represent_operator_in_basis (DMloc, self.ao2loc.T )
         JK_ao = self.get_veff_ao (DM_ao, 0, 0, 1) #Last 3 numbers: dm_last, vhf_last, hermi
         if JK_ao.ndim == 3:
@@ -266,6 +610,8 @@ class localintegrals:
 
     def loc_rhf_k_bis (self, DMloc):
 
+        if self._cderi_loc is not None:
+            return self.get_jk_loc (DMloc, with_j=False)[1]
         DM_ao = represent_operator_in_basis (DMloc, self.ao2loc.T)
         K_ao = self.get_k_ao (DM_ao, 1)
         K_loc = represent_operator_in_basis (K_ao, self.ao2loc)
@@ -290,6 +636,7 @@ class localintegrals:
 
         nelec      = nelec   or self.nelec_idem
         loc2wrk    = loc2wrk if np.any (loc2wrk) else self.loc2idem
+        warm_start = not np.any (oneRDMguess_loc)
         oneRDM_wrk = represent_operator_in_basis (oneRDMguess_loc, loc2wrk) if np.any (oneRDMguess_loc) else None
         nocc       = nelec // 2
 
@@ -304,7 +651,7 @@ class localintegrals:
             self.num_mf_stab_checks, self.get_veff_ao, self.get_jk_ao,
             groupname=self.symmetry, symm_orb=wrk2symm, irrep_name=self.mol.irrep_name,
             irrep_id=self.mol.irrep_id, enforce_symmetry=self.enforce_symmetry,
-            output=output)
+            output=output, mf_ctx=self.wm_mf_ctx, loc2basis=loc2wrk, warm_start=warm_start)
         if self.enforce_symmetry: assert (is_operator_block_adapted (oneRDM_wrk, wrk2symm)), measure_operator_blockbreaking (oneRDM_wrk, wrk2symm)
         oneRDM_loc = represent_operator_in_basis (oneRDM_wrk, loc2wrk.T)
         if self.enforce_symmetry: assert (is_operator_block_adapted (oneRDM_loc, self.loc2symm)), measure_operator_blockbreaking (oneRDM_loc, self.loc2symm)
@@ -323,15 +670,20 @@ class localintegrals:
 
         loc2corr = np.concatenate ([frag.loc2amo for frag in fragments], axis=1)
 
+        # The JK of the correlated 1RDM, the K of the correlated spin density, and the K of the fragments' active-space spin densities
+        # for E2_cum all come from a single pass over the integrals
+        frags_E2 = [frag for frag in fragments if frag.norbs_as > 0 and frag.E2_cum == 0 and np.amax (np.abs (frag.twoCDMimp_amo)) > 0]
+        JKcorr, Klist = self.loc_rhf_jk_k_batch ([oneRDMcorr_loc], [oneSDMcorr_loc] + [frag.oneSDMas_loc for frag in frags_E2])
+        JKcorr, Kcorr = JKcorr[0], Klist[0]
+
         # Calculate E2_cum            
         E2_cum = 0
         for frag in fragments:
             if frag.norbs_as > 0:
-                if frag.E2_cum == 0 and np.amax (np.abs (frag.twoCDMimp_amo)) > 0:
-                    V  = self.dmet_tei (frag.loc2amo)
-                    L  = frag.twoCDMimp_amo
-                    frag.E2_cum  = np.tensordot (V, L, axes=4) / 2
-                    K  = self.loc_rhf_k_bis (frag.oneSDMas_loc)
+                if frag in frags_E2:
+                    L  = twoCDM_store ([frag.loc2amo], [frag.twoCDMimp_amo])
+                    frag.E2_cum  = L.contract_eri (partial (self.dmet_tei, symmetry=8)) / 2
+                    K  = Klist[1+frags_E2.index (frag)]
                     frag.E2_cum += (K * frag.oneSDMas_loc).sum () / 4
                 E2_cum += frag.E2_cum
             
@@ -357,9 +709,8 @@ class localintegrals:
             raise ValueError ("nelec_corr not an integer! {}".format (nelec_corr))
         nelec_idem     = int (round (self.nelec_tot - nelec_corr))
         if nelec_idem % 2: raise NotImplementedError ("Odd % of unactive electrons")
-        JKcorr         = self.loc_rhf_jk_bis (oneRDMcorr_loc)
         oei            = self.activeOEI + JKcorr/2
-        vk             = -self.loc_rhf_k_bis (oneSDMcorr_loc)/2
+        vk             = -Kcorr/2
         working_const  = self.activeCONST + (oei * oneRDMcorr_loc).sum () + (vk * oneSDMcorr_loc).sum ()/2 + E2_cum
         oneRDMidem_loc = self.get_wm_1RDM_from_scf_on_OEI (self.loc_oei () + JKcorr, nelec=nelec_idem, loc2wrk=loc2idem, oneRDMguess_loc=oneRDMguess_loc,
             output = calcname + '_trial_wvfn.log', working_const=working_const)
@@ -392,7 +743,7 @@ class localintegrals:
 
         # Analysis: 1RDM and total energy
         print ("Analyzing LASSCF trial wave function")
-        jk = np.stack ([JKcorr + JKidem, -self.loc_rhf_k_bis (oneSDM_loc)/2], axis=0)
+        jk = np.stack ([JKcorr + JKidem, vk], axis=0) # oneSDM_loc is oneSDMcorr_loc
         dm = np.stack ([oneRDM_loc, oneSDM_loc], axis=0)
         E = self.activeCONST + (self.activeOEI * oneRDM_loc).sum () + (jk * dm).sum ()/2 + E2_cum
         print ("LASSCF trial wave function total energy: {:.6f}".format (E))
@@ -402,7 +753,8 @@ class localintegrals:
         ao2molden, ene_no, occ_no = self.get_trial_nos (aobasis=True, loc2wmas=loc2corr, oneRDM_loc=oneRDM_loc,
             fock=self.activeFOCK, jmol_shift=True, try_symmetrize=True)
         print ("Writing trial wave function molden")
-        molden.from_mo (self.mol, calcname + '_trial_wvfn.molden', ao2molden, occ=occ_no, ene=ene_no)
+        fname = calcname + '_trial_wvfn.molden'
+        self.output_writer.submit (fname, molden.from_mo, self.mol, fname, ao2molden, occ=occ_no, ene=ene_no)
 
     def restore_wm_full_scf (self):
         self.activeFOCK     = represent_operator_in_basis (self.fullFOCK_ao,  self.ao2loc )
@@ -420,14 +772,17 @@ class localintegrals:
         OEIdmet  = np.dot( np.dot( loc2dmet[:,:numActive].T, self.activeOEI ), loc2dmet[:,:numActive] )
         return symmetrize_tensor (OEIdmet)
         
-    def dmet_fock( self, loc2dmet, numActive, coreDMloc ):
+    def dmet_fock( self, loc2dmet, numActive, coreDMloc, JKloc=None ):
+        ''' JKloc, if given, is loc_rhf_jk_bis (coreDMloc) computed in advance (e.g., by loc_rhf_jk_k_batch) '''
     
-        FOCKdmet  = np.dot( np.dot( loc2dmet[:,:numActive].T, self.loc_rhf_fock_bis( coreDMloc ) ), loc2dmet[:,:numActive] )
+        FOCKloc = self.loc_rhf_fock_bis( coreDMloc ) if JKloc is None else self.activeOEI + JKloc
+        FOCKdmet  = np.dot( np.dot( loc2dmet[:,:numActive].T, FOCKloc ), loc2dmet[:,:numActive] )
         return symmetrize_tensor (FOCKdmet)
         
-    def dmet_k (self, loc2imp, norbs_imp, DMloc):
+    def dmet_k (self, loc2imp, norbs_imp, DMloc, Kloc=None):
 
-        k_imp = represent_operator_in_basis (self.loc_rhf_k_bis (DMloc), loc2imp[:,:norbs_imp])
+        Kloc = self.loc_rhf_k_bis (DMloc) if Kloc is None else Kloc
+        k_imp = represent_operator_in_basis (Kloc, loc2imp[:,:norbs_imp])
         return symmetrize_tensor (k_imp)
 
     def dmet_init_guess_rhf( self, loc2dmet, numActive, numPairs, norbs_frag, chempot_imp ):
@@ -440,67 +795,161 @@ class localintegrals:
         DMguess = 2 * np.dot( eigvecs[ :, :numPairs ], eigvecs[ :, :numPairs ].T )
         return DMguess
 
-    def dmet_cderi (self, loc2dmet, numAct=None):
+    def dmet_cderi (self, loc2dmet, numAct=None, compression='svd', max_rank=None, return_aux=False):
+        ''' Three-center integrals (P|ij) projected onto the first numAct columns of loc2dmet, compressed in the auxiliary index.
+            compression='svd' projects the whole tensor and then does a dense SVD of it; compression='stream' folds each block
+            of with_df.loop () into the compressed tensor as soon as it is projected, so only one block and the compressed
+            tensor are ever in memory. max_rank caps the number of compressed auxiliary functions in the latter case.
+            With return_aux, also return the compressed auxiliary functions in terms of with_df's (see update_dmet_cderi),
+            or None for compression='stream', which never has them. '''
 
-        t0 = time.clock ()
+        t0 = time.process_time ()
         w0 = time.time ()     
         norbs_aux = self.with_df.get_naoaux ()   
         numAct = loc2dmet.shape[1] if numAct==None else numAct
         loc2imp = loc2dmet[:,:numAct]
         assert (self.with_df is not None), "density fitting required"
+        assert (compression in ('svd', 'stream')), "unknown cderi compression {}".format (compression)
         npair = numAct*(numAct+1)//2
-        CDERI = np.empty ((self.with_df.get_naoaux (), npair), dtype=loc2dmet.dtype)
-        full_cderi_size = (norbs_aux * self.mol.nao_nr () * (self.mol.nao_nr () + 1) * CDERI.itemsize // 2) / 1e6
-        imp_eri_size = (CDERI.itemsize * npair * (npair+1) // 2) / 1e6 
-        imp_cderi_size = CDERI.size * CDERI.itemsize / 1e6
+        itemsize = np.dtype (loc2dmet.dtype).itemsize
+        full_cderi_size = (norbs_aux * self.mol.nao_nr () * (self.mol.nao_nr () + 1) * itemsize // 2) / 1e6
+        imp_eri_size = (itemsize * npair * (npair+1) // 2) / 1e6 
+        imp_cderi_size = norbs_aux * npair * itemsize / 1e6
         print ("Size comparison: cderi is ({0},{1},{1})->{2:.0f} MB compacted; eri is ({1},{1},{1},{1})->{3:.0f} MB compacted".format (
                 norbs_aux, numAct, imp_cderi_size, imp_eri_size))
         ao2imp = np.dot (self.ao2loc, loc2imp)
         ijmosym, mij_pair, moij, ijslice = ao2mo.incore._conc_mos (ao2imp, ao2imp, compact=True)
+        if compression == 'stream':
+            CDERI = np.zeros ((0, npair), dtype=loc2dmet.dtype)
+            nnonzero = 0
+            for eri1 in self.with_df.loop ():
+                eri2 = ao2mo._ao2mo.nr_e2 (eri1, moij, ijslice, aosym='s2', mosym=ijmosym)
+                eri2 = eri2[np.amax (np.abs (eri2), axis=1) > sqrt(LINEAR_DEP_THR)]
+                nnonzero += eri2.shape[0]
+                CDERI = _fold_cderi_block (CDERI, eri2, sqrt(LINEAR_DEP_THR), max_rank)
+            imp_cderi_size = CDERI.size * CDERI.itemsize / 1e6
+            print ("From {} auxiliary functions, {} have nonzero rows of the 3-center integral".format (norbs_aux, nnonzero))
+            print (("With streaming compression: {0} compressed auxiliary functions; {1:.0f}-MB CDERI array, compared to "
+                    "{2:.0f}-MB eri; ({3}, {4}) seconds").format (CDERI.shape[0], imp_cderi_size, imp_eri_size,
+                    time.process_time () - t0, time.time () - w0))
+            CDERI = np.ascontiguousarray (CDERI)
+            return (CDERI, None) if return_aux else CDERI
+
+        CDERI = np.empty ((self.with_df.get_naoaux (), npair), dtype=loc2dmet.dtype)
         b0 = 0
         for eri1 in self.with_df.loop ():
             b1 = b0 + eri1.shape[0]
             eri2 = CDERI[b0:b1]
             eri2 = ao2mo._ao2mo.nr_e2 (eri1, moij, ijslice, aosym='s2', mosym=ijmosym, out=eri2)
             b0 = b1
-        t1 = time.clock ()
+        t1 = time.process_time ()
         w1 = time.time ()
         print (("({0}, {1}) seconds to turn {2:.0f}-MB full"
                 "cderi array into {3:.0f}-MP impurity cderi array").format (
                 t1 - t0, w1 - w0, full_cderi_size, imp_cderi_size))
 
+        CDERI, aux2c = self._compress_cderi (CDERI)
+        imp_cderi_size = CDERI.size * CDERI.itemsize / 1e6
+        print ("With SVD: {0:.0f}-MB CDERI array, compared to {1:.0f}-MB eri; ({2}, {3}) seconds".format (
+            imp_cderi_size, imp_eri_size, time.process_time () - t1, time.time () - w1))
+        return (CDERI, aux2c) if return_aux else CDERI
+
+    def _compress_cderi (self, CDERI):
+        ''' Compress CDERI of shape (naux, npair) to sigma_k v_k^T of its thin SVD. Also returns aux2c, the left singular vectors
+            u_k (zero on the rows that were dropped up front for being zero), so that CDERI ~= aux2c @ compressed CDERI. '''
         # Compression step 1: remove zero rows
+        norbs_aux = CDERI.shape[0]
         idx_nonzero = np.amax (np.abs (CDERI), axis=1) > sqrt(LINEAR_DEP_THR)
         print ("From {} auxiliary functions, {} have nonzero rows of the 3-center integral".format (norbs_aux, np.count_nonzero (idx_nonzero)))
         CDERI = CDERI[idx_nonzero]
 
         # Compression step 2: svd
-        sigma, vmat = matrix_svd_control_options (CDERI, sort_vecs=-1, only_nonzero_vals=True, full_matrices=False, num_zero_atol=sqrt(LINEAR_DEP_THR))[1:]
-        imp_cderi_size = vmat.size * vmat.itemsize / 1e6
+        umat, sigma, vmat = matrix_svd_control_options (CDERI, sort_vecs=-1, only_nonzero_vals=True, full_matrices=False, num_zero_atol=sqrt(LINEAR_DEP_THR))
         print ("From {} nonzero aux-function rows, {} nonzero singular values found".format (np.count_nonzero (idx_nonzero), len (sigma)))
-        print ("With SVD: {0:.0f}-MB CDERI array, compared to {1:.0f}-MB eri; ({2}, {3}) seconds".format (
-            imp_cderi_size, imp_eri_size, time.clock () - t1, time.time () - w1))
-        CDERI = np.ascontiguousarray ((vmat * sigma).T)
-        return CDERI
+        aux2c = np.zeros ((norbs_aux, len (sigma)), dtype=umat.dtype)
+        aux2c[idx_nonzero,:] = umat
+        return np.ascontiguousarray ((vmat * sigma).T), aux2c
+
+    def update_dmet_tei (self, TEI_old, loc2old, loc2new, max_frac=0.25, verbose=False):
+        ''' Impurity ERIs (symmetry=8) in the basis loc2new, from TEI_old (symmetry=8) in the basis loc2old, for when the impurity
+            basis has only gained or lost a few orbitals. Only integrals with at least one index on the part of loc2new outside the
+            span of loc2old are computed from the localized-basis integrals; everything else is a transformation of TEI_old.
+            Returns None if more than max_frac of loc2new is outside that span, in which case a rebuild with dmet_tei is cheaper. '''
+        t0 = time.time ()
+        loc2q, xtd2new = _split_basis_change (loc2old, loc2new)
+        nold, nq, nnew = loc2old.shape[1], loc2q.shape[1], loc2new.shape[1]
+        if nq > max_frac * nnew: return None
+        nxtd = nold + nq
+        # Everything stays in the 4-fold (pair x pair) packed form. The pairs of the old orbitals are the leading
+        # nold*(nold+1)/2 rows and columns of the pair index of the extended basis [loc2old, loc2q].
+        npair_old, npair_xtd = nold * (nold + 1) // 2, nxtd * (nxtd + 1) // 2
+        TEI = np.empty ((npair_xtd, npair_xtd), dtype=np.float64)
+        TEI[:npair_old,:npair_old] = ao2mo.restore (4, TEI_old, nold)
+        if nq > 0:
+            # (pq|rQ) gives every pair rs with r in Q, which are all the remaining columns; the rows follow by symmetry
+            loc2xtd = np.append (loc2old, loc2q, axis=1)
+            pqrQ = self.general_tei ([loc2xtd, loc2xtd, loc2xtd, loc2q], compact=True).reshape (npair_xtd, nxtd, nq)
+            tril_r, tril_s = np.tril_indices (nxtd)
+            tril_r, tril_s = tril_r[npair_old:], tril_s[npair_old:]
+            TEI[:,npair_old:] = pqrQ[:,tril_s,tril_r-nold]
+            pqrQ = None
+            TEI[npair_old:,:npair_old] = TEI[:npair_old,npair_old:].T
+        # Two half-transformations of the pair indices
+        TEI = ao2mo.incore.general (TEI, [xtd2new,]*4, compact=True)
+        if verbose: print ("Impurity ERIs updated from {} to {} orbitals with {} new directions in {:.2f} seconds".format (nold, nnew, nq,
+            time.time () - t0))
+        return ao2mo.restore (8, TEI, nnew)
+
+    def update_dmet_cderi (self, CDERI_old, aux2c_old, loc2old, loc2new, max_frac=0.25, verbose=False):
+        ''' Compressed impurity CDERI in the basis loc2new, from CDERI_old in the basis loc2old; the counterpart of update_dmet_tei.
+            If loc2new lies within the span of loc2old, this is just a transformation of CDERI_old. Otherwise, only the (P|pQ)
+            integrals for the new directions Q come from with_df, and the old ones are put back into with_df's auxiliary basis
+            with aux2c_old (from dmet_cderi with return_aux) before everything is compressed again. Returns (CDERI, aux2c),
+            or None if a rebuild with dmet_cderi is needed (new directions but no aux2c_old, or more than max_frac of them). '''
+        t0 = time.time ()
+        loc2q, xtd2new = _split_basis_change (loc2old, loc2new)
+        nold, nq, nnew = loc2old.shape[1], loc2q.shape[1], loc2new.shape[1]
+        if nq > 0 and (aux2c_old is None or nq > max_frac * nnew): return None
+        if nq == 0:
+            CDERI = lib.unpack_tril (CDERI_old)
+            CDERI = np.matmul (xtd2new.conjugate ().T, np.matmul (CDERI, xtd2new))
+            CDERI = np.ascontiguousarray (lib.pack_tril (CDERI))
+            aux2c = aux2c_old
+        else:
+            nxtd = nold + nq
+            loc2xtd = np.append (loc2old, loc2q, axis=1)
+            pxQ = self.general_cderi (loc2xtd, loc2q)
+            CDERI = np.empty ((pxQ.shape[0], nxtd, nxtd), dtype=pxQ.dtype)
+            CDERI[:,:nold,:nold] = lib.unpack_tril (np.dot (aux2c_old, CDERI_old))
+            CDERI[:,:,nold:] = pxQ
+            CDERI[:,nold:,:nold] = pxQ[:,:nold,:].transpose (0,2,1)
+            CDERI = np.matmul (xtd2new.conjugate ().T, np.matmul (CDERI, xtd2new))
+            CDERI, aux2c = self._compress_cderi (lib.pack_tril (CDERI))
+        if verbose: print ("Impurity CDERI updated from {} to {} orbitals with {} new directions in {:.2f} seconds".format (nold, nnew, nq,
+            time.time () - t0))
+        return CDERI, aux2c
 
     def dmet_tei (self, loc2dmet, numAct=None, symmetry=1):
+        ''' symmetry=8 (the canonical packed format of the impurity Hamiltonian) is taken straight from the lower triangle of
+            the compact transformed integrals, without the intermediate full-size symmetrization '''
 
         numAct = loc2dmet.shape[1] if numAct==None else numAct
         loc2imp = loc2dmet[:,:numAct]
-        TEI = symmetrize_tensor (self.general_tei ([loc2imp for i in range(4)], compact=True))
+        TEI = self.general_tei ([loc2imp for i in range(4)], compact=True)
+        if symmetry != 8: TEI = symmetrize_tensor (TEI)
         return ao2mo.restore (symmetry, TEI, numAct)
 
-    def dmet_const (self, loc2dmet, norbs_imp, oneRDMfroz_loc, oneSDMfroz_loc):
+    def dmet_const (self, loc2dmet, norbs_imp, oneRDMfroz_loc, oneSDMfroz_loc, JKloc=None, Kloc=None):
         norbs_core = self.norbs_tot - norbs_imp
         if norbs_core == 0:
             return 0.0
         loc2core = loc2dmet[:,norbs_imp:]
         GAMMA = represent_operator_in_basis (oneRDMfroz_loc, loc2core)
         OEI  = self.dmet_oei (loc2core, norbs_core)
-        OEI += self.dmet_fock (loc2core, norbs_core, oneRDMfroz_loc)
+        OEI += self.dmet_fock (loc2core, norbs_core, oneRDMfroz_loc, JKloc=JKloc)
         CONST  = (GAMMA * OEI).sum () / 2
         M = represent_operator_in_basis (oneSDMfroz_loc, loc2core)
-        K = self.dmet_k (loc2core, norbs_core, oneSDMfroz_loc) 
+        K = self.dmet_k (loc2core, norbs_core, oneSDMfroz_loc, Kloc=Kloc)
         CONST -= (M * K).sum () / 4
         return CONST
 
@@ -516,6 +965,8 @@ class localintegrals:
         elif self._eri is not None:
             a2b_list = [self._eri.loc2eri_bas (l2b) for l2b in loc2bas_list]
             TEI = ao2mo.incore.general(self._eri, a2b_list, compact=compact)
+        elif self._eri_outcore is not None:
+            TEI = self._general_tei_outcore (loc2bas_list, compact=compact)
         else:
             a2b_list = [np.dot (self.ao2loc, l2b) for l2b in loc2bas_list]
             TEI  = ao2mo.outcore.general_iofree(self.mol, a2b_list, compact=compact)
@@ -524,6 +975,28 @@ class localintegrals:
 
         return TEI
 
+    def general_cderi (self, loc2bra, loc2ket):
+        ''' Three-center integrals (P|ij) with i in loc2bra and j in loc2ket, as an array of shape (naux, nbra, nket). Uses the cached
+            localized-basis cderi if it exists, and otherwise transforms with_df's blocks one at a time. '''
+        assert (self.with_df is not None), "density fitting required"
+        nbra, nket = loc2bra.shape[1], loc2ket.shape[1]
+        naux = self.with_df.get_naoaux ()
+        cderi = np.empty ((naux, nbra, nket), dtype=loc2bra.dtype)
+        if self._cderi_loc is not None:
+            blksize = max (1, min (naux, int ((self.max_memory - current_memory ()[0]) * 0.3e6 / 8 / (self.norbs_tot * (self.norbs_tot + nket)))))
+            for p0 in range (0, naux, blksize):
+                p1 = min (naux, p0 + blksize)
+                cderi[p0:p1] = np.matmul (loc2bra.conjugate ().T, np.matmul (lib.unpack_tril (self._cderi_loc[p0:p1]), loc2ket))
+            return cderi
+        ao2bra, ao2ket = self.with_df.loc2eri_bas (loc2bra), self.with_df.loc2eri_bas (loc2ket)
+        ijmosym, mij_pair, moij, ijslice = ao2mo.incore._conc_mos (ao2bra, ao2ket, compact=False)
+        b0 = 0
+        for eri1 in self.with_df.loop ():
+            b1 = b0 + eri1.shape[0]
+            cderi[b0:b1] = ao2mo._ao2mo.nr_e2 (eri1, moij, ijslice, aosym='s2', mosym=ijmosym).reshape (b1-b0, nbra, nket)
+            b0 = b1
+        return cderi
+
     def compare_basis_to_loc (self, loc2bas, frags, nlead=3, quiet=True):
         nfrags = len (frags)
         norbs_tot, norbs_bas = loc2bas.shape
@@ -645,3 +1118,55 @@ class localintegrals:
         return loc2no, ene_no, occ_no
         
 
+# Attributes of localintegrals that publish_shared doesn't write out as they are; attach_shared rebuilds them
+_SHARED_REBUILT_KEYS = ('mol', 'get_jk_ao', 'get_veff_ao', 'get_k_ao', 'fullovlpao', 'with_df', '_eri', '_eri_outcore',
+    '_eri_outcore_file', 'wm_mf_ctx', 'output_writer')
+
+def attach_shared (dirname):
+    ''' Rebuild a localintegrals object from the directory written by localintegrals.publish_shared, without copying
+        any of its arrays: they are memory-mapped read-only. Meant to be called in worker processes. '''
+    with open (os.path.join (dirname, 'header.pkl'), 'rb') as f:
+        header = pickle.load (f)
+    ints = localintegrals.__new__ (localintegrals)
+    for key in header['arrays']:
+        setattr (ints, key, np.load (os.path.join (dirname, key + '.npy'), mmap_mode='r'))
+    special = ('mol', 'arrays', 'eri_ao_basis', 'eri_outcore_file', 'df_cderi', 'df_auxbasis')
+    for key, val in header.items ():
+        if key not in special: setattr (ints, key, val)
+    ints.mol = gto.mole.loads (header['mol'])
+    # Same as the parent's scf object as far as get_jk, get_veff, get_k and get_ovlp are concerned
+    if header['mf_xc'] is None:
+        mf = scf.RHF (ints.mol)
+    else:
+        from pyscf import dft
+        mf = dft.RKS (ints.mol)
+        mf.xc = header['mf_xc']
+    mf.max_memory = ints.max_memory
+    ints.with_df = None
+    if header['df_cderi'] is not None:
+        mf = mf.density_fit (auxbasis=header['df_auxbasis'])
+        cderi = header['df_cderi']
+        mf.with_df._cderi = np.load (cderi, mmap_mode='r') if cderi.endswith ('.npy') else cderi
+        ints.with_df = ints._tag_eri_bases (mf.with_df, ao_basis=True)
+    ints.get_jk_ao   = partial (mf.get_jk, ints.mol)
+    ints.get_veff_ao = partial (mf.get_veff, ints.mol)
+    ints.get_k_ao    = partial (mf.get_k, ints.mol)
+    ints.fullovlpao  = mf.get_ovlp
+    if getattr (ints, '_eri', None) is not None:
+        ints._eri = ints._tag_eri_bases (ints._eri, ao_basis=header['eri_ao_basis'])
+        if header['eri_ao_basis']: mf._eri = ints._eri
+    else:
+        ints._eri = None
+    ints._eri_outcore = None
+    if header['eri_outcore_file'] is not None:
+        # Owned by the parent; not removed by this object
+        ints._eri_outcore_file = header['eri_outcore_file']
+        ints._eri_outcore = np.load (ints._eri_outcore_file, mmap_mode='r')
+    ints.wm_mf_ctx = wm_rhf.impurity_mf_context ()
+    ints.output_writer = async_writer (enabled=False)
+    return ints
+
+def release_shared (dirname):
+    ''' Remove a directory written by localintegrals.publish_shared '''
+    shutil.rmtree (dirname, ignore_errors=True)
+
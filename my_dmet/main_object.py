@@ -22,12 +22,13 @@
     51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 '''
 
-from mrh.my_dmet import localintegrals, qcdmethelper
+from mrh.my_dmet import localintegrals, qcdmethelper, chkfile
 import numpy as np
 from scipy import optimize, linalg
+from scipy.sparse.linalg import LinearOperator, eigsh
 import time, ctypes
 #import tracemalloc
-from pyscf import scf, mcscf
+from pyscf import scf, mcscf, lib
 from pyscf.lo import orth, nao
 from pyscf.gto import mole, same_mol
 from pyscf.tools import molden
@@ -35,14 +36,15 @@ from pyscf.symm.addons import symmetrize_space
 from pyscf.scf.addons import project_mo_nr2nr, project_dm_nr2nr
 from mrh.util import params
 from mrh.util.io import prettyprint_ndarray as prettyprint
+from mrh.util.io import async_writer
 from mrh.util.la import matrix_eigen_control_options, matrix_svd_control_options
 from mrh.util.basis import represent_operator_in_basis, orthonormalize_a_basis, get_complementary_states, project_operator_into_subspace
 from mrh.util.basis import is_matrix_eye, measure_basis_olap, is_basis_orthonormal_and_complete, is_basis_orthonormal, get_overlapping_states
 from mrh.util.basis import is_matrix_zero, is_subspace_block_adapted, symmetrize_basis, are_bases_orthogonal, measure_subspace_blockbreaking
 from mrh.util.basis import assign_blocks, align_states, measure_subspace_blockbreaking
-from mrh.util.rdm import get_2RDM_from_2CDM, get_2CDM_from_2RDM
+from mrh.util.rdm import get_2RDM_from_2CDM, get_2CDM_from_2RDM, twoCDM_store
 from mrh.my_dmet.debug import debug_ofc_oneRDM, debug_Etot, examine_ifrag_olap, examine_wmcs
-from functools import reduce
+from functools import reduce, partial
 from itertools import combinations, product
 
 class dmet:
@@ -52,7 +54,10 @@ class dmet:
                     minFunc='FOCK_INIT', print_u=True,
                     print_rdm=True, debug_energy=False, debug_reloc=False,
                     nelec_int_thresh=1e-6, chempot_init=0.0, num_mf_stab_checks=0,
-                    corrpot_maxiter=50, orb_maxiter=50, chempot_tol=1e-6, corrpot_mf_moldens=0 ):
+                    corrpot_maxiter=50, orb_maxiter=50, chempot_tol=1e-6, corrpot_mf_moldens=0, equivalent_fragments=None,
+                    orb_diis=False, orb_diis_space=6, orb_diis_start=2, orb_diis_reset=10.0,
+                    imp_tol_schedule=False, imp_tol_max=1e-5, imp_tol_min=1e-9, imp_tol_factor=1e-2, resume_fragments=False,
+                    async_output=False ):
 
 
         if isTranslationInvariant:
@@ -60,7 +65,7 @@ class dmet:
             assert( theInts.TI_OK == True )
             assert( len (fragments) == 1 )
         
-        assert (( SCmethod == 'LSTSQ' ) or ( SCmethod == 'BFGS' ) or ( SCmethod == 'NONE' ))
+        assert (( SCmethod == 'LSTSQ' ) or ( SCmethod == 'BFGS' ) or ( SCmethod == 'NEWTON' ) or ( SCmethod == 'NONE' ))
 
         #tracemalloc.start (10)
 
@@ -90,6 +95,18 @@ class dmet:
         self.num_mf_stab_checks       = num_mf_stab_checks
         self.corrpot_maxiter          = corrpot_maxiter
         self.orb_maxiter              = orb_maxiter
+        self.orb_conv_tol             = 1e-5
+        self.do_orb_diis              = orb_diis and doLASSCF
+        self.orb_diis_space           = orb_diis_space
+        self.orb_diis_start           = orb_diis_start
+        self.orb_diis_reset           = orb_diis_reset
+        self.imp_tol_schedule         = imp_tol_schedule
+        self.imp_tol_max              = imp_tol_max
+        self.imp_tol_min              = imp_tol_min
+        self.imp_tol_factor           = imp_tol_factor
+        self.resume_fragments         = resume_fragments
+        self.output_writer            = async_writer (enabled=async_output)
+        self.ints.output_writer       = self.output_writer
         self.chempot_tol              = chempot_tol
         self.corrpot_mf_moldens       = corrpot_mf_moldens
         self.corrpot_mf_molden_cnt    = 0
@@ -100,6 +117,7 @@ class dmet:
             frag.debug_energy             = debug_energy
             frag.num_mf_stab_checks       = num_mf_stab_checks
             frag.filehead                 = self.calcname + '_'
+            frag.output_writer            = self.output_writer
             frag.groupname                = self.ints.symmetry
             frag.loc2symm                 = self.ints.loc2symm
             frag.ir_names                 = self.ints.ir_names
@@ -133,7 +151,19 @@ class dmet:
         self.relaxation = 0.0
         self.energy     = 0.0
         self.spin       = 0.0
+        self.niter_corrpot = 0
+        self.niter_orbs    = 0
+        self.reset_timings ()
+        self.reset_orb_diis ()
+        self.reset_imp_tol ()
         self.helper     = qcdmethelper.qcdmethelper( self.ints, self.makelist_H1(), self.altcostfunc, self.minFunc )
+
+        # Fragments equivalent by symmetry: either 'auto' or a list of (representative, copy, orbital mapping)
+        if equivalent_fragments == 'auto':
+            self.detect_equivalent_fragments ()
+        elif equivalent_fragments is not None:
+            for rep, copy, loc_map in equivalent_fragments:
+                self.set_equivalent_fragments (rep, copy, loc_map)
         
         np.set_printoptions(precision=3, linewidth=160)
         #objinit = tracemalloc.take_snapshot ()
@@ -191,6 +221,133 @@ class dmet:
     def norbs_wmc (self):
         return self.norbs_tot - self.norbs_wma
 
+    def reset_timings( self ):
+        ''' Wall-time accumulators (seconds) for the phases of doselfconsistent, and the numbers of impurity solves and of
+            impurity solutions resumed from storage instead '''
+        self.timings = {'schmidt': 0.0, 'impham': 0.0, 'solve': 0.0, 'corrpot': 0.0, 'wm_core_scf': 0.0}
+        self.nsolves = 0
+        self.nresumed = 0
+
+    def reset_imp_tol( self ):
+        ''' Start the impurity-solver tolerance schedule: loose (imp_tol_max) if imp_tol_schedule, otherwise solver defaults '''
+        self.imp_tol = self.imp_tol_max if self.imp_tol_schedule else None
+        self.imp_tol_used = None
+        self.apply_imp_tol ()
+
+    def apply_imp_tol( self ):
+        ''' Hand the current tolerance to the fragments. Called at the top of every iteration of the loop that the schedule follows,
+            so that imp_tol_used is always the tolerance of the most recent impurity solves. '''
+        tol = None if (self.imp_tol is None or self.imp_tol <= self.imp_tol_min) else self.imp_tol
+        for frag in self.fragments: frag.imp_conv_tol = tol
+        self.imp_tol_used = tol
+
+    def update_imp_tol( self, err ):
+        ''' Tighten the impurity-solver tolerance to imp_tol_factor times the outer-loop error measure err. The tolerance is
+            never loosened again, so the solutions become monotonically more accurate. '''
+        if self.imp_tol is None or self.imp_tol <= self.imp_tol_min: return
+        tol = min (self.imp_tol, max (self.imp_tol_min, self.imp_tol_factor * err))
+        if tol < self.imp_tol: print ("Impurity-solver tolerance: {:.1e} -> {:.1e}".format (self.imp_tol, tol))
+        self.imp_tol = tol
+
+    def finalize_imp_tol( self ):
+        ''' Called when an outer loop has converged. If the impurity problems of the iteration that converged were solved with a
+            loose tolerance, switch to the solver defaults and return True, meaning that the loop needs one more iteration for the
+            final answer. (The tolerance update at the end of that iteration may already have reached imp_tol_min, so it is the
+            tolerance actually used, imp_tol_used, that is checked.) '''
+        if self.imp_tol_used is None: return False
+        print ("Outer loop converged with impurity-solver tolerance {:.1e}; one more iteration with default tolerances".format (
+            self.imp_tol_used))
+        self.imp_tol = self.imp_tol_min
+        return True
+
+    def reset_orb_diis( self ):
+        ''' Clear the history of the orbital-iteration DIIS '''
+        self.orb_diis = lib.diis.DIIS () if self.do_orb_diis else None
+        if self.orb_diis is not None: self.orb_diis.space = self.orb_diis_space
+        self.orb_diis_errmin = None
+
+    def get_orb_diis_vector( self ):
+        ''' The active-orbital projectors of all fragments, stacked: a gauge-invariant representation of the active spaces '''
+        return np.stack ([f.loc2amo @ f.loc2amo.conjugate ().T for f in self.fragments], axis=0)
+
+    def orb_diis_extrapolate( self, x_in ):
+        ''' DIIS on the fixed-point map of the LASSCF macro-iteration, x_in -> self.get_orb_diis_vector () (where x_in is the
+            vector at the beginning of the iteration), with the residual as the error vector. The extrapolated projectors are
+            turned back into orthonormal active orbitals, which are rotated as close as possible to the new ones so that the
+            fragments' active-space density matrices carry over. Extrapolation starts once the history holds orb_diis_start
+            vectors. The history is reset if the number of active orbitals changes or if the residual grows by a factor of more
+            than orb_diis_reset over the smallest one in the history. '''
+        x_out = self.get_orb_diis_vector ()
+        if x_out.shape != x_in.shape:
+            print ("Orbital DIIS: active-space dimensions changed; resetting")
+            self.reset_orb_diis ()
+            return
+        xerr = x_out - x_in
+        err = linalg.norm (xerr)
+        if self.orb_diis_errmin is not None and err > self.orb_diis_reset * self.orb_diis_errmin:
+            print ("Orbital DIIS: residual {:.3e} much larger than previous minimum {:.3e}; resetting".format (err, self.orb_diis_errmin))
+            self.reset_orb_diis ()
+        self.orb_diis_errmin = err if self.orb_diis_errmin is None else min (err, self.orb_diis_errmin)
+        x = self.orb_diis.update (x_out, xerr=xerr).reshape (x_out.shape)
+        if self.orb_diis.get_num_vec () < self.orb_diis_start: return
+        loc2amo_x = []
+        for f, P in zip (self.fragments, x):
+            evals, evecs = matrix_eigen_control_options ((P + P.conjugate ().T) / 2, sort_vecs=-1, only_nonzero_vals=False)
+            loc2amo_x.append (evecs[:,:f.norbs_as])
+        loc2wmas = np.concatenate (loc2amo_x, axis=1)
+        if loc2wmas.shape[1] == 0: return
+        # Symmetric orthonormalization keeps each fragment's orbitals as close as possible to the extrapolated ones
+        evals, evecs = matrix_eigen_control_options (loc2wmas.conjugate ().T @ loc2wmas, sort_vecs=-1, only_nonzero_vals=False)
+        if evals[-1] < 1e-8:
+            print ("Orbital DIIS: extrapolated active spaces are linearly dependent; resetting")
+            self.reset_orb_diis ()
+            return
+        loc2wmas = loc2wmas @ (evecs / np.sqrt (evals)[None,:]) @ evecs.conjugate ().T
+        i = 0
+        for f in self.fragments:
+            if f.norbs_as == 0: continue
+            loc2amo = loc2wmas[:,i:i+f.norbs_as]
+            i += f.norbs_as
+            lvecs, svals, rvecs = matrix_svd_control_options (np.dot (loc2amo.conjugate ().T, f.loc2amo), sort_vecs=-1, only_nonzero_vals=False)
+            loc2amo = loc2amo @ lvecs @ rvecs.conjugate ().T
+            # After this (Procrustes) rotation, new active orbital i is the one closest to old active orbital i: the old-new
+            # overlap is symmetric positive definite, and it becomes the identity as the active spaces converge. So the
+            # active-space density matrices are carried over index by index, without the overlap transformation that
+            # expand_active_space applies after larger changes of the active orbitals. They are only the starting point of the next
+            # iteration (the embedding 1RDM in setup_wm_core_scf and the impurity CI guess), and the next impurity solution
+            # replaces them, so the carry-over error only affects how the iteration gets to the fixed point, not where it is:
+            # it vanishes with the DIIS residual. E2_cum, on the other hand, enters the energy directly, so it is zeroed here
+            # and recomputed exactly from the carried-over 2CDM in the new orbitals by setup_wm_core_scf.
+            oneRDM_amo = represent_operator_in_basis (f.oneRDMas_loc, f.loc2amo)
+            oneSDM_amo = represent_operator_in_basis (f.oneSDMas_loc, f.loc2amo)
+            f.loc2amo = loc2amo
+            f.oneRDMas_loc = represent_operator_in_basis (oneRDM_amo, loc2amo.conjugate ().T)
+            f.oneSDMas_loc = represent_operator_in_basis (oneSDM_amo, loc2amo.conjugate ().T)
+            f.E2_cum = 0 # recomputed in setup_wm_core_scf
+        print ("Orbital DIIS: residual {:.3e}; extrapolated from {} previous iterations".format (err, self.orb_diis.get_num_vec ()))
+
+    def print_transform_cache_stats( self, reset=False ):
+        ''' Number of basis-transformation matrix products the fragments reused from their caches (i.e., GEMMs saved) and built '''
+        hits = sum ([frag.transform_cache_stats['hits'] for frag in self.fragments])
+        misses = sum ([frag.transform_cache_stats['misses'] for frag in self.fragments])
+        print ("Fragment transformation-matrix cache: {} products reused, {} built".format (hits, misses))
+        if reset:
+            for frag in self.fragments: frag.reset_transform_cache_stats ()
+
+    def print_timings( self ):
+        print ("Wall time by phase: " + "; ".join (["{} {:.2f} s".format (key, val) for key, val in self.timings.items ()]))
+        print ("{} impurity solves, {} correlation-potential and {} orbital iterations".format (self.nsolves, self.niter_corrpot,
+            self.niter_orbs))
+        if self.resume_fragments: print ("{} impurity solutions resumed from stored fragment states".format (self.nresumed))
+        ncalls = sum ([f.imp_mf_ctx.ncalls for f in self.fragments])
+        nbuild = sum ([f.imp_mf_ctx.nbuild for f in self.fragments])
+        if ncalls: print ("Impurity RHF objects: {} calls, {} builds".format (ncalls, nbuild))
+        self.print_transform_cache_stats ()
+        for f in self.fragments:
+            if f.schmidt_tracker is not None:
+                print ("{} Schmidt decompositions: {} tracked, {} full".format (f.frag_name, f.schmidt_tracker.ntracked,
+                    f.schmidt_tracker.nfallback))
+
     def makelist_H1( self ):
    
         # OK, this is somehow related to the C code that came with this that does rhf response. 
@@ -258,13 +415,43 @@ class dmet:
         H1col   = np.array( H1col,   dtype=ctypes.c_int )
         return ( H1start, H1row, H1col )
         
+    def get_fragment_state_fname (self, ifrag, frag):
+        return '{}.{}.{}.resume.pkl'.format (self.calcname, ifrag, frag.frag_name)
+
+    def save_fragment_state (self, ifrag, frag, chempot_frag):
+        ''' Store frag's impurity solution as soon as it is done, so that a calculation interrupted in the middle of an
+            iteration can pick up where it left off (see resume_fragment) '''
+        if frag.imp_solver_name == 'dummy RHF': return
+        chkfile.save_fragment_state (self.get_fragment_state_fname (ifrag, frag), frag.get_resume_key (chempot_frag),
+            frag.get_solved_state ())
+
+    def resume_fragment (self, ifrag, frag, chempot_frag):
+        ''' Put back frag's stored impurity solution if it is for the same impurity problem as the one just built.
+            Returns True if it did so and the solver can be skipped. '''
+        if frag.imp_solver_name == 'dummy RHF': return False
+        # Differences in the impurity problem below the solver's convergence threshold are below what solving it again would resolve
+        atol = self.imp_tol_min if frag.imp_conv_tol is None else frag.imp_conv_tol
+        state = chkfile.load_fragment_state (self.get_fragment_state_fname (ifrag, frag), frag.get_resume_key (chempot_frag), atol=atol)
+        if state is None: return False
+        frag.set_solved_state (state)
+        self.nresumed += 1
+        return True
+
     def doexact( self, chempot_frag=0.0 ):
         oneRDM_loc = self.helper.construct1RDM_loc( self.doSCF, self.umat ) 
         self.energy = 0.0												
         self.spin = 0.0
 
+        t0 = time.time ()
+        for ifrag, frag in enumerate (self.fragments):
+            if frag.equiv_rep is None:
+                if self.resume_fragments and self.resume_fragment (ifrag, frag, chempot_frag): continue
+                frag.solve_impurity_problem (chempot_frag)
+                self.nsolves += 1
+                if self.resume_fragments: self.save_fragment_state (ifrag, frag, chempot_frag)
+        self.timings['solve'] += time.time () - t0
         for frag in self.fragments:
-            frag.solve_impurity_problem (chempot_frag)
+            if frag.equiv_rep is not None: frag.copy_solution_from (frag.equiv_rep, frag.equiv_map)
             self.energy += frag.E_frag
             self.spin += frag.S2_frag
 
@@ -382,6 +569,18 @@ class dmet:
         assert (idx == len (newumatflat))
         return thegradient
 
+    def costfunction_and_derivative( self, newumatflat ):
+        ''' costfunction and costfunction_derivative together (for optimize.minimize with jac=True). When possible (see
+            qcdmethelper.can_share_eigenpairs), the mean-field Hamiltonian is diagonalized only once for both. '''
+        errors = self.rdm_differences( newumatflat )
+        thegradient = np.zeros([ len( newumatflat ) ])
+        idx = 0
+        for error_derivs in self.rdm_differences_derivative (newumatflat):
+            thegradient[ idx ] = 2 * np.dot( error_derivs, errors )
+            idx += 1
+        assert (idx == len (newumatflat))
+        return linalg.norm( errors )**2, thegradient
+
     def alt_costfunction_derivative( self, newumatflat ):
         
 #        errors = self.rdm_differences_bis( newumatflat )
@@ -417,49 +616,89 @@ class dmet:
         
 #        return gradient
         
-    def verify_gradient( self, umatflat ):
-    
+    def errvec_adjoint( self, errvec ):
+        ''' Adjoint of the map rsp_1RDM -> errvec (see fragment_object.get_rsp_1RDM_adjoint), as one matrix in the local basis '''
+        W = np.zeros( [ self.norbs_tot, self.norbs_tot ] )
+        idx = 0
+        for frag in self.fragments:
+            if self.incl_bath_errvec:
+                size = frag.norbs_imp * frag.norbs_imp
+            else:
+                size = frag.norbs_frag if self.doDET else frag.norbs_frag * frag.norbs_frag
+            W += frag.get_rsp_1RDM_adjoint (self, errvec[idx:idx+size])
+            idx += size
+        assert (idx == len (errvec))
+        return W
+
+    def has_analytic_hessian( self ):
+        return (self.helper.can_share_eigenpairs (self.doSCF, self.loc2fno) and not (self.doDET_NO or self.doLASSCF or self.altcostfunc))
+
+    def costfunction_hessp( self, newumatflat, vecflat ):
+        ''' Analytic product of the Hessian of costfunction with vecflat. With e the error vector, J = de/du and
+            V = sum_t vecflat[t] H1[t], this is 2 J^T J vecflat (from the linear response of the mean-field 1RDM to V) plus
+            2 sum_k e_k (d^2 e_k / du^2) vecflat (from the quadratic response). Each product costs a few Norb^3 operations
+            regardless of the number of correlation-potential terms. '''
+        if not self.has_analytic_hessian ():
+            raise NotImplementedError ("Analytic Hessian of the DMET cost function requires a non-SCF mean field in the whole orbital space")
+        newumatsquare_loc = self.flat2square( newumatflat )
+        eigvals, eigvecs = self.helper.get_oei_eigenpairs (self.ints.loc_rhf_fock () + newumatsquare_loc)
+        errors = self.rdm_differences( newumatflat )
+        V = self.helper.H1_expand (vecflat)
+        rsp_1RDM = self.helper.rhf_linear_response (eigvals, eigvecs, V)
+        Jv = np.concatenate ([frag.get_rsp_1RDM_elements (self, rsp_1RDM) for frag in self.fragments])
+        G  = self.helper.rhf_linear_response (eigvals, eigvecs, self.errvec_adjoint (Jv))
+        G += self.helper.rhf_quadratic_response_adjoint (eigvals, eigvecs, self.errvec_adjoint (errors), V)
+        return 2 * self.helper.H1_contract (G)
+
+    def costfunction_hessian_operator( self, umatflat, stepsize=1e-5 ):
+        ''' The Hessian of costfunction at umatflat as a scipy LinearOperator. Uses costfunction_hessp if possible, and
+            central finite differences of costfunction_derivative along the requested vector otherwise. '''
+        nparams = len (umatflat)
+        if self.has_analytic_hessian ():
+            matvec = lambda x: self.costfunction_hessp (umatflat, np.ravel (x))
+        else:
+            def matvec (x):
+                x = np.ravel (x)
+                gp = self.costfunction_derivative (umatflat + stepsize * x)
+                gm = self.costfunction_derivative (umatflat - stepsize * x)
+                return (gp - gm) / (2 * stepsize)
+        return LinearOperator ((nparams, nparams), matvec=matvec, dtype=np.float64)
+        
+    def verify_gradient( self, umatflat, ndirections=3, stepsize=1e-6 ):
+        ''' Compare the analytic gradient (and Hessian-vector products, if available) to central finite differences along a
+            few random directions, instead of along every correlation-potential parameter '''
         gradient = self.costfunction_derivative( umatflat )
-        cost_reference = self.costfunction( umatflat )
-        gradientbis = np.zeros( [ len( gradient ) ])
-        stepsize = 1e-7
-        for cnt in range( len( gradient ) ):
-            umatbis = np.array( umatflat, copy=True )
-            umatbis[cnt] += stepsize
-            costbis = self.costfunction( umatbis )
-            gradientbis[ cnt ] = ( costbis - cost_reference ) / stepsize
-        print ("   Norm( gradient difference ) =", linalg.norm( gradient - gradientbis ))
+        hessop = self.costfunction_hessian_operator( umatflat ) if self.has_analytic_hessian () else None
+        rng = np.random.default_rng ()
+        for cnt in range( ndirections ):
+            direction = rng.standard_normal (len (umatflat))
+            direction /= linalg.norm (direction)
+            costp = self.costfunction( umatflat + stepsize * direction )
+            costm = self.costfunction( umatflat - stepsize * direction )
+            print ("   Directional derivative: analytic = {}; finite-difference = {}".format (
+                np.dot (gradient, direction), (costp - costm) / (2 * stepsize)))
+            if hessop is not None:
+                gradp = self.costfunction_derivative( umatflat + stepsize * direction )
+                gradm = self.costfunction_derivative( umatflat - stepsize * direction )
+                print ("   Norm( Hessian-vector product difference ) =", linalg.norm( hessop.matvec (direction) - (gradp - gradm) / (2 * stepsize) ))
         print ("   Norm( gradient )            =", linalg.norm( gradient ))
         
-    def hessian_eigenvalues( self, umatflat ):
-    
-        stepsize = 1e-7
+    def hessian_eigenvalues( self, umatflat, nroots=4 ):
+        ''' Lowest and highest eigenvalues of the cost-function Hessian by Lanczos iteration on Hessian-vector products '''
         print ('Calculating hessian eigenvalues...')
-        grad_start = time.time ()
-        gradient_reference = self.costfunction_derivative( umatflat )
-        grad_end = time.time ()
-        print ("Gradient-reference calculated in {} seconds".format (grad_end - grad_start))
-        print ("Gradient is an array of length {}".format (gradient_reference.shape))
-        print ("Hessian is a {}-by-{} matrix".format (len (umatflat), len (umatflat)))
+        nparams = len (umatflat)
+        print ("Hessian is a {}-by-{} matrix".format (nparams, nparams))
         hess_start = time.time ()
-        hessian = np.zeros( [ len( umatflat ), len( umatflat ) ] )
-        for cnt in range( len( umatflat ) ):
-            gradient = umatflat.copy()
-            gradient[ cnt ] += stepsize
-            gradient = self.costfunction_derivative( gradient )
-            hessian[ :, cnt ] = ( gradient - gradient_reference ) / stepsize
-        hessian = 0.5 * ( hessian + hessian.T )
-        hess_end = time.time ()
-        print ("Hessian evaluated in {} seconds".format (hess_end - hess_start))
-        diag_start = time.time ()
-        eigvals, eigvecs = linalg.eigh( hessian )
-        diag_end = time.time ()
-        idx = eigvals.argsort()
-        eigvals = eigvals[ idx ]
-        eigvecs = eigvecs[ :, idx ]
+        hessop = self.costfunction_hessian_operator( umatflat )
+        if 2 * nroots >= nparams:
+            eigvals = linalg.eigvalsh (hessop.matmat (np.eye (nparams)))
+        else:
+            eigvals_lo = eigsh (hessop, k=nroots, which='SA', return_eigenvectors=False)
+            eigvals_hi = eigsh (hessop, k=nroots, which='LA', return_eigenvectors=False)
+            eigvals = np.sort (np.append (eigvals_lo, eigvals_hi))
+        print ("Hessian eigenvalues found in {} seconds".format (time.time () - hess_start))
         print ("Hessian eigenvalues =", eigvals)
-        #print "Hessian 1st eigenvector =",eigvecs[:,0]
-        #print "Hessian 2nd eigenvector =",eigvecs[:,1]
+        return eigvals
         
     def flat2square( self, umatflat ):
     
@@ -507,17 +746,22 @@ class dmet:
         self.energy = self.ints.e_tot
         self.ints.enforce_symmetry = self.enforce_symmetry
         iteration = 0
+        self.niter_corrpot = self.niter_orbs = 0
+        self.reset_timings ()
+        self.reset_imp_tol ()
         u_diff = 1.0
         convergence_threshold = 1e-6
         self.check_fragment_symmetry_breaking (verbose=False, do_break=True)
         rdm = np.zeros ((self.norbs_tot, self.norbs_tot))
         print ("RHF energy =", self.ints.fullEhf)
 
-        while (u_diff > convergence_threshold):
+        while (u_diff > convergence_threshold or (not self.doLASSCF and self.finalize_imp_tol ())):
+            if not self.doLASSCF: self.apply_imp_tol ()
             u_diff, rdm = self.doselfconsistent_corrpot (rdm, [('corrpot', iteration)])
             iteration += 1 
             if iteration > self.corrpot_maxiter:
                 raise RuntimeError ('Maximum correlation-potential cycles!')
+            if not self.doLASSCF: self.update_imp_tol (u_diff)
 
         if self.do1EMB:
             assert( len (self.fragments) == 1 )		
@@ -540,24 +784,33 @@ class dmet:
         ao2no, no_ene, no_occ = self.get_las_nos (aobasis=True, oneRDM_loc=rdm, jmol_shift=True, try_symmetrize=True)
         print ("Whole-molecule natural orbital occupancies:\n{}".format (no_occ))
         print ("Writing trial wave function natural orbital molden")
-        molden.from_mo (self.ints.mol, self.calcname + '_natorb.molden', ao2no, occ=no_occ, ene=no_ene)
+        fname = self.calcname + '_natorb.molden'
+        self.output_writer.submit (fname, molden.from_mo, self.ints.mol, fname, ao2no, occ=no_occ, ene=no_ene)
+        self.output_writer.flush ()
+        self.output_writer.report ()
+        self.print_timings ()
         
         return self.energy
 
     def doselfconsistent_corrpot (self, rdm_old, iters):
         umat_old = np.array(self.umat, copy=True)
+        self.niter_corrpot += 1
         
         # Find the chemical potential for the correlated impurity problem
         myiter = iters[-1][-1]
         nextiter = 0
         orb_diff = 1.0
-        convergence_threshold = 1e-5
-        while (np.any (np.asarray (orb_diff) > convergence_threshold)):
+        convergence_threshold = self.orb_conv_tol
+        self.reset_orb_diis ()
+        # In LASSCF, the impurity-solver tolerance follows the orbital loop; in DMET, the correlation-potential loop
+        while (np.any (np.asarray (orb_diff) > convergence_threshold) or (self.doLASSCF and self.finalize_imp_tol ())):
             lower_iters = iters + [('orbs', nextiter)]
+            if self.doLASSCF: self.apply_imp_tol ()
             orb_diff = self.doselfconsistent_orbs (lower_iters)
             nextiter += 1
             if nextiter > self.orb_maxiter:
                 raise RuntimeError ('Maximum active-orbital rotation cycles!')
+            if self.doLASSCF: self.update_imp_tol (np.amax (orb_diff))
         #itersnap = tracemalloc.take_snapshot ()
         #itersnap.dump ('iter{}bgn.snpsht'.format (myiter))
         
@@ -567,6 +820,7 @@ class dmet:
         #    self.hessian_eigenvalues( self.square2flat( self.umat ) )
         
         # Solve for the u-matrix
+        t0 = time.time ()
         if ( self.altcostfunc and self.SCmethod == 'BFGS' ):
             result = optimize.minimize( self.alt_costfunction, self.square2flat( self.umat ), jac=self.alt_costfunction_derivative, options={'disp': False} )
             self.umat = self.flat2square( result.x )
@@ -576,9 +830,21 @@ class dmet:
         elif ( self.SCmethod == 'BFGS' ):
             print ("Doing BFGS for chemical potential.....")
             bfgs_start = time.time ()
-            result = optimize.minimize( self.costfunction, self.square2flat( self.umat ), jac=self.costfunction_derivative, options={'disp': True} )
+            result = optimize.minimize( self.costfunction_and_derivative, self.square2flat( self.umat ), jac=True, options={'disp': True} )
+            print ("   Mean-field diagonalizations: {} ({} shared)".format (self.helper.eig_cache_miss, self.helper.eig_cache_hits))
             self.umat = self.flat2square( result.x )
             print ("BFGS done after {} seconds".format (time.time () - bfgs_start))
+        elif ( self.SCmethod == 'NEWTON' ):
+            print ("Doing trust-region Newton-Krylov for correlation potential.....")
+            newton_start = time.time ()
+            hessp = self.costfunction_hessp if self.has_analytic_hessian () else (lambda x, p: self.costfunction_hessian_operator (x).matvec (p))
+            result = optimize.minimize( self.costfunction_and_derivative, self.square2flat( self.umat ), jac=True, hessp=hessp,
+                method='trust-krylov', options={'disp': True} )
+            print ("   Mean-field diagonalizations: {} ({} shared)".format (self.helper.eig_cache_miss, self.helper.eig_cache_hits))
+            self.umat = self.flat2square( result.x )
+            print ("Newton-Krylov done after {} seconds".format (time.time () - newton_start))
+        self.umat = self.symmetrize_umat (self.umat)
+        self.timings['corrpot'] += time.time () - t0
         if self.do1EMB:
             # You NEED the diagonal component if the molecule isn't tiled out with fragments!
             # But otherwise, it's a redundant chemical potential term
@@ -591,7 +857,7 @@ class dmet:
         # Possibly print the u-matrix / 1-RDM
         if self.print_u:
             self.print_umat()
-            np.save ('umat.npy', self.umat)
+            self.output_writer.submit ('umat.npy', np.save, 'umat.npy', self.umat)
         if self.print_rdm:
             self.print_1rdm()
         if self.corrpot_mf_molden_cnt < self.corrpot_mf_moldens:
@@ -599,7 +865,7 @@ class dmet:
             oneRDM_loc = self.helper.construct1RDM_loc( self.doSCF, self.umat )
             mf_occ, loc2mf = matrix_eigen_control_options (oneRDM_loc, sort_vecs=-1)
             mf_coeff = np.dot (self.ints.ao2loc, loc2mf)
-            molden.from_mo (self.ints.mol, fname, mf_coeff, occ=mf_occ)
+            self.output_writer.submit (fname, molden.from_mo, self.ints.mol, fname, mf_coeff, occ=mf_occ)
             self.corrpot_mf_molden_cnt += 1
         
         # Get the error measure
@@ -618,13 +884,15 @@ class dmet:
         #itersnap = tracemalloc.take_snapshot ()
         #itersnap.dump ('iter{}end.snpsht'.format (myiter))
 
-        if not self.doLASSCF: self.save_checkpoint (self.calcname + '.chk.npy')
+        if not self.doLASSCF: self.save_checkpoint (self.calcname + '.chk.h5')
 
         return u_diff, rdm_new
 
     def doselfconsistent_orbs (self, iters):
+        self.niter_orbs += 1
 
         loc2wmas_old = np.concatenate ([frag.loc2amo for frag in self.fragments], axis=1)
+        if self.orb_diis is not None: orb_diis_x = self.get_orb_diis_vector ()
         '''
         if self.doLASSCF and self.ints.symmetry and not is_subspace_block_adapted (loc2wmas_old, self.ints.loc2symm):
             print ("Active orbitals break symmetry :(")
@@ -638,8 +906,10 @@ class dmet:
 
         if self.doLASSCF:
             print ("Entering setup_wm_core_scf")
+            t0 = time.time ()
             self.ints.setup_wm_core_scf (self.fragments, self.calcname)
-            self.save_checkpoint (self.calcname + '.chk.npy')
+            self.timings['wm_core_scf'] += time.time () - t0
+            self.save_checkpoint (self.calcname + '.chk.h5')
 
         oneRDM_loc = self.helper.construct1RDM_loc( self.doSCF, self.umat )
         if self.doLASSCF:
@@ -652,15 +922,33 @@ class dmet:
         old_energy = self.energy
         self.energy = 0.0
         self.spin = 0.0
+        frags_todo = []
         for frag in self.fragments:
+            if frag.equiv_rep is not None:
+                print ("Skipping Schmidt decomposition for {}, which is equivalent to {}".format (frag.frag_name, frag.equiv_rep.frag_name))
+                continue
             print ("Entering Schmidt decomposition for {}".format (frag.frag_name))
             t0 = time.time ()
             frag.do_Schmidt (oneRDM_loc, self.fragments, loc2wmcs_old, self.doLASSCF)
             t1 = time.time ()
+            print ("Schmidt decomposition: {} seconds".format (t1-t0))
+            self.timings['schmidt'] += t1-t0
+            frags_todo.append (frag)
+        # The core J and K matrices of all the impurities come from one pass over the integrals
+        t0 = time.time ()
+        core_jk = [None for frag in frags_todo]
+        frags_jk = [frag for frag in frags_todo if frag.imp_solver_name != "dummy RHF"]
+        if len (frags_jk) > 1 and hasattr (self.ints, 'loc_rhf_jk_k_batch'):
+            JKcore, Kcore = self.ints.loc_rhf_jk_k_batch ([frag.oneRDMfroz_loc for frag in frags_jk],
+                [frag.oneSDMfroz_loc for frag in frags_jk])
+            core_jk = [(JKcore[frags_jk.index (frag)], Kcore[frags_jk.index (frag)]) if frag in frags_jk else None for frag in frags_todo]
+            print ("Batched core JK build for {} impurities: {} seconds".format (len (frags_jk), time.time () - t0))
+        for frag, jk in zip (frags_todo, core_jk):
             print ("Entering impurity Hamiltonian construction for {}".format (frag.frag_name))
-            frag.construct_impurity_hamiltonian ()
-            t2 = time.time ()
-            print ("Schmidt decomposition: {} seconds; impurity Hamiltonian construction: {} seconds".format (t1-t0, t2-t1))
+            t1 = time.time ()
+            frag.construct_impurity_hamiltonian (core_jk=jk)
+            print ("Impurity Hamiltonian construction: {} seconds".format (time.time () - t1))
+        self.timings['impham'] += time.time () - t0
         if self.examine_ifrag_olap:
             examine_ifrag_olap (self)
         if self.examine_wmcs:
@@ -713,6 +1001,10 @@ class dmet:
             orb_diff = oneRDM_diff = 0
             
 
+        # Extrapolate the active orbitals for the next iteration, unless this was the last one
+        if self.orb_diis is not None and np.any (np.asarray ([orb_diff, oneRDM_diff, Eimp_stdev, abs (Eiter)]) > self.orb_conv_tol):
+            self.orb_diis_extrapolate (orb_diis_x)
+
         return orb_diff, oneRDM_diff, Eimp_stdev, abs (Eiter)
         
     def print_umat( self ):
@@ -752,12 +1044,11 @@ class dmet:
         
     def dump_bath_orbs( self, filename, frag_idx=0 ):
         
-        from mrh.my_dmet import qcdmet_paths
-        from pyscf import tools
-        from pyscf.tools import molden
-        with open( filename, 'w' ) as thefile:
-            molden.header( self.ints.mol, thefile )
-            molden.orbital_coeff( self.ints.mol, thefile, np.dot( self.ints.ao2loc, self.fragment[frag_idx].loc2imp ) )
+        def write_bath_molden( fname, ao2imp ):
+            with open( fname, 'w' ) as thefile:
+                molden.header( self.ints.mol, thefile )
+                molden.orbital_coeff( self.ints.mol, thefile, ao2imp )
+        self.output_writer.submit( filename, write_bath_molden, filename, np.dot( self.ints.ao2loc, self.fragments[frag_idx].loc2imp ) )
     
     def onedm_solution_rhf(self):
         return self.helper.construct1RDM_loc( self.doSCF, self.umat )
@@ -817,6 +1108,7 @@ class dmet:
 
         for loc2imo, loc2amo, frag in zip (loc2wmcs, loc2wmas, self.fragments):
             frag.set_new_fragment_basis (np.append (loc2imo, loc2amo, axis=1))
+            frag.impham_update_pending = frag.incremental_impham
             if frag.imp_solver_name != 'dummy RHF':
                 assert (is_basis_orthonormal (loc2imo))
                 assert (is_basis_orthonormal (loc2amo))
@@ -1126,31 +1418,33 @@ class dmet:
                 f.oneRDMas_loc = represent_operator_in_basis (dm, f.loc2amo.conjugate ().T)
                 f.ci_as = None
             
-    def save_checkpoint (self, fname):
-        ''' Data array structure: nao_nr, chempot, 1RDM or umat, norbs_amo in frag 1, loc2amo of frag 1, oneRDM_amo of frag 1, twoCDMimp_amo of frag 1, norbs_amo of frag 2, ... '''
+    def save_checkpoint (self, fname, compression=None):
+        ''' Write nao_nr, chempot, 1RDM (LASSCF) or umat (DMET) in the AO basis, and for each fragment norbs_amo, ao2amo, oneRDM_amo,
+            and twoCDMimp_amo.  Files ending in .h5 get one chunked dataset per array (see mrh.my_dmet.chkfile); anything else
+            gets the old flat npy array. '''
         nao = self.ints.mol.nao_nr ()
         if self.doLASSCF:
-            chkdata = self.helper.construct1RDM_loc (self.doSCF, self.umat)
-            chkdata = represent_operator_in_basis (chkdata, self.ints.ao2loc.conjugate ().T).flatten (order='C')
+            mat = self.helper.construct1RDM_loc (self.doSCF, self.umat)
+            mat = represent_operator_in_basis (mat, self.ints.ao2loc.conjugate ().T)
         else:
-            chkdata = represent_operator_in_basis (self.umat, self.ints.ao2loc.conjugate ().T).flatten (order='C')
-        chkdata = np.append (np.asarray ([nao, self.chempot]), chkdata)
-        for f in self.fragments:
-            chkdata = np.append (chkdata, [f.norbs_as])
-            chkdata = np.append (chkdata, np.dot (self.ints.ao2loc, f.loc2amo).flatten (order='C'))
-            chkdata = np.append (chkdata, represent_operator_in_basis (f.oneRDM_loc, f.loc2amo).flatten (order='C'))
-            chkdata = np.append (chkdata, f.twoCDMimp_amo.flatten (order='C'))
-        np.save (fname, chkdata)
+            mat = represent_operator_in_basis (self.umat, self.ints.ao2loc.conjugate ().T)
+        frags = ((f.norbs_as, np.dot (self.ints.ao2loc, f.loc2amo), represent_operator_in_basis (f.oneRDM_loc, f.loc2amo), f.twoCDMimp_amo)
+            for f in self.fragments)
+        # The background writer needs the fragment arrays all at once; otherwise they are streamed into the file one by one
+        if self.output_writer.enabled: frags = list (frags)
+        self.output_writer.submit (fname, chkfile.save_chkfile, fname, nao, self.chempot, mat, frags, compression=compression)
 
     def load_checkpoint (self, fname, prev_mol=None):
         nelec_amo = sum ((f.active_space[0] for f in self.fragments if f.active_space is not None))
         norbs_amo = sum ((f.active_space[1] for f in self.fragments if f.active_space is not None))
         norbs_cmo = (self.ints.mol.nelectron - nelec_amo) // 2
         norbs_omo = norbs_cmo + norbs_amo
-        chkdata = np.load (fname)
-        nao, self.chempot, chkdata = int (round (chkdata[0])), chkdata[1], chkdata[2:] 
+        self.output_writer.flush ()
+        chk = chkfile.chkfile_reader (fname)
+        nao, self.chempot = chk.nao, chk.chempot
         print ("{} atomic orbital basis functions reported in checkpoint file, as opposed to {} in integral object".format (nao, self.ints.mol.nao_nr ()))
         assert (prev_mol is not None or nao == self.ints.mol.nao_nr ())
+        assert (chk.nfrags == len (self.fragments)), "{} fragments in checkpoint file; {} in calculation".format (chk.nfrags, len (self.fragments))
         locSao = np.dot (self.ints.ao_ovlp, self.ints.ao2loc).conjugate ().T
         if prev_mol:
             oldSnew = mole.intor_cross('int1e_ovlp', prev_mol, self.ints.mol)
@@ -1163,8 +1457,7 @@ class dmet:
             aoSloc = np.dot (self.ints.ao_ovlp, self.ints.ao2loc)
             locSao = aoSloc.conjugate ().T
 
-        mat, chkdata = chkdata[:nao**2].reshape (nao, nao, order='C'), chkdata[nao**2:]
-        mat = represent_operator_in_basis (mat, aoSloc)
+        mat = represent_operator_in_basis (chk.mat, aoSloc)
         if self.doLASSCF:
             self.ints.oneRDM_loc = mat.copy ()
             if prev_mol and not same_mol (prev_mol, self.ints.mol, cmp_basis = False):
@@ -1173,38 +1466,45 @@ class dmet:
         else:
             self.umat = mat.copy ()
 
-        for f in self.fragments:
+        for ifrag, f in enumerate (self.fragments):
             if self.doLASSCF: f.oneRDM_loc = self.ints.oneRDM_loc
-            namo, chkdata = int (round (chkdata[0])), chkdata[1:]
+            namo = chk.norbs_amo[ifrag]
             print ("{} active orbitals reported in checkpoint file for fragment {}".format (namo, f.frag_name))
             if namo > 0:
-                f.loc2amo,       chkdata = chkdata[:nao*namo].reshape (nao, namo, order='C'), chkdata[nao*namo:]
-                f.oneRDMas_loc,  chkdata = chkdata[:namo**2].reshape (namo, namo, order='C'), chkdata[namo**2:]
-                print ("{} fragment oneRDM_amo (trace = {}):\n{}".format (
-                    f.frag_name, np.trace (f.oneRDMas_loc), prettyprint (f.oneRDMas_loc, fmt='{:6.3f}')))
-                f.twoCDMimp_amo, chkdata = chkdata[:namo**4].reshape (namo, namo, namo, namo, order='C'), chkdata[namo**4:]
-                if prev_mol and same_mol (prev_mol, self.ints.mol, cmp_basis=False): f.loc2amo = project_mo_nr2nr (prev_mol, f.loc2amo, self.ints.mol)
-                f.loc2amo = np.dot (locSao, f.loc2amo)
-                # Normalize
-                amo_norm = (f.loc2amo * f.loc2amo).sum (0)
-                f.loc2amo /= np.sqrt (amo_norm)[None,:]
-                # orthogonalize and natorbify
-                ovlp = np.dot (f.loc2amo.conjugate ().T, f.loc2amo)
-                print ("{} fragment amo overlap matrix (trace = {}):\n{}".format (
-                    f.frag_name, np.trace (ovlp), prettyprint (ovlp, fmt='{:6.3f}')))
-                no_occ, no_evecs = matrix_eigen_control_options (f.oneRDMas_loc, b_matrix=ovlp, sort_vecs=-1)
-                f.loc2amo = f.loc2amo @ no_evecs
-                f.oneRDMas_loc = (no_occ[None,:] * f.loc2amo) @ f.loc2amo.conjugate ().T
-                f.twoCDMimp_amo = represent_operator_in_basis (f.twoCDMimp_amo, no_evecs)
-                print ("{} fragment oneRDM_amo (trace = {}):\n{}".format (
-                    f.frag_name, np.trace (f.oneRDMas_loc), prettyprint (represent_operator_in_basis (f.oneRDMas_loc, f.loc2amo), fmt='{:6.3f}')))
-               
-                if np.amax (np.abs (f.twoCDMimp_amo)) > 1e-10:
-                    tei = self.ints.dmet_tei (f.loc2amo)
-                    f.E2_cum = np.tensordot (tei, f.twoCDMimp_amo, axes=4) / 2
-        assert (chkdata.shape == tuple((0,))), chkdata.shape               
+                namo, loc2amo, oneRDM_amo, twoCDM_amo = chk.load_fragment (ifrag)
+                if prev_mol and same_mol (prev_mol, self.ints.mol, cmp_basis=False): loc2amo = project_mo_nr2nr (prev_mol, loc2amo, self.ints.mol)
+                self.set_frag_amo_guess (f, np.dot (locSao, loc2amo), oneRDM_amo, twoCDM_amo)
 
         if self.doLASSCF: self.ints.setup_wm_core_scf (self.fragments, self.calcname)
+
+    def set_frag_amo_guess (self, f, loc2amo, oneRDM_amo, twoCDM_amo, ci=None, loc2ci=None):
+        ''' Install active orbitals (loc basis, not necessarily orthonormal, e.g., projected from another geometry) and the
+            corresponding active-space density matrices as the guess of fragment f. If ci is given, it is kept as the CI guess
+            in the symmetrically-orthonormalized version of loc2ci (default: loc2amo). '''
+        print ("{} fragment oneRDM_amo (trace = {}):\n{}".format (
+            f.frag_name, np.trace (oneRDM_amo), prettyprint (oneRDM_amo, fmt='{:6.3f}')))
+        # Normalize
+        amo_norm = (loc2amo * loc2amo).sum (0)
+        loc2amo = loc2amo / np.sqrt (amo_norm)[None,:]
+        # orthogonalize and natorbify
+        ovlp = np.dot (loc2amo.conjugate ().T, loc2amo)
+        print ("{} fragment amo overlap matrix (trace = {}):\n{}".format (
+            f.frag_name, np.trace (ovlp), prettyprint (ovlp, fmt='{:6.3f}')))
+        if ci is not None:
+            if loc2ci is None: loc2ci = loc2amo
+            ovlp_ci = np.dot (loc2ci.conjugate ().T, loc2ci)
+            evals, evecs = matrix_eigen_control_options (ovlp_ci, sort_vecs=-1, only_nonzero_vals=False)
+            f.ci_as = ci
+            f.ci_as_orb = loc2ci @ (evecs / np.sqrt (evals)[None,:]) @ evecs.conjugate ().T
+        no_occ, no_evecs = matrix_eigen_control_options (oneRDM_amo, b_matrix=ovlp, sort_vecs=-1)
+        f.loc2amo = loc2amo @ no_evecs
+        f.oneRDMas_loc = (no_occ[None,:] * f.loc2amo) @ f.loc2amo.conjugate ().T
+        f.twoCDMimp_amo = represent_operator_in_basis (twoCDM_amo, no_evecs)
+        print ("{} fragment oneRDM_amo (trace = {}):\n{}".format (
+            f.frag_name, np.trace (f.oneRDMas_loc), prettyprint (represent_operator_in_basis (f.oneRDMas_loc, f.loc2amo), fmt='{:6.3f}')))
+       
+        if np.amax (np.abs (f.twoCDMimp_amo)) > 1e-10:
+            f.E2_cum = twoCDM_store ([f.loc2amo], [f.twoCDMimp_amo]).contract_eri (partial (self.ints.dmet_tei, symmetry=8)) / 2
         
     def expand_active_space (self, callables):
         ''' Add occupied or vitual orbitals from the whole molecule to one or several fragments' active spaces using functions in list "callables"
@@ -1226,6 +1526,7 @@ class dmet:
             old2new_amo = np.dot (old2new_amo, frag.loc2amo)
             frag.oneRDMas_loc = project_operator_into_subspace (self.ints.oneRDM_loc, frag.loc2amo) 
             frag.twoCDMimp_amo = represent_operator_in_basis (frag.twoCDMimp_amo, old2new_amo) 
+            frag.impham_update_pending = frag.incremental_impham
 
 
     def get_las_nos (self, **kwargs):
@@ -1282,6 +1583,67 @@ class dmet:
                 if f.wfnsym is None: f.wfnsym = self.ints.wfnsym
         return symmetry
 
+    def set_equivalent_fragments (self, rep, copy, loc_map, atol=1e-6):
+        ''' Declare that fragment copy (an index or fragment object) is equivalent to fragment rep under the orbital mapping loc_map,
+            which is either an orthogonal matrix in the localized basis carrying rep onto copy or a permutation array whose element
+            i is the localized orbital onto which orbital i of rep is carried. Then only rep's impurity problem is solved; copy
+            takes its solution through loc_map. loc_map must leave the localized one-electron Hamiltonian, Fock matrix and
+            mean-field 1RDM invariant. '''
+        if isinstance (rep, (int, np.integer)): rep = self.fragments[rep]
+        if isinstance (copy, (int, np.integer)): copy = self.fragments[copy]
+        loc_map = np.asarray (loc_map)
+        if loc_map.ndim == 1:
+            perm, loc_map = loc_map, np.zeros ((self.norbs_tot, self.norbs_tot))
+            loc_map[perm,np.arange (self.norbs_tot)] = 1
+        if not is_matrix_eye (np.dot (loc_map.T, loc_map)):
+            raise RuntimeError ("Orbital mapping of {} onto {} is not orthogonal".format (rep.frag_name, copy.frag_name))
+        for name, mat in self._equivalence_invariants ():
+            err = np.amax (np.abs (represent_operator_in_basis (mat, loc_map.T) - mat))
+            if err > atol:
+                raise RuntimeError ("Orbital mapping of {} onto {} changes the {} by up to {}".format (rep.frag_name, copy.frag_name, name, err))
+        if (rep.imp_solver_name, rep.active_space, rep.norbs_frag) != (copy.imp_solver_name, copy.active_space, copy.norbs_frag):
+            raise RuntimeError ("Fragments {} and {} have different solvers or sizes".format (rep.frag_name, copy.frag_name))
+        if rep.equiv_rep is not None: # Chain onto the representative of rep
+            rep, loc_map = rep.equiv_rep, np.dot (loc_map, rep.equiv_map)
+        if rep is copy: return
+        copy.equiv_rep, copy.equiv_map = rep, loc_map
+        print ("Fragment {} will be copied from equivalent fragment {} instead of being solved".format (copy.frag_name, rep.frag_name))
+
+    def detect_equivalent_fragments (self, atol=1e-8):
+        ''' Look for pairs of fragments related by a signed permutation of the localized orbitals (e.g., a point-group operation
+            that maps atoms onto atoms, or a translation along a regular cluster) and declare them equivalent. This only checks the
+            one-electron matrices of set_equivalent_fragments, not the two-electron integrals, so it can be fooled in principle;
+            declare the mapping with set_equivalent_fragments yourself if in doubt. Returns the number of copies found. '''
+        mats = [mat for name, mat in self._equivalence_invariants ()]
+        ncopies = 0
+        reps = []
+        for copy in self.fragments:
+            for rep in reps:
+                if (rep.imp_solver_name, rep.active_space, rep.norbs_frag) != (copy.imp_solver_name, copy.active_space, copy.norbs_frag):
+                    continue
+                loc_map = _find_equivalence_map (mats, rep.frag_orb_list, copy.frag_orb_list, atol=atol)
+                if loc_map is not None:
+                    self.set_equivalent_fragments (rep, copy, loc_map)
+                    ncopies += 1
+                    break
+            if copy.equiv_rep is None: reps.append (copy)
+        print ("Found {} fragments equivalent to one of {} others".format (ncopies, len (reps)))
+        return ncopies
+
+    def _equivalence_invariants (self):
+        return (('one-electron Hamiltonian', self.ints.activeOEI), ('Fock matrix', self.ints.activeFOCK),
+                ('mean-field 1RDM', self.ints.oneRDM_loc))
+
+    def symmetrize_umat (self, umat):
+        ''' Overwrite the blocks of umat on fragments that are copies with the mapped blocks of their representatives '''
+        umat = umat.copy ()
+        for frag in self.fragments:
+            if frag.equiv_rep is None: continue
+            umat_rep = represent_operator_in_basis (umat, frag.equiv_map.T)
+            idx = np.ix_(frag.frag_orb_list, frag.frag_orb_list)
+            umat[idx] = umat_rep[idx]
+        return umat
+
     def examine_symmetry (self, verbose=True):
         if not self.ints.mol.symmetry:
             return False
@@ -1310,4 +1672,35 @@ class dmet:
             print ("This system loses its symmetry")
         return symmetry
 
+def _find_equivalence_map (mats, orbs_rep, orbs_copy, atol=1e-8):
+    ''' Look for a signed permutation R of the localized orbitals which leaves every matrix in mats invariant (R.T M R = M) and
+        carries the orbitals orbs_rep onto the orbitals orbs_copy. Greedy: the orbitals of orbs_rep are placed first, then the rest
+        in order of decreasing coupling to those already placed, each onto the first free orbital consistent with all
+        placements so far. Returns R or None. '''
+    norbs = mats[0].shape[0]
+    orbs_copy = np.asarray (orbs_copy)
+    # Properties of each orbital which any signed permutation preserves
+    keys = np.concatenate ([np.diag (mat)[:,None] for mat in mats] + [np.sort (np.abs (mat), axis=1) for mat in mats], axis=1)
+    perm = -np.ones (norbs, dtype=np.int32)
+    sign = np.zeros (norbs)
+    used = np.zeros (norbs, dtype=bool)
+    coupling = sum ([np.abs (mat) for mat in mats])
+    def place (i, candidates):
+        placed = np.where (perm >= 0)[0]
+        for j in candidates:
+            if used[j] or not np.allclose (keys[i], keys[j], atol=atol): continue
+            for s in (1, -1):
+                if all ([np.allclose (s * sign[placed] * mat[j,perm[placed]], mat[i,placed], atol=atol) for mat in mats]):
+                    perm[i], sign[i], used[j] = j, s, True
+                    return True
+        return False
+    for i in orbs_rep:
+        if not place (i, orbs_copy): return None
+    for nplaced in range (len (orbs_rep), norbs):
+        unplaced = np.where (perm < 0)[0]
+        i = unplaced[np.argmax (coupling[np.ix_(unplaced, perm >= 0)].sum (1))]
+        if not place (i, np.where (~used)[0]): return None
+    loc_map = np.zeros ((norbs, norbs))
+    loc_map[perm,np.arange (norbs)] = sign
+    return loc_map
 
@@ -0,0 +1,144 @@
+''' Potential energy surface scans with in-memory warm starts
+
+    pes_scan runs one DMET/LASSCF calculation per geometry. After each point it keeps the correlation potential and
+    chemical potential, and for every fragment the active orbitals (AO basis), active-space 1RDM and 2CDM, and CI vector.
+    These are projected onto the AO basis of the next geometry with the cross-geometry AO overlap matrix, as
+    dmet.load_checkpoint does with prev_mol, but without going through checkpoint files. With extrapolate > 0, the last
+    extrapolate+1 points are each projected onto the new geometry and combined with Lagrange weights in the scan
+    coordinate. Before they are combined, each point's active orbitals are rotated onto those of the most recent point.
+'''
+
+import time
+import numpy as np
+from pyscf.gto import mole
+from mrh.util.la import matrix_svd_control_options
+from mrh.util.basis import represent_operator_in_basis
+
+def lagrange_weights (x_prev, x_new):
+    ''' Weights w such that f(x_new) ~= sum_i w[i] f(x_prev[i]) for the polynomial through all points in x_prev '''
+    x_prev = np.asarray (x_prev, dtype=np.float64)
+    w = np.ones (len (x_prev))
+    for i, xi in enumerate (x_prev):
+        for j, xj in enumerate (x_prev):
+            if i != j: w[i] *= (x_new - xj) / (xi - xj)
+    return w
+
+class pes_scan:
+    ''' Driver for a potential energy surface scan
+
+        Args:
+            build_dmet: callable
+                build_dmet (geom, warm_start) returns a dmet object at geometry geom, ready for doselfconsistent ().
+                warm_start is False only for the first point, which must get its own guess (e.g., generate_frag_cas_guess);
+                otherwise the guess made by the scan overrides whatever build_dmet does. To carry the orbital localization
+                over from point to point as well, give the localintegrals built at every point the same
+                localintegrals.localization_cache as loc_cache.
+
+        Kwargs:
+            extrapolate: int
+                Polynomial order of the extrapolation of the guess from previous points (0 = just project the last point)
+            carry_ci: bool
+                Whether to carry CI vectors over as guesses for the CASSCF fragment solvers
+    '''
+
+    def __init__(self, build_dmet, extrapolate=0, carry_ci=True):
+        self.build_dmet  = build_dmet
+        self.extrapolate = extrapolate
+        self.carry_ci    = carry_ci
+        self.history     = []
+        self.stats       = []
+
+    def kernel (self, geometries, coords=None):
+        ''' Run the scan. coords are scalar scan coordinates for each geometry, used for extrapolation (default: 0, 1, 2, ...).
+            Returns the list of energies. Per-point timing and iteration counts are in self.stats. '''
+        geometries = list (geometries)
+        if coords is None: coords = list (range (len (geometries)))
+        assert (len (coords) == len (geometries))
+        energies = []
+        for geom, x in zip (geometries, coords):
+            warm_start = len (self.history) > 0
+            t0 = time.time ()
+            dmet_obj = self.build_dmet (geom, warm_start)
+            t1 = time.time ()
+            if warm_start: self.apply_guess (dmet_obj, x)
+            t2 = time.time ()
+            energy = dmet_obj.doselfconsistent ()
+            t3 = time.time ()
+            self.store (dmet_obj, x)
+            energies.append (energy)
+            self.stats.append ({'coord': x, 'energy': energy, 'warm_start': warm_start, 'niter_corrpot': dmet_obj.niter_corrpot,
+                'niter_orbs': dmet_obj.niter_orbs, 't_build': t1-t0, 't_guess': t2-t1, 't_solve': t3-t2})
+            print ("PES scan point {} (coordinate {}): energy = {:.10f}; {} corrpot and {} orbital iterations; {:.2f} seconds".format (
+                len (self.stats)-1, x, energy, dmet_obj.niter_corrpot, dmet_obj.niter_orbs, t3-t0))
+        self.print_stats ()
+        return energies
+
+    def store (self, dmet_obj, x):
+        ''' Keep the converged state of dmet_obj in the AO basis '''
+        ints = dmet_obj.ints
+        ao2loc = ints.ao2loc
+        frags = []
+        for f in dmet_obj.fragments:
+            if f.norbs_as == 0:
+                frags.append (None)
+                continue
+            ao2amo = np.dot (ao2loc, f.loc2amo)
+            oneRDM_amo = represent_operator_in_basis (f.oneRDM_loc, f.loc2amo)
+            ci = ao2ci = None
+            if self.carry_ci and getattr (f, 'ci_as', None) is not None:
+                ci, ao2ci = f.ci_as, np.dot (ao2loc, f.ci_as_orb)
+            frags.append ((ao2amo, oneRDM_amo, f.twoCDMimp_amo.copy (), ci, ao2ci))
+        umat_ao = represent_operator_in_basis (dmet_obj.umat, ao2loc.conjugate ().T)
+        self.history.append ({'mol': ints.mol, 'coord': x, 'chempot': dmet_obj.chempot, 'umat_ao': umat_ao, 'frags': frags})
+        self.history = self.history[-(self.extrapolate+1):]
+
+    def apply_guess (self, dmet_obj, x):
+        ''' Project (and maybe extrapolate) the stored states onto the geometry of dmet_obj and install them as its guess '''
+        ints = dmet_obj.ints
+        history = self.history[-(self.extrapolate+1):]
+        w = lagrange_weights ([h['coord'] for h in history], x) if len (history) > 1 else np.ones (1)
+        print ("PES scan guess from {} previous points with weights {}".format (len (history), w))
+        # loc <- ao(old geometry) projectors
+        locSao = [np.dot (mole.intor_cross ('int1e_ovlp', h['mol'], ints.mol), ints.ao2loc).conjugate ().T for h in history]
+
+        if not dmet_obj.doLASSCF:
+            dmet_obj.umat = sum (wi * represent_operator_in_basis (h['umat_ao'], S.conjugate ().T)
+                for wi, h, S in zip (w, history, locSao))
+            dmet_obj.chempot = sum (wi * h['chempot'] for wi, h in zip (w, history))
+
+        latest = history[-1]
+        for ifrag, f in enumerate (dmet_obj.fragments):
+            if ifrag >= len (latest['frags']) or latest['frags'][ifrag] is None: continue
+            ao2amo, oneRDM_amo, twoCDM_amo, ci, ao2ci = latest['frags'][ifrag]
+            if f.active_space is not None and f.active_space[1] != ao2amo.shape[1]:
+                print ("Active space of fragment {} changed; no PES scan guess".format (f.frag_name))
+                continue
+            loc2amo_ref = np.dot (locSao[-1], ao2amo)
+            loc2amo = w[-1] * loc2amo_ref
+            oneRDM_amo = w[-1] * oneRDM_amo
+            twoCDM_amo = w[-1] * twoCDM_amo
+            for wi, h, S in zip (w[:-1], history[:-1], locSao[:-1]):
+                if h['frags'][ifrag] is None: continue
+                ao2amo_i, oneRDM_i, twoCDM_i = h['frags'][ifrag][:3]
+                loc2amo_i = np.dot (S, ao2amo_i)
+                # Rotate onto the latest point's active orbitals, so that the extrapolation isn't fooled by the arbitrary
+                # ordering and phases of the active orbitals
+                lvecs, svals, rvecs = matrix_svd_control_options (np.dot (loc2amo_i.conjugate ().T, loc2amo_ref), sort_vecs=-1,
+                    only_nonzero_vals=False)
+                umat = np.dot (lvecs, rvecs.conjugate ().T)
+                loc2amo += wi * np.dot (loc2amo_i, umat)
+                oneRDM_amo = oneRDM_amo + wi * represent_operator_in_basis (oneRDM_i, umat)
+                twoCDM_amo = twoCDM_amo + wi * represent_operator_in_basis (twoCDM_i, umat)
+            # The CI vector is carried over from the latest point only; pyscf_casscf matches its orbitals to the new guess
+            loc2ci = None if ci is None else np.dot (locSao[-1], ao2ci)
+            dmet_obj.set_frag_amo_guess (f, loc2amo, oneRDM_amo, twoCDM_amo, ci=ci, loc2ci=loc2ci)
+
+        if dmet_obj.doLASSCF: ints.setup_wm_core_scf (dmet_obj.fragments, dmet_obj.calcname)
+
+    def print_stats (self):
+        print ("PES scan summary")
+        print ("{:>5s} {:>12s} {:>18s} {:>5s} {:>8s} {:>6s} {:>10s}".format ('point', 'coord', 'energy', 'warm', 'corrpot', 'orbs', 'seconds'))
+        for i, s in enumerate (self.stats):
+            print ("{:5d} {:12.6f} {:18.10f} {:>5s} {:8d} {:6d} {:10.2f}".format (i, s['coord'], s['energy'], str (s['warm_start']),
+                s['niter_corrpot'], s['niter_orbs'], s['t_build'] + s['t_guess'] + s['t_solve']))
+
@@ -39,7 +39,7 @@ from mrh.util.basis import is_basis_orthonormal, get_overlapping_states, is_basi
 from mrh.util.basis import measure_subspace_blockbreaking, measure_basis_nonorthonormality, cleanup_subspace_symmetry
 from mrh.util.rdm import get_2CDM_from_2RDM, get_2RDM_from_2CDM
 from mrh.util.io import prettyprint_ndarray as prettyprint
-from mrh.util.tensors import symmetrize_tensor
+from mrh.util.tensors import symmetrize_tensor, contract_eri_2cdm
 from mrh.my_dmet.pyscf_rhf import fix_my_RHF_for_nonsinglet_env
 from mrh.my_pyscf import mcscf as my_mcscf
 from mrh.my_pyscf.scf import hf_as
@@ -57,35 +57,23 @@ def solve (frag, guess_1RDM, chempot_imp):
     guess_orbs_av = len (frag.imp_cache) == 2 or frag.norbs_as > 0 
 
     # Get the RHF solution
-    mol = gto.Mole()
+    # The Mole and RHF objects persist on the fragment between calls; only the Hamiltonian and symmetry blocks are swapped
     abs_2MS = int (round (2 * abs (frag.target_MS)))
     abs_2S = int (round (2 * abs (frag.target_S)))
     sign_MS = np.sign (frag.target_MS) or 1
-    mol.spin = abs_2MS
-    mol.verbose = 0 if frag.mol_output is None else lib.logger.DEBUG
-    mol.output = frag.mol_output
-    mol.atom.append(('H', (0, 0, 0)))
-    mol.nelectron = frag.nelec_imp
+    symm = None
     if frag.enforce_symmetry:
-        mol.groupname  = frag.symmetry
-        mol.symm_orb   = get_subspace_symmetry_blocks (frag.loc2imp, frag.loc2symm)
-        mol.irrep_name = frag.ir_names
-        mol.irrep_id   = frag.ir_ids
-    mol.build ()
-    if frag.enforce_symmetry: mol.symmetry = True
-    #mol.incore_anyway = True
-    mf = scf.RHF(mol)
-    mf.get_hcore = lambda *args: OEI
-    mf.get_ovlp = lambda *args: np.eye(frag.norbs_imp)
-    mf.energy_nuc = lambda *args: frag.impham_CONST
-    if frag.impham_CDERI is not None:
-        mf = mf.density_fit ()
-        mf.with_df._cderi = frag.impham_CDERI
-    else:
-        mf._eri = ao2mo.restore(8, frag.impham_TEI, frag.norbs_imp)
-    mf = fix_my_RHF_for_nonsinglet_env (mf, sign_MS * frag.impham_OEI_S)
+        symm = (frag.symmetry, get_subspace_symmetry_blocks (frag.loc2imp, frag.loc2symm), frag.ir_names, frag.ir_ids)
+    mf_ctx = frag.imp_mf_ctx
+    mf_imp = mf_ctx.get_mf (frag.impham_CONST, OEI, frag.nelec_imp, spin=abs_2MS, eri=frag.impham_TEI, cderi=frag.impham_CDERI,
+        atom='H', verbose=(0 if frag.mol_output is None else lib.logger.DEBUG), output=frag.mol_output, symm=symm)
+    mol = mf_imp.mol
+    max_cycle = mf_imp.max_cycle # Put back after the RHF step, since mf_imp outlives this call
+    mf = fix_my_RHF_for_nonsinglet_env (mf_imp, sign_MS * frag.impham_OEI_S)
     mf.__dict__.update (frag.mf_attr)
     if guess_orbs_av: mf.max_cycle = 2
+    # Only a converged RHF is worth keeping as a guess, and only when it isn't just a stepping stone to cached orbitals
+    if not guess_orbs_av: guess_1RDM = mf_ctx.warm_guess (guess_1RDM, frag.loc2imp, frag.nelec_imp)
     mf.scf (guess_1RDM)
     if (not mf.converged) and (not guess_orbs_av):
         if np.any (np.abs (frag.impham_OEI_S) > 1e-8) and mol.spin != 0:
@@ -93,6 +81,7 @@ def solve (frag, guess_1RDM, chempot_imp):
         print ("CASSCF RHF-step not converged on fixed-point iteration; initiating newton solver")
         mf = mf.newton ()
         mf.kernel ()
+    mf_imp.max_cycle = max_cycle
 
     # Instability check and repeat
     if not guess_orbs_av:
@@ -101,15 +90,12 @@ def solve (frag, guess_1RDM, chempot_imp):
                 raise NotImplementedError('ROHF stability-check fixes for nonsinglet environment')
             mf.mo_coeff = mf.stability ()[0]
             guess_1RDM = mf.make_rdm1 ()
-            mf = scf.RHF(mol)
-            mf.get_hcore = lambda *args: OEI
-            mf.get_ovlp = lambda *args: np.eye(frag.norbs_imp)
-            mf._eri = ao2mo.restore(8, frag.impham_TEI, frag.norbs_imp)
-            mf = fix_my_RHF_for_nonsinglet_env (mf, sign_MS * frag.impham_OEI_S)
+            mf = fix_my_RHF_for_nonsinglet_env (mf_imp, sign_MS * frag.impham_OEI_S)
             mf.scf (guess_1RDM)
             if not mf.converged:
                 mf = mf.newton ()
                 mf.kernel ()
+    if not guess_orbs_av: mf_ctx.save (mf.make_rdm1 (), frag.loc2imp)
 
     E_RHF = mf.e_tot
     print ("CASSCF RHF-step energy: {}".format (E_RHF))
@@ -136,6 +122,7 @@ def solve (frag, guess_1RDM, chempot_imp):
     mc.ah_start_tol =1e-10
     mc.ah_conv_tol = 1e-10
     mc.conv_tol = 1e-9
+    if frag.imp_conv_tol is not None: mc.conv_tol = max (mc.conv_tol, frag.imp_conv_tol)
     mc.__dict__.update (frag.corr_attr)
     mc = fix_my_CASSCF_for_nonsinglet_env (mc, sign_MS * frag.impham_OEI_S)
     norbs_amo = mc.ncas
@@ -209,7 +196,8 @@ def solve (frag, guess_1RDM, chempot_imp):
     if frag.mfmo_printed == False:
         ao2mfmo = reduce (np.dot, [frag.ints.ao2loc, frag.loc2imp, imp2mo])
         print ("Writing {} {} orbital molden".format (frag.frag_name, 'CAS guess'))
-        molden.from_mo (frag.ints.mol, frag.filehead + frag.frag_name + '_mfmorb.molden', ao2mfmo, occ=my_occ)
+        fname = frag.filehead + frag.frag_name + '_mfmorb.molden'
+        frag.output_writer.submit (fname, molden.from_mo, frag.ints.mol, fname, ao2mfmo, occ=my_occ)
         frag.mfmo_printed = True
     elif len (frag.active_orb_list) > 0: # This is done AFTER everything else so that the _mfmorb.molden always has consistent ordering
         print('Applying caslst: {}'.format (frag.active_orb_list))
@@ -229,6 +217,7 @@ def solve (frag, guess_1RDM, chempot_imp):
         imp2mo = mc.mo_coeff.copy ()
         mc = mcscf.CASSCF(mf, CASorb, CASe)
         mc.max_cycle_macro = 50 if frag.imp_maxiter is None else frag.imp_maxiter
+        if frag.imp_conv_tol is not None: mc.conv_tol = max (mc.conv_tol, frag.imp_conv_tol) # Never tighter than pyscf's default
         smult = abs_2S + 1 if frag.target_S is not None else (frag.nelec_imp % 2) + 1
         mc.fcisolver = csf_solver (mf.mol, smult)
         E_CASSCF = mc.kernel(imp2mo)[0]
@@ -311,7 +300,7 @@ def solve (frag, guess_1RDM, chempot_imp):
     frag.twoCDMimp_amo = twoCDM_amo
     frag.loc2mo  = loc2mo
     frag.loc2amo = loc2amo
-    frag.E2_cum  = np.tensordot (ao2mo.restore (1, mc.get_h2eff (), mc.ncas), twoCDM_amo, axes=4) / 2
+    frag.E2_cum  = contract_eri_2cdm (mc.get_h2eff (), twoCDM_amo) / 2
     frag.E2_cum += (mf.get_k (dm=oneSDM_imp) * oneSDM_imp).sum () / 4
     # The second line compensates for my incorrect cumulant decomposition. Anything to avoid changing the checkpoint files...
 
@@ -402,7 +391,7 @@ def make_guess_molden (frag, filename, imp2mo, norbs_cmo, norbs_amo):
     mo_occ[:norbs_cmo] = 2
     mo_occ[norbs_cmo:norbs_occ] = 1
     mo = reduce (np.dot, (frag.ints.ao2loc, frag.loc2imp, imp2mo))
-    molden.from_mo (frag.ints.mol, filename, mo, occ=mo_occ)
+    frag.output_writer.submit (filename, molden.from_mo, frag.ints.mol, filename, mo, occ=mo_occ)
     return
 
 def fix_my_CASSCF_for_nonsinglet_env (mc, h1e_s):
@@ -50,6 +50,7 @@ def solve (frag, guess_1RDM, chempot_imp):
 
     t_start = time.time()
     ed.conv_tol = 1e-12
+    if frag.imp_conv_tol is not None: ed.conv_tol = max (ed.conv_tol, frag.imp_conv_tol)
     E_FCI, ci = ed.kernel (h1e, eri, frag.norbs_imp, frag.nelec_imp, ci0=ci)
     assert (ed.converged)
     frag.imp_cache = [ci]
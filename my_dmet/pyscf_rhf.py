@@ -36,24 +36,18 @@ def solve (frag, guess_1RDM, chempot_imp):
     sign_MS = np.sign (frag.target_MS) or 1
 
     # Get the RHF solution
-    mol = gto.Mole()
-    mol.spin = abs (int (round (2 * frag.target_MS)))
-    mol.verbose = 0 if frag.mol_output is None else 4
-    mol.output = frag.mol_output
-    mol.build ()
-    mol.atom.append(('C', (0, 0, 0)))
-    mol.nelectron = frag.nelec_imp
-    mol.incore_anyway = True
-    mf = scf.RHF( mol )
-    mf.get_hcore = lambda *args: OEI
-    mf.get_ovlp = lambda *args: np.eye( frag.norbs_imp )
-    mf.energy_nuc = lambda *args: frag.impham_CONST
+    # The Mole and RHF objects persist on the fragment between calls; only the Hamiltonian is swapped
+    mf_ctx = frag.imp_mf_ctx
     if frag.quasidirect:
-        mf.get_jk = frag.impham_get_jk 
+        mf = mf_ctx.get_mf (frag.impham_CONST, OEI, frag.nelec_imp, spin=abs (int (round (2 * frag.target_MS))), atom='C',
+            get_jk=frag.impham_get_jk, verbose=(0 if frag.mol_output is None else 4), output=frag.mol_output, incore_anyway=True)
     else:
-        mf._eri = ao2mo.restore(8, frag.impham_TEI, frag.norbs_imp)
+        mf = mf_ctx.get_mf (frag.impham_CONST, OEI, frag.nelec_imp, spin=abs (int (round (2 * frag.target_MS))), atom='C',
+            eri=frag.impham_TEI, verbose=(0 if frag.mol_output is None else 4), output=frag.mol_output, incore_anyway=True)
+    mol = mf.mol
     mf = fix_my_RHF_for_nonsinglet_env (mf, sign_MS * frag.impham_OEI_S)
     mf.__dict__.update (frag.mf_attr)
+    guess_1RDM = mf_ctx.warm_guess (guess_1RDM, frag.loc2imp, frag.nelec_imp)
     mf.scf( guess_1RDM )
     if ( mf.converged == False ):
         if np.any (np.abs (frag.impham_OEI_S) > 1e-8) and mol.spin != 0:
@@ -67,14 +61,7 @@ def solve (frag, guess_1RDM, chempot_imp):
             raise NotImplementedError('ROHF stability-check fixes for nonsinglet environment')
         new_mo = mf.stability ()[0]
         guess_1RDM = reduce (np.dot, (new_mo, np.diag (mf.mo_occ), new_mo.conjugate ().T))
-        mf = scf.RHF( mol )
-        mf.get_hcore = lambda *args: OEI
-        mf.get_ovlp = lambda *args: np.eye( frag.norbs_imp )
-        if frag.quasidirect:
-            mf.get_jk = frag.impham_get_jk 
-        else:
-            mf._eri = ao2mo.restore(8, frag.impham_TEI, frag.norbs_imp)
-        mf = fix_my_RHF_for_nonsinglet_env (mf, sign_MS * frag.impham_OEI_S)
+        mf = fix_my_RHF_for_nonsinglet_env (mf_ctx.mf, sign_MS * frag.impham_OEI_S)
         mf.scf( guess_1RDM )
         if ( mf.converged == False ):
             mf = mf.newton ()
@@ -93,6 +80,7 @@ def solve (frag, guess_1RDM, chempot_imp):
     frag.twoCDM_imp = None
     frag.E_imp      = mf.e_tot + np.einsum ('ab,ab->', oneRDM_imp, chempot_imp)
     frag.loc2mo     = np.dot (frag.loc2imp, mf.mo_coeff)
+    mf_ctx.save (mf.make_rdm1 (), frag.loc2imp)
 
     print ("Time for impurity RHF: {} seconds".format (time.time () - t_start))
 
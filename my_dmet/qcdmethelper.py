@@ -23,6 +23,7 @@ from mrh.util.rdm import get_1RDM_from_OEI_in_subspace
 from mrh.util.basis import represent_operator_in_basis, project_operator_into_subspace
 import numpy as np
 import ctypes
+from scipy.sparse.linalg import eigsh
 from mrh.lib.helper import load_library
 lib_qcdmet = load_library ('libqcdmet')
 
@@ -47,6 +48,12 @@ class qcdmethelper:
         self.H1row = H1row
         self.H1col = H1col
         self.Nterms = len( self.H1start ) - 1
+
+        # Eigenpairs of the last mean-field one-electron Hamiltonian (F + u), shared by construct1RDM_loc and construct1RDM_response
+        self.eig_cache_oei  = None
+        self.eig_cache      = None
+        self.eig_cache_hits = 0
+        self.eig_cache_miss = 0
         
     def convertH1sparse( self ):
     
@@ -67,9 +74,30 @@ class qcdmethelper:
         H1col   = np.array( H1col,   dtype=ctypes.c_int )
         return ( H1start, H1row, H1col )
 
+    def can_share_eigenpairs( self, doSCF, NOrotation=None ):
+        ''' The mean-field 1RDM and its response come from the same diagonalization only if neither involves an SCF, they use
+            the same one-electron Hamiltonian (F + u), and the whole orbital space is idempotent '''
+        if doSCF or ( NOrotation is not None ) or ( self.altcf and self.minFunc == 'OEI' ):
+            return False
+        return self.locints.loc2idem.shape[1] == self.locints.norbs_tot and not np.any (self.locints.oneRDMcorr_loc)
+
+    def get_oei_eigenpairs( self, OEI ):
+        ''' Diagonalize OEI, or return the eigenpairs from the previous call if OEI hasn't changed '''
+        if self.eig_cache_oei is not None and np.array_equal (OEI, self.eig_cache_oei):
+            self.eig_cache_hits += 1
+            return self.eig_cache
+        self.eig_cache_miss += 1
+        self.eig_cache = np.linalg.eigh (OEI)
+        self.eig_cache_oei = np.array (OEI, copy=True)
+        return self.eig_cache
+
     def construct1RDM_loc( self, doSCF, umat_loc ):
         
         # Everything in this functions works in the original local AO / lattice basis!
+        if self.can_share_eigenpairs (doSCF):
+            evals, evecs = self.get_oei_eigenpairs (self.locints.loc_rhf_fock () + umat_loc)
+            occ = evecs[:,:self.numPairs]
+            return 2 * np.dot (occ, occ.T)
         if doSCF:
             return self.locints.get_wm_1RDM_from_scf_on_OEI (self.locints.loc_oei ()      + umat_loc)
         elif self.altcf and self.minFunc == 'OEI' :
@@ -95,6 +123,9 @@ class qcdmethelper:
         #   P_idem dg_mol/du P_idem needs to be zero but might not be if OEI is defined in the entire space
         #   However I think I can solve this by projecting the ~final~ derivative up in main_object into the working space
 
+        if self.can_share_eigenpairs (doSCF, NOrotation):
+            return self.rhf_response_from_eigenpairs (*self.get_oei_eigenpairs (OEI))
+
         # This part works in the rotated NO basis if NOrotation is specified
         rdm_deriv_rot = np.ones( [ self.locints.norbs_tot * self.locints.norbs_tot * self.Nterms ], dtype=ctypes.c_double )
         if ( NOrotation != None ):
@@ -113,20 +144,102 @@ class qcdmethelper:
         rdm_deriv_rot = rdm_deriv_rot.reshape( (self.Nterms, self.locints.norbs_tot, self.locints.norbs_tot), order='C' )
         return rdm_deriv_rot
         
-    def constructbath( self, OneDM, impurityOrbs, numBathOrbs, threshold=1e-13 ):
+    def rhf_response_from_eigenpairs( self, eigvals, eigvecs ):
+        ''' Same as lib_qcdmet.rhf_response, but from already-available eigenpairs of the mean-field Hamiltonian.
+            The derivative terms are done in blocks so that only a few Norb x Norb matrices per term are in memory at once. '''
+        norbs = self.locints.norbs_tot
+        nocc  = self.numPairs
+        occ   = eigvecs[:,:nocc]
+        virt  = eigvecs[:,nocc:]
+        denom = -1.0 / ( eigvals[nocc:,None] - eigvals[None,:nocc] )
+        rdm_deriv = np.empty( (self.Nterms, norbs, norbs), dtype=eigvecs.dtype )
+        blksize = max (1, min (self.Nterms, int (0.1e9 / 8 / (3 * norbs * norbs))))
+        for t0 in range (0, self.Nterms, blksize):
+            t1 = min (self.Nterms, t0 + blksize)
+            e0, e1 = self.H1start[t0], self.H1start[t1]
+            # work1 = - VIRT.T * H1 * OCC / ( eps_vir - eps_occ )
+            work1 = virt[self.H1row[e0:e1],:,None] * occ[self.H1col[e0:e1],None,:]
+            work1 = np.add.reduceat (work1, self.H1start[t0:t1] - e0, axis=0) * denom[None,:,:]
+            # work1 = 2 * VIRT * work1 * OCC.T
+            work1 = 2 * np.matmul (np.matmul (virt[None,:,:], work1), occ.T[None,:,:])
+            rdm_deriv[t0:t1] = work1 + work1.transpose (0,2,1)
+        return rdm_deriv
+
+    def H1_contract( self, G ):
+        ''' The vector whose elements are the overlaps (G * H1[term]).sum () for each correlation-potential term '''
+        return np.add.reduceat (G[self.H1row,self.H1col], self.H1start[:-1])
+
+    def H1_expand( self, v ):
+        ''' The matrix sum_term v[term] * H1[term] '''
+        norbs = self.locints.norbs_tot
+        V = np.zeros( (norbs, norbs), dtype=np.result_type (v, np.float64) )
+        np.add.at (V, (self.H1row, self.H1col), np.repeat (v, np.diff (self.H1start)))
+        return V
+
+    def get_occ_divided_differences( self, eigvals ):
+        ''' First divided differences f1[p,q] = (n_p - n_q) / (e_p - e_q) of the RHF occupation numbers, which vanish within the
+            occupied and virtual blocks. The linear response of the 1RDM to a perturbation H (both in the eigenbasis) is
+            f1 * H. '''
+        nocc = self.numPairs
+        occ_num = np.zeros_like (eigvals)
+        occ_num[:nocc] = 2
+        f1 = np.zeros( (eigvals.size, eigvals.size), dtype=eigvals.dtype )
+        f1[nocc:,:nocc] = -2 / ( eigvals[nocc:,None] - eigvals[None,:nocc] )
+        f1[:nocc,nocc:] = f1[nocc:,:nocc].T
+        return occ_num, f1
+
+    def rhf_linear_response( self, eigvals, eigvecs, V ):
+        ''' First-order change of the mean-field 1RDM for a dense perturbation V of the mean-field Hamiltonian '''
+        occ_num, f1 = self.get_occ_divided_differences (eigvals)
+        V_mo = represent_operator_in_basis (V, eigvecs)
+        return represent_operator_in_basis (f1 * V_mo, eigvecs.T)
+
+    def rhf_quadratic_response_adjoint( self, eigvals, eigvecs, W, V ):
+        ''' The matrix G such that (G * H).sum () == (W * D2[V,H]).sum () for any H, where D2 is the second derivative of the
+            mean-field 1RDM with respect to the mean-field Hamiltonian. Built from second divided differences f2[p,r,q] of the
+            occupation numbers (Daleckii-Krein), in blocks of p so that the Norb^3 array is never stored at once. '''
+        norbs = eigvals.size
+        nocc  = self.numPairs
+        occ_num, f1 = self.get_occ_divided_differences (eigvals)
+        is_occ = np.arange (norbs) < nocc
+        W_mo = represent_operator_in_basis (W, eigvecs)
+        V_mo = represent_operator_in_basis (V, eigvecs)
+        G_mo = np.zeros_like (W_mo)
+        blksize = max (1, min (norbs, int (0.1e9 / 8 / (4 * norbs * norbs))))
+        for p0 in range (0, norbs, blksize):
+            p1 = min (norbs, p0 + blksize)
+            ep = eigvals[p0:p1]
+            # f2[p,r,q] = (f1[p,r] - f1[r,q]) / (e_p - e_q) if p and q are in different blocks,
+            #           = -(n_p - n_r) / ((e_p - e_r)(e_q - e_r)) if p and q are in the same block (zero if r is too)
+            diff_block = is_occ[p0:p1,None] != is_occ[None,:]
+            with np.errstate (divide='ignore', invalid='ignore'):
+                f2_diff = (f1[p0:p1,:,None] - f1[None,:,:]) / (ep[:,None,None] - eigvals[None,None,:])
+                er = eigvals[None,:]
+                f2_same = -(occ_num[p0:p1,None] - occ_num[None,:]) / (ep[:,None] - er)
+                f2_same = f2_same[:,:,None] / (eigvals[None,None,:] - er[:,:,None])
+            f2_same[np.broadcast_to ((is_occ[p0:p1,None] == is_occ[None,:])[:,:,None], f2_same.shape)] = 0
+            f2 = np.where (diff_block[:,None,:], f2_diff, f2_same)
+            # (W * D2[V,H]).sum () = sum_prq f2[p,r,q] W[q,p] (V[p,r] H[r,q] + H[p,r] V[r,q])
+            G_mo += np.einsum ('prq,qp,pr->rq', f2, W_mo[:,p0:p1], V_mo[p0:p1,:])
+            G_mo[p0:p1,:] += np.einsum ('prq,qp,rq->pr', f2, W_mo[:,p0:p1], V_mo)
+        return represent_operator_in_basis (G_mo, eigvecs.T)
+
+    def constructbath( self, OneDM, impurityOrbs, numBathOrbs, threshold=1e-13, only_bath=False ):
+        ''' If only_bath, only the numBathOrbs environment eigenvectors with occupations closest to 1 are found (by shift-invert
+            Lanczos) and the returned eigenvecs and coreOccupations omit the pure environment orbitals. '''
     
-        embeddingOrbs = 1 - impurityOrbs
-        embeddingOrbs = np.matrix( embeddingOrbs )
-        if (embeddingOrbs.shape[0] > 1):
-            embeddingOrbs = embeddingOrbs.T # Now certainly row-like matrix (shape = 1 x len(vector))
-        isEmbedding = np.dot( embeddingOrbs.T , embeddingOrbs ) == 1
-        numEmbedOrbs = np.sum( embeddingOrbs )
-        embedding1RDM = np.reshape( OneDM[ isEmbedding ], ( numEmbedOrbs , numEmbedOrbs ) )
-
-        numImpOrbs   = np.sum( impurityOrbs )
+        impurityOrbs = np.asarray( impurityOrbs ).ravel() == 1
+        impIdx       = np.flatnonzero( impurityOrbs )
+        envIdx       = np.flatnonzero( ~impurityOrbs )
+        numImpOrbs   = len( impIdx )
+        numEmbedOrbs = len( envIdx )
         numTotalOrbs = len( impurityOrbs )
-        
-        eigenvals, eigenvecs = np.linalg.eigh( embedding1RDM )
+        embedding1RDM = OneDM[ np.ix_( envIdx, envIdx ) ]
+
+        if only_bath and 0 < numBathOrbs < numEmbedOrbs - 1:
+            eigenvals, eigenvecs = eigsh( embedding1RDM, k=numBathOrbs, sigma=1.0, which='LM' )
+        else:
+            eigenvals, eigenvecs = np.linalg.eigh( embedding1RDM )
         idx = np.maximum( -eigenvals, eigenvals - 2.0 ).argsort() # Occupation numbers closest to 1 come first
         tokeep = np.sum( -np.maximum( -eigenvals, eigenvals - 2.0 )[idx] > threshold )
         if ( tokeep < numBathOrbs ):
@@ -134,25 +247,26 @@ class qcdmethelper:
         numBathOrbs = min(np.sum( tokeep ), numBathOrbs)
         eigenvals = eigenvals[idx]
         eigenvecs = eigenvecs[:,idx]
-        pureEnvironEigVals = -eigenvals[numBathOrbs:]
-        pureEnvironEigVecs = eigenvecs[:,numBathOrbs:]
-        idx = pureEnvironEigVals.argsort()
-        eigenvecs[:,numBathOrbs:] = pureEnvironEigVecs[:,idx]
-        pureEnvironEigVals = -pureEnvironEigVals[idx]
+        if only_bath:
+            eigenvecs = eigenvecs[:,:numBathOrbs]
+            pureEnvironEigVals = np.zeros( 0 )
+        else:
+            pureEnvironEigVals = -eigenvals[numBathOrbs:]
+            pureEnvironEigVecs = eigenvecs[:,numBathOrbs:]
+            idx = pureEnvironEigVals.argsort()
+            eigenvecs[:,numBathOrbs:] = pureEnvironEigVecs[:,idx]
+            pureEnvironEigVals = -pureEnvironEigVals[idx]
         coreOccupations = np.hstack(( np.zeros([ numImpOrbs + numBathOrbs ]), pureEnvironEigVals ))
-    
-        for counter in range(0, numImpOrbs):
-            eigenvecs = np.insert(eigenvecs, counter, 0.0, axis=1) #Stack columns with zeros in the beginning
-        counter = 0
-        for counter2 in range(0, numTotalOrbs):
-            if ( impurityOrbs[counter2] ):
-                eigenvecs = np.insert(eigenvecs, counter2, 0.0, axis=0) #Stack rows with zeros on locations of the impurity orbitals
-                eigenvecs[counter2, counter] = 1.0
-                counter += 1
-        assert( counter == numImpOrbs )
+
+        # Scatter into the full space: impurity orbitals are unit vectors on the impurity sites, environment eigenvectors live on the rest
+        numCols = numImpOrbs + eigenvecs.shape[1]
+        fullvecs = np.zeros( [ numTotalOrbs, numCols ], dtype=eigenvecs.dtype )
+        fullvecs[ impIdx, np.arange( numImpOrbs ) ] = 1.0
+        fullvecs[ envIdx, numImpOrbs: ] = eigenvecs
+        eigenvecs = fullvecs
     
         # Orthonormality is guaranteed due to (1) stacking with zeros and (2) orthonormality eigenvecs for symmetric matrix
-        assert( np.linalg.norm( np.dot(eigenvecs.T, eigenvecs) - np.identity(numTotalOrbs) ) < 1e-12 )
+        assert( np.linalg.norm( np.dot(eigenvecs.T, eigenvecs) - np.identity(numCols) ) < 1e-12 )
 
         # eigenvecs[ : , 0:numImpOrbs ]                      = impurity orbitals
         # eigenvecs[ : , numImpOrbs:numImpOrbs+numBathOrbs ] = bath orbitals
@@ -26,6 +26,109 @@ from pyscf.lib import logger
 from mrh.util.basis import get_complementary_states
 from mrh.util.la import matrix_eigen_control_options
 
+class impurity_mf_context:
+    ''' Persistent fake-molecule RHF object for an impurity (or any other orthonormal working basis).
+
+        The Mole and RHF objects are built once and kept.  Later calls to get_mf only swap in the new one-electron
+        operator, constant, symmetry blocks, and two-electron integrals; the ERIs are only repacked if a different TEI
+        array is passed.  Anything that decides which class scf.RHF returns (spin, electron count, point group) forces
+        a rebuild instead.  warm_guess projects the density of the last converged calculation into
+        the current basis so that the next SCF can start from it. '''
+
+    def __init__(self):
+        self.mol      = None
+        self.mf       = None
+        self.mf_df    = None
+        self.norb     = 0
+        self.oei      = None
+        self.const    = 0
+        self.dm_last  = None
+        self.loc2bas_last = None
+        self.nbuild   = 0
+        self.ncalls   = 0
+        self._mol_key   = None
+        self._eri_src   = None
+        self._cderi_src = None
+
+    def _intor (self, intor, comp=None, hermi=0, aosym='s1', out=None, shls_slice=None):
+        if intor == 'int1e_ovlp':
+            return np.eye (self.norb)
+        return gto.Mole.intor (self.mol, intor, comp=comp, hermi=hermi, aosym=aosym, out=out, shls_slice=shls_slice)
+
+    def _build (self, nelec, spin, atom, verbose, output, incore_anyway, symm):
+        mol = gto.Mole ()
+        mol.atom.append ((atom, (0, 0, 0)))
+        mol.nelectron = nelec
+        mol.spin = spin
+        mol.verbose = verbose
+        if output is not None: mol.output = output
+        mol.incore_anyway = incore_anyway
+        mol.build ()
+        if symm is not None:
+            # Must be in place before scf.RHF, which picks the symmetry-adapted class from mol.symmetry
+            mol.groupname, mol.symm_orb, mol.irrep_name, mol.irrep_id = symm
+            mol.symmetry = True
+        mf = scf.RHF (mol)
+        mf.get_hcore = lambda *args: self.oei
+        mf.get_ovlp = lambda *args: np.eye (self.norb)
+        mf.energy_nuc = lambda *args: self.const
+        self.mol, self.mf, self.mf_df = mol, mf, None
+        self._eri_src = self._cderi_src = None
+        self.nbuild += 1
+
+    def get_mf (self, CONST, OEI, nelec, spin=0, eri=None, cderi=None, get_jk=None, atom='H', verbose=0, output=None,
+            symm=None, incore_anyway=False):
+        ''' Return the persistent RHF object updated for this call. symm is None or (groupname, symm_orb, irrep_name, irrep_id).
+            Exactly one of eri (any pyscf ERI symmetry), cderi, or get_jk should be supplied. '''
+        self.ncalls += 1
+        mol_key = (nelec, spin, None if symm is None else symm[0], atom, verbose, output, incore_anyway)
+        if self.mol is None or mol_key != self._mol_key:
+            self._build (nelec, spin, atom, verbose, output, incore_anyway, symm)
+            self._mol_key = mol_key
+        self.norb, self.oei, self.const = OEI.shape[0], OEI, CONST
+        mol = self.mol
+        if symm is not None:
+            # Same point group as the cached objects (see mol_key), so only the orbital blocks need to be swapped out
+            mol.groupname, mol.symm_orb, mol.irrep_name, mol.irrep_id = symm
+        mf = self.mf
+        if cderi is not None:
+            if self.mf_df is None: self.mf_df = mf.density_fit ()
+            mf = self.mf_df
+            if cderi is not self._cderi_src:
+                mf.with_df._cderi = cderi
+                self._cderi_src = cderi
+        elif get_jk is not None:
+            mf._eri = None
+            mf.get_jk = get_jk
+            self._eri_src = None
+        else:
+            mf.__dict__.pop ('get_jk', None)
+            if eri is not self._eri_src:
+                mf._eri = ao2mo.restore (8, eri, self.norb)
+                self._eri_src = eri
+        mf.verbose = mol.verbose
+        mf.converged = False
+        return mf
+
+    def patch_ovlp_intor (self):
+        ''' The newton solver asks the Mole object for the overlap matrix directly '''
+        self.mol.intor = self._intor
+
+    def warm_guess (self, dm0, loc2bas, nelec, nelec_tol=1e-2):
+        ''' Project the last converged density into the basis loc2bas.  Falls back to dm0 if there is none or if the
+            projection doesn't hold nelec electrons (i.e., if the basis or the electron count changed too much). '''
+        if self.dm_last is None or loc2bas is None or self.loc2bas_last is None: return dm0
+        if self.loc2bas_last.shape[0] != loc2bas.shape[0]: return dm0
+        ovlp = np.dot (loc2bas.conjugate ().T, self.loc2bas_last)
+        dm = np.matmul (np.matmul (ovlp, self.dm_last), ovlp.conjugate ().T)
+        if abs (np.trace (dm, axis1=-2, axis2=-1).sum () - nelec) > nelec_tol: return dm0
+        return dm
+
+    def save (self, dm, loc2bas):
+        if loc2bas is None: return
+        self.dm_last = np.asarray (dm).copy ()
+        self.loc2bas_last = np.asarray (loc2bas).copy ()
+
 # The TEI is tagged and I must wrap_my_veff and wrap_my_jk in solve_ERI as well
 
 def wrap_my_jk_ERI (TEI):
@@ -50,19 +153,10 @@ def wrap_my_veff_ERI (TEI):
         
     return my_veff
 
-def solve_ERI( OEI, TEI, oneRDMguess_loc, numPairs, num_mf_stab_checks):
-
-    mol = gto.Mole()
-    mol.build(verbose=0)
-    mol.atom.append(('C', (0, 0, 0)))
-    mol.nelectron = 2 * numPairs
+def solve_ERI( OEI, TEI, oneRDMguess_loc, numPairs, num_mf_stab_checks, mf_ctx=None):
 
-    L = OEI.shape[0]
-    mf = scf.RHF( mol )
-    mf.get_hcore = lambda *args: OEI
-    mf.get_ovlp = lambda *args: np.eye( L )
-    mf._eri = None # ao2mo.restore(8, TEI, L)
-    mf.get_jk   = wrap_my_jk_ERI   (TEI)
+    if mf_ctx is None: mf_ctx = impurity_mf_context ()
+    mf = mf_ctx.get_mf (0, OEI, 2 * numPairs, atom='C', get_jk=wrap_my_jk_ERI (TEI))
     mf.get_veff = wrap_my_veff_ERI (TEI)
     mf.verbose = 4
     mf.scf( oneRDMguess_loc )
@@ -74,14 +168,8 @@ def solve_ERI( OEI, TEI, oneRDMguess_loc, numPairs, num_mf_stab_checks):
 
     # Instability check and repeat
     for i in range (num_mf_stab_checks):
-        mf.mo_coeff = mf.stability ()[0]
-        oneRDMguess_loc = mf.make_rdm1 ()
-        mf = scf.RHF( mol )
-        mf.get_hcore = lambda *args: OEI
-        mf.get_ovlp = lambda *args: np.eye( L )
-        mf._eri = None # ao2mo.restore(8, TEI, L)
-        mf.get_jk   = wrap_my_jk_ERI   (TEI)
-        mf.get_veff = wrap_my_veff_ERI (TEI)
+        oneRDMguess_loc = mf.make_rdm1 (mf.stability ()[0], mf.mo_occ)
+        mf = mf_ctx.mf
         mf.verbose=0
         mf.scf( oneRDMguess_loc )
         oneRDM_loc = mf.make_rdm1 ()
@@ -127,57 +215,32 @@ def wrap_my_veff (get_veff_ao, ao2basis ):
 
 def solve_JK(CONST, OEI, ao2basis, oneRDMguess_loc, numPairs, num_mf_stab_checks, get_veff_ao, get_jk_ao,
     groupname=None, symm_orb=None, irrep_name=None, irrep_id=None, enforce_symmetry=False,
-    verbose=logger.INFO, output=None):
-
-    mol = gto.Mole()
-    mol.atom.append(('C', (0, 0, 0)))
-    mol.nelectron = 2 * numPairs
-    mol.verbose = 0 if output is None else verbose
-    if enforce_symmetry:
-        mol.groupname = groupname
-        mol.symm_orb = symm_orb
-        mol.irrep_name = irrep_name
-        mol.irrep_id = irrep_id
-    if output is not None: mol.output = output
-    mol.build ()
-    if enforce_symmetry: mol.symmetry = True
-
-    L = OEI.shape[0]
-    mf = scf.RHF( mol )
-    mf.get_hcore = lambda *args: OEI
-    mf.get_ovlp = lambda *args: np.eye( L )
-    mf.energy_nuc = lambda *args: CONST
-    mf._eri = None
-    mf.get_jk   = wrap_my_jk   (get_jk_ao, ao2basis)
+    verbose=logger.INFO, output=None, mf_ctx=None, loc2basis=None, warm_start=False):
+    ''' If mf_ctx (an impurity_mf_context) is given, its Mole and RHF objects are reused. If loc2basis is also given, the converged
+        density is kept, and with warm_start=True the previous one is projected into the current basis and used as the initial guess. '''
+
+    if mf_ctx is None: mf_ctx = impurity_mf_context ()
+    symm = (groupname, symm_orb, irrep_name, irrep_id) if enforce_symmetry else None
+    mf = mf_ctx.get_mf (CONST, OEI, 2 * numPairs, atom='C', get_jk=wrap_my_jk (get_jk_ao, ao2basis),
+        verbose=(0 if output is None else verbose), output=output, symm=symm)
     #mf.get_veff = wrap_my_veff (get_veff_ao, ao2basis)
     mf.max_cycle = 500
     mf.damp = 0.33
+    if warm_start: oneRDMguess_loc = mf_ctx.warm_guess (oneRDMguess_loc, loc2basis, 2 * numPairs)
     
     mf.scf( oneRDMguess_loc )
     oneRDM_loc = mf.make_rdm1 ()
     if not mf.converged:
         mf = mf.newton ()
-        def my_intor (intor, comp=None, hermi=0, aosym='s1', out=None, shls_slice=None):
-            if intor == 'int1e_ovlp':
-                return np.eye (L)
-            return gto.Mole.intor(mol, intor, comp=comp, hermi=hermi, aosym=aosym, out=out, shls_slice=shls_slice)
-        mf.mol.intor = my_intor
+        mf_ctx.patch_ovlp_intor ()
         mf.kernel ( oneRDM_loc )
         oneRDM_loc = mf.make_rdm1 ()
     assert (mf.converged)
 
     # Instability check and repeat
     for i in range (num_mf_stab_checks):
-        mf.mo_coeff = mf.stability ()[0]
-        oneRDMguess_loc = mf.make_rdm1 ()
-        mf = scf.RHF( mol )
-        mf.get_hcore = lambda *args: OEI
-        mf.get_ovlp = lambda *args: np.eye( L )
-        mf.energy_nuc = lambda *args: CONST
-        mf._eri = None # ao2mo.restore(8, TEI, L)
-        mf._eri = None
-        mf.get_jk   = wrap_my_jk   (get_jk_ao, ao2basis)
-        #mf.get_veff = wrap_my_veff (get_veff_ao, ao2basis)
+        oneRDMguess_loc = mf.make_rdm1 (mf.stability ()[0], mf.mo_occ)
+        mf = mf_ctx.mf
         mf.verbose=0
         mf.scf( oneRDMguess_loc )
         oneRDM_loc = mf.make_rdm1 ()
@@ -185,6 +248,7 @@ def solve_JK(CONST, OEI, ao2basis, oneRDMguess_loc, numPairs, num_mf_stab_checks
             mf.newton ().kernel ( oneRDM_loc )
             oneRDM_loc = mf.make_rdm1 () #np.dot(np.dot( mf.mo_coeff, np.diag( mf.mo_occ )), mf.mo_coeff.T )
 
+    mf_ctx.save (oneRDM_loc, loc2basis)
     return oneRDM_loc
     
 def get_unfrozen_states (oneRDMfroz_loc):
@@ -0,0 +1,54 @@
+import os
+import numpy as np
+import pytest
+from mrh.my_dmet import chkfile
+
+# Run from the directory containing mrh, e.g.: python -m pytest mrh/tests
+
+def random_frags (nao, norbs_amo, seed=0):
+    rng = np.random.default_rng (seed)
+    return [(n, rng.standard_normal ((nao, n)), rng.standard_normal ((n, n)), rng.standard_normal ((n,)*4))
+        for n in norbs_amo]
+
+@pytest.mark.parametrize ('ext,compression', [('.h5', None), ('.h5', 'gzip'), ('.npy', None)])
+def test_save_load_identity (tmp_path, ext, compression):
+    nao, norbs_amo = 7, (2, 0, 3)
+    frags = random_frags (nao, norbs_amo)
+    mat = np.random.default_rng (1).standard_normal ((nao, nao))
+    fname = str (tmp_path / ('chk' + ext))
+    chkfile.save_chkfile (fname, nao, 0.25, mat, iter (frags), compression=compression)
+    assert (os.listdir (str (tmp_path)) == ['chk' + ext]) # No temporary file left behind
+    reader = chkfile.chkfile_reader (fname)
+    assert (reader.nao == nao and reader.chempot == 0.25 and reader.nfrags == len (norbs_amo))
+    assert (reader.norbs_amo == list (norbs_amo))
+    assert (np.array_equal (reader.mat, mat))
+    for ref, test in zip (frags, reader.iter_fragments ()):
+        assert (test[0] == ref[0])
+        for arr_ref, arr_test in zip (ref[1:], test[1:]):
+            assert (arr_test.shape == arr_ref.shape and np.array_equal (arr_test, arr_ref))
+    # Lazy single-fragment read gives the same as the full walk
+    assert (np.array_equal (chkfile.load_chkfile_fragment (fname, 2)[3], frags[2][3]))
+
+def test_failed_write_keeps_previous_checkpoint (tmp_path):
+    nao = 4
+    fname = str (tmp_path / 'chk.h5')
+    chkfile.save_chkfile (fname, nao, 0.0, np.eye (nao), random_frags (nao, (2,)))
+    def bad_frags ():
+        yield random_frags (nao, (1,), seed=2)[0]
+        raise RuntimeError ("interrupted")
+    with pytest.raises (RuntimeError):
+        chkfile.save_chkfile (fname, nao, 1.0, np.zeros ((nao, nao)), bad_frags ())
+    reader = chkfile.chkfile_reader (fname)
+    assert (reader.chempot == 0.0 and reader.norbs_amo == [2])
+    assert (os.listdir (str (tmp_path)) == ['chk.h5'])
+
+def test_fragment_state_key (tmp_path):
+    fname = str (tmp_path / 'frag.resume.pkl')
+    key = {'solver': 'CASSCF', 'chempot_frag': 0.1, 'loc2imp': np.eye (3)}
+    chkfile.save_fragment_state (fname, key, {'E_imp': -1.5})
+    assert (chkfile.load_fragment_state (fname, dict (key, loc2imp=np.eye (3) + 1e-9), atol=1e-8) == {'E_imp': -1.5})
+    assert (chkfile.load_fragment_state (fname, dict (key, loc2imp=np.eye (3) + 1e-6), atol=1e-8) is None)
+    assert (chkfile.load_fragment_state (fname, dict (key, solver='FCI'), atol=1e-8) is None)
+    with open (fname, 'wb') as f: f.write (b'not a pickle')
+    with pytest.warns (RuntimeWarning):
+        assert (chkfile.load_fragment_state (fname, key) is None)
@@ -0,0 +1,78 @@
+import time
+import numpy as np
+import pytest
+from mrh.util.io import async_writer
+
+class recorder:
+    ''' Logs the files it wrote, in order. (Lists passed as arguments to submit would be snapshotted, so the log lives here.) '''
+    def __init__(self):
+        self.log = []
+    def save (self, fname, arr, delay=0.01):
+        time.sleep (delay)
+        np.save (fname, arr)
+        self.log.append (fname)
+
+def failing_save (fname):
+    raise IOError ("disk full")
+
+def test_writes_in_order_and_complete_after_flush (tmp_path):
+    writer = async_writer (queue_size=2)
+    rec = recorder ()
+    fnames = [str (tmp_path / '{}.npy'.format (i)) for i in range (6)]
+    for i, fname in enumerate (fnames):
+        writer.submit (fname, rec.save, fname, np.full (3, i))
+    writer.flush ()
+    assert (rec.log == fnames)
+    for i, fname in enumerate (fnames):
+        assert (np.array_equal (np.load (fname), np.full (3, i)))
+    assert (writer.nwritten == 6)
+    writer.close ()
+
+def test_arrays_are_snapshotted (tmp_path):
+    writer = async_writer ()
+    fname = str (tmp_path / 'a.npy')
+    arr = np.zeros (4)
+    writer.submit (fname, recorder ().save, fname, arr, delay=0.05)
+    arr[:] = 1 # The caller is free to change it right away
+    writer.close ()
+    assert (np.array_equal (np.load (fname), np.zeros (4)))
+
+def test_error_raised_by_next_flush (tmp_path):
+    writer = async_writer ()
+    rec = recorder ()
+    writer.submit ('bad', failing_save, 'bad')
+    fname = str (tmp_path / 'after.npy')
+    writer.submit (fname, rec.save, fname, np.ones (2))
+    with pytest.raises (RuntimeError, match='bad'):
+        writer.flush ()
+    # Later writes still happen, and the error is only reported once
+    assert (rec.log == [fname])
+    writer.flush ()
+    writer.close ()
+
+def test_error_raised_by_close ():
+    writer = async_writer ()
+    writer.submit ('bad', failing_save, 'bad')
+    with pytest.raises (RuntimeError):
+        writer.close ()
+    assert (writer._thread is None)
+
+def test_close_then_submit_restarts (tmp_path):
+    writer = async_writer ()
+    rec = recorder ()
+    fname = str (tmp_path / 'a.npy')
+    writer.submit (fname, rec.save, fname, np.ones (2))
+    writer.close ()
+    assert (rec.log == [fname] and writer._thread is None)
+    writer.submit (fname, rec.save, fname, np.ones (2))
+    writer.close ()
+    assert (rec.log == [fname, fname] and writer.nwritten == 2)
+
+def test_disabled_writes_synchronously (tmp_path):
+    writer = async_writer (enabled=False)
+    rec = recorder ()
+    fname = str (tmp_path / 'a.npy')
+    writer.submit (fname, rec.save, fname, np.ones (2))
+    assert (rec.log == [fname] and writer._thread is None)
+    with pytest.raises (IOError):
+        writer.submit ('bad', failing_save, 'bad')
@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+from mrh.my_dmet.pes_scan import lagrange_weights
+
+@pytest.mark.parametrize ('npoints', [1, 2, 3, 4])
+def test_lagrange_weights_polynomial (npoints):
+    # Extrapolation through npoints points is exact for polynomials of degree npoints-1
+    rng = np.random.default_rng (npoints)
+    coeffs = rng.standard_normal (npoints)
+    x_prev = [1.0, 1.1, 1.25, 1.3][:npoints]
+    for x_new in (1.4, 1.05, 0.9):
+        w = lagrange_weights (x_prev, x_new)
+        assert (np.isclose (np.dot (w, np.polyval (coeffs, x_prev)), np.polyval (coeffs, x_new), rtol=0, atol=1e-10))
+        assert (np.isclose (w.sum (), 1.0))
+
+def test_lagrange_weights_at_nodes ():
+    x_prev = [0.0, 1.0, 2.0]
+    for i, x in enumerate (x_prev):
+        assert (np.allclose (lagrange_weights (x_prev, x), np.eye (3)[i]))
+
+def test_lagrange_weights_linear ():
+    # Linear extrapolation from two equally spaced points: 2 f(x1) - f(x0)
+    assert (np.allclose (lagrange_weights ([0.0, 1.0], 2.0), [-1.0, 2.0]))
@@ -0,0 +1,48 @@
+import numpy as np
+from mrh.util.rdm import twoCDM_store
+from mrh.util.basis import represent_operator_in_basis
+
+def random_store (norbs=10, nas=(2, 3), seed=0):
+    ''' A store with one block per "fragment", the active spaces being orthonormal to each other as in LASSCF '''
+    rng = np.random.default_rng (seed)
+    loc2wmas = np.linalg.qr (rng.standard_normal ((norbs, sum (nas))))[0]
+    offs = np.cumsum ((0,) + nas)
+    loc2tb = [loc2wmas[:,i:j] for i, j in zip (offs[:-1], offs[1:])]
+    twoCDM_tb = [rng.standard_normal ((n,)*4) for n in nas]
+    return twoCDM_store (loc2tb, twoCDM_tb), loc2tb, twoCDM_tb, loc2wmas
+
+def dense (loc2tb, twoCDM_tb):
+    return sum ([np.einsum ('ijkl,pi,qj,rk,sl->pqrs', L, C, C, C, C) for C, L in zip (loc2tb, twoCDM_tb)])
+
+def test_project_round_trip ():
+    store, loc2tb, twoCDM_tb, loc2wmas = random_store ()
+    # Projecting onto each block's own basis gives back that block (the other blocks are orthogonal to it)
+    for C, L in zip (loc2tb, twoCDM_tb):
+        assert (np.allclose (store.project (C), L))
+    # Projecting onto the union of the blocks and back out reproduces the whole cumulant
+    L_wmas = store.project (loc2wmas)
+    assert (np.allclose (represent_operator_in_basis (L_wmas, loc2wmas.T), dense (loc2tb, twoCDM_tb)))
+    # One basis per index
+    C0, C1 = loc2tb
+    assert (np.allclose (store.project (C0, C1, C0, C1), np.zeros ((2, 3, 2, 3))))
+    assert (np.allclose (store.project (loc2wmas, C0, C0, C0), represent_operator_in_basis (dense (loc2tb, twoCDM_tb), loc2wmas, C0, C0, C0)))
+
+def test_project_skips_orthogonal_basis ():
+    store, loc2tb, twoCDM_tb, loc2wmas = random_store ()
+    norbs = loc2wmas.shape[0]
+    loc2other = np.linalg.qr (np.append (loc2wmas, np.eye (norbs), axis=1))[0][:,loc2wmas.shape[1]:]
+    assert (np.allclose (store.project (loc2other), 0))
+
+def test_contract_eri ():
+    store, loc2tb, twoCDM_tb, loc2wmas = random_store ()
+    norbs = loc2wmas.shape[0]
+    rng = np.random.default_rng (1)
+    eri = rng.standard_normal ((norbs,)*4)
+    eri = eri + eri.transpose (1,0,2,3)
+    eri = eri + eri.transpose (0,1,3,2)
+    eri = eri + eri.transpose (2,3,0,1)
+    ref = np.einsum ('pqrs,pqrs->', eri, dense (loc2tb, twoCDM_tb))
+    # Callable returning the eris in any basis, as ints.dmet_tei does
+    assert (np.isclose (store.contract_eri (lambda C: represent_operator_in_basis (eri, C)), ref))
+    # Array in the localized basis
+    assert (np.isclose (store.contract_eri (eri, np.eye (norbs)), ref))
@@ -0,0 +1,39 @@
+import numpy as np
+from scipy import linalg
+from mrh.util.rdm import Schmidt_tracker, Schmidt_decomposition_idempotent_wrapper
+
+def idempotent_1RDM (loc2occ):
+    return 2 * np.dot (loc2occ, loc2occ.T)
+
+def test_tracker_matches_full_decomposition ():
+    norbs, nocc, nfrag = 14, 5, 3
+    rng = np.random.default_rng (0)
+    loc2occ = np.linalg.qr (rng.standard_normal ((norbs, nocc)))[0]
+    loc2frag = np.eye (norbs)[:,:nfrag]
+    tracker = Schmidt_tracker (thresh=0.1)
+    for it in range (4):
+        # Small rotation of the occupied space from one "iteration" to the next
+        kappa = 1e-3 * rng.standard_normal ((norbs, norbs))
+        loc2occ = np.dot (linalg.expm (kappa - kappa.T), loc2occ)
+        D = idempotent_1RDM (loc2occ)
+        test = Schmidt_decomposition_idempotent_wrapper (D, loc2frag, nfrag, tracker=tracker)
+        ref = Schmidt_decomposition_idempotent_wrapper (D, loc2frag, nfrag)
+        loc2emb, norbs_bath, nelec_imp, core_1RDM = test[:4]
+        assert (norbs_bath == ref[1] and nelec_imp == ref[2])
+        assert (np.allclose (np.dot (loc2emb.T, loc2emb), np.eye (norbs)))
+        # Same impurity space (the basis within it may differ) and the same core 1RDM
+        norbs_imp = nfrag + norbs_bath
+        P_test = np.dot (loc2emb[:,:norbs_imp], loc2emb[:,:norbs_imp].T)
+        P_ref = np.dot (ref[0][:,:norbs_imp], ref[0][:,:norbs_imp].T)
+        assert (np.allclose (P_test, P_ref, atol=1e-8))
+        assert (np.allclose (core_1RDM, ref[3], atol=1e-8))
+    assert (tracker.nfallback == 1 and tracker.ntracked == 3)
+
+def test_tracker_falls_back_when_fragment_changes ():
+    norbs, nocc = 10, 4
+    loc2occ = np.linalg.qr (np.random.default_rng (1).standard_normal ((norbs, nocc)))[0]
+    D = idempotent_1RDM (loc2occ)
+    tracker = Schmidt_tracker ()
+    Schmidt_decomposition_idempotent_wrapper (D, np.eye (norbs)[:,:2], 2, tracker=tracker)
+    Schmidt_decomposition_idempotent_wrapper (D, np.eye (norbs)[:,2:4], 2, tracker=tracker)
+    assert (tracker.nfallback == 2 and tracker.ntracked == 0)
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+from pyscf import ao2mo
+from mrh.util.tensors import pack_2cdm, contract_eri_2cdm
+
+def random_eri (norb, seed=0):
+    # Real eri with 8-fold permutational symmetry
+    rng = np.random.default_rng (seed)
+    eri = rng.standard_normal ((norb,)*4)
+    eri = eri + eri.transpose (1,0,2,3)
+    eri = eri + eri.transpose (0,1,3,2)
+    return eri + eri.transpose (2,3,0,1)
+
+@pytest.mark.parametrize ('symmetry', [1, 4, 8])
+def test_contract_eri_2cdm_vs_einsum (symmetry):
+    norb = 5
+    eri = random_eri (norb)
+    # The 2CDM doesn't need any permutational symmetry of its own
+    twoCDM = np.random.default_rng (1).standard_normal ((norb,)*4)
+    ref = np.einsum ('pqrs,pqrs->', eri, twoCDM)
+    eri_packed = eri if symmetry == 1 else ao2mo.restore (symmetry, eri, norb)
+    assert (np.isclose (contract_eri_2cdm (eri_packed, twoCDM), ref, rtol=1e-12, atol=1e-10))
+
+@pytest.mark.parametrize ('symmetry', [4, 8])
+def test_pack_2cdm_shape (symmetry):
+    norb = 4
+    npair = norb * (norb+1) // 2
+    G = pack_2cdm (np.ones ((norb,)*4), symmetry=symmetry)
+    assert (G.shape == ((npair, npair) if symmetry == 4 else (npair * (npair+1) // 2,)))
+    # The weights of the folded-away elements add up to the number of elements
+    assert (np.isclose (G.sum (), norb**4))
@@ -1,4 +1,4 @@
-import sys
+import sys, os, time, queue, threading, atexit
 import numpy as np
 import warnings
 import traceback
@@ -19,3 +19,104 @@ def prettyprint_ndarray (mat, fmt='{:9.2e}'):
     return '\n'.join (fmt_str.format (*row) for row in mat)
 
 
+
+def _snapshot (x):
+    ''' Copy the arrays in (possibly nested lists, tuples, or dicts of) x, so that the caller is free to change them '''
+    if isinstance (x, np.ndarray): return x.copy ()
+    if isinstance (x, (list, tuple)): return type (x) (_snapshot (y) for y in x)
+    if isinstance (x, dict): return {key: _snapshot (val) for key, val in x.items ()}
+    return x
+
+def _nbytes (x):
+    if isinstance (x, np.ndarray): return x.nbytes
+    if isinstance (x, (list, tuple)): return sum (_nbytes (y) for y in x)
+    if isinstance (x, dict): return sum (_nbytes (y) for y in x.values ())
+    return 0
+
+class async_writer:
+    ''' Writes output files (moldens, npy guesses, checkpoints) on a background thread, so that the calculation doesn't wait on
+        the filesystem. submit (fname, fn, *args, **kwargs) snapshots every array in args and kwargs and queues fn (*args, **kwargs),
+        which must write fname; it returns immediately unless queue_size writes are already pending, in which case it waits for
+        one of them to finish. Writes happen in the order they were submitted.
+
+        Semantics: a file is complete once flush () returns (and not necessarily before; so call flush before reading any of these
+        files back). With fsync=True, each file is also fsync'd after it is written, so that once flush () returns it is on disk
+        and not just in the page cache. An exception in the writer thread is re-raised, as a RuntimeError, by the next flush or
+        close. With enabled=False, submit just calls fn right away, which is the old behavior. report () prints the bookkeeping. '''
+
+    def __init__(self, enabled=True, queue_size=8, fsync=False):
+        self.enabled = enabled
+        self.queue_size = queue_size
+        self.fsync = fsync
+        self.nwritten = 0
+        self.nbytes = 0
+        self.t_write = 0.0
+        self.t_wait = 0.0
+        self._errors = []
+        self._queue = None
+        self._thread = None
+
+    def _start (self):
+        self._queue = queue.Queue (maxsize=self.queue_size)
+        self._thread = threading.Thread (target=self._run, name='async_writer', daemon=True)
+        self._thread.start ()
+        atexit.register (self._drain) # Don't lose pending writes if the calculation dies or forgets to flush
+
+    def _drain (self):
+        if self._queue is not None: self._queue.join ()
+
+    def _run (self):
+        while True:
+            job = self._queue.get ()
+            try:
+                if job is None: return
+                self._write (*job)
+            except Exception as e:
+                self._errors.append ((job[0], e))
+                traceback.print_exc ()
+            finally:
+                self._queue.task_done ()
+
+    def _write (self, fname, fn, args, kwargs):
+        t0 = time.time ()
+        fn (*args, **kwargs)
+        if self.fsync and os.path.exists (fname):
+            with open (fname, 'rb') as f:
+                os.fsync (f.fileno ())
+        self.nwritten += 1
+        self.t_write += time.time () - t0
+
+    def submit (self, fname, fn, *args, **kwargs):
+        if not self.enabled:
+            self._write (fname, fn, args, kwargs)
+            return
+        if self._thread is None: self._start ()
+        args, kwargs = _snapshot (args), _snapshot (kwargs)
+        self.nbytes += _nbytes (args) + _nbytes (kwargs)
+        t0 = time.time ()
+        self._queue.put ((fname, fn, args, kwargs))
+        self.t_wait += time.time () - t0
+
+    def flush (self):
+        if self._queue is not None:
+            t0 = time.time ()
+            self._queue.join ()
+            self.t_wait += time.time () - t0
+        if len (self._errors):
+            fname, e = self._errors[0]
+            self._errors = []
+            raise RuntimeError ("Background write of {} failed: {}".format (fname, e))
+
+    def close (self):
+        ''' Flush and stop the writer thread; a later submit starts a new one '''
+        if self._thread is not None:
+            self._queue.put (None)
+            self._thread.join ()
+            self._queue = self._thread = None
+        self.flush ()
+
+    def report (self):
+        if not self.enabled: return
+        print (("Background writer: {} files ({:.1f} MB of array snapshots); {:.2f} s writing off the critical path, {:.2f} s "
+                "waited on it; files are complete after flush{}").format (self.nwritten, self.nbytes / 1e6, self.t_write, self.t_wait,
+                " and fsync'd" if self.fsync else " (not fsync'd)"))
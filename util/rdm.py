@@ -7,6 +7,7 @@ from mrh.util.basis import *
 from mrh.util.my_math import is_close_to_integer
 from mrh.util import params
 from mrh.util.io import warnings
+from mrh.util.tensors import contract_eri_2cdm
 
 def get_1RDM_from_OEI (one_electron_hamiltonian, nocc, subspace=None, symmetry=None, strong_symm=None):
     evals, evecs = matrix_eigen_control_options (one_electron_hamiltonian, sort_vecs=1, subspace=subspace,
@@ -25,8 +26,8 @@ def get_1RDM_from_OEI_in_subspace (one_electron_hamiltonian, subspace_basis, noc
     
 def Schmidt_decompose_1RDM (the_1RDM, loc2frag, norbs_bath_max, symmetry=None, fock_helper=None, enforce_symmetry=False,
         bath_tol=params.num_zero_atol, num_zero_atol=params.num_zero_atol, num_zero_rtol=params.num_zero_rtol):
-    get_labels = (not (symmetry is None)) or (not (frag_symm is None))
     labels = frag_symm = env_symm = ufrag_labels = efrag_labels = bath_labels = core_labels = None
+    get_labels = (not (symmetry is None)) or (not (frag_symm is None))
     norbs_tot = assert_matrix_square (the_1RDM)
     norbs_frag = loc2frag.shape[1]
     assert (norbs_tot >= norbs_frag and loc2frag.shape[0] == norbs_tot)
@@ -177,11 +178,108 @@ def idempotize_1RDM (oneRDM, thresh):
     new_oneRDM = represent_operator_in_basis (np.diag (new_evals), evecs.T)
     return new_oneRDM, nelec_diff
 
+class Schmidt_tracker:
+    ''' Schmidt decomposition that reuses the embedding basis of the previous call.
+
+        The bath is always recomputed exactly, from the thin SVD of the environment-fragment block (1 - P_frag) D loc2frag,
+        which is only norbs_tot * norbs_frag**2 work and needs no explicit environment basis. The expensive part of
+        Schmidt_decompose_1RDM is the core (the complement of the impurity): get_complementary_states, full_matrices SVD
+        and the core diagonalization are all norbs_tot**3. Here the previous core orbitals are instead projected out of the
+        new impurity space and symmetrically orthonormalized, using the low-rank (<= norbs_imp) structure of their overlap
+        matrix. The core orbitals are therefore not natural orbitals; nothing downstream depends on that. Falls back to the
+        full decomposition (and counts it in nfallback) if there is no previous basis, if the fragment space changed, if the
+        number of bath orbitals changed, if symmetry is enforced, or if the impurity space rotated by more than
+        thresh (sine of the largest principal angle) since the last full decomposition. With verbose, each step is logged. '''
+
+    def __init__(self, thresh=0.1, verbose=False):
+        self.thresh    = thresh
+        self.verbose   = verbose
+        self.loc2emb   = None
+        self.loc2frag  = None
+        self.norbs_imp = 0
+        self.drift     = 0.0
+        self.ntracked  = 0
+        self.nfallback = 0
+
+    def reset (self):
+        self.loc2emb = self.loc2frag = None
+        self.drift = 0.0
+
+    def decompose (self, the_1RDM, loc2frag, norbs_bath_max, symmetry=None, fock_helper=None, enforce_symmetry=False,
+            bath_tol=params.num_zero_atol, num_zero_atol=params.num_zero_atol):
+        ''' Same arguments and returns as Schmidt_decompose_1RDM '''
+        rets = None
+        if enforce_symmetry:
+            why = 'symmetry is enforced'
+        elif self.loc2emb is None:
+            why = 'no previous embedding basis'
+        else:
+            rets, why = self._track (the_1RDM, loc2frag, symmetry, fock_helper, num_zero_atol)
+        if rets is None:
+            if self.verbose: print ("Tracking Schmidt decomposition falling back to full decomposition: {}".format (why))
+            rets = Schmidt_decompose_1RDM (the_1RDM, loc2frag, norbs_bath_max, symmetry=symmetry, fock_helper=fock_helper,
+                enforce_symmetry=enforce_symmetry, bath_tol=bath_tol, num_zero_atol=num_zero_atol)
+            self.nfallback += 1
+            self.drift = 0.0
+        else:
+            self.ntracked += 1
+        loc2emb, norbs_bath = rets[:2]
+        self.loc2emb   = loc2emb.copy ()
+        self.loc2frag  = loc2frag.copy ()
+        self.norbs_imp = loc2frag.shape[1] + norbs_bath
+        return rets
+
+    def _track (self, the_1RDM, loc2frag, symmetry, fock_helper, num_zero_atol):
+        norbs_frag = loc2frag.shape[1]
+        if loc2frag.shape != self.loc2frag.shape:
+            return None, 'number of fragment orbitals changed'
+        svals = linalg.svd (np.dot (self.loc2frag.conjugate ().T, loc2frag), compute_uv=False)
+        if np.amin (svals) < 1 - num_zero_atol:
+            return None, 'fragment orbital space changed'
+
+        # Bath from the environment-fragment block of the 1RDM
+        D_frag = np.dot (the_1RDM, loc2frag)
+        D_envfrag = D_frag - np.dot (loc2frag, np.dot (loc2frag.conjugate ().T, D_frag))
+        loc2bath, svals, vh = linalg.svd (D_envfrag, full_matrices=False)
+        norbs_bath = np.count_nonzero (svals > num_zero_atol)
+        if norbs_frag + norbs_bath != self.norbs_imp:
+            return None, 'number of bath orbitals changed ({} -> {})'.format (self.norbs_imp - norbs_frag, norbs_bath)
+        loc2bath = loc2bath[:,:norbs_bath]
+        frag2efrag = vh.conjugate ().T
+        loc2efrag = np.dot (loc2frag, frag2efrag[:,:norbs_bath])
+        loc2ufrag = np.dot (loc2frag, frag2efrag[:,norbs_bath:])
+        if loc2ufrag.shape[1] > 0:
+            mat = the_1RDM if fock_helper is None else fock_helper
+            evals, evecs = linalg.eigh (represent_operator_in_basis (mat, loc2ufrag))
+            loc2ufrag = np.dot (loc2ufrag, evecs[:,::-1])
+        loc2imp = np.concatenate ([loc2ufrag, loc2efrag, loc2bath], axis=1)
+
+        # Core: project the previous core out of the new impurity and orthonormalize. With B = imp^T core_old = U s V^T,
+        # the overlap of the projected core is 1 - V s^2 V^T, so its inverse square root is 1 + V ((1 - s^2)^-1/2 - 1) V^T
+        loc2core = self.loc2emb[:,self.norbs_imp:]
+        B = np.dot (loc2imp.conjugate ().T, loc2core)
+        loc2core = loc2core - np.dot (loc2imp, B)
+        u, s, vh = linalg.svd (B, full_matrices=False)
+        drift = np.amax (s) if s.size else 0.0
+        if self.drift + drift > self.thresh:
+            return None, 'impurity space drifted by {:.3e} > {:.3e}'.format (self.drift + drift, self.thresh)
+        self.drift += drift
+        v = vh.conjugate ().T
+        loc2core = loc2core + np.dot (np.dot (loc2core, v), (1 / np.sqrt (1 - s*s) - 1)[:,None] * vh)
+
+        loc2emb = np.append (loc2imp, loc2core, axis=1)
+        nelec_imp = ((the_1RDM @ loc2imp) * loc2imp).sum ()
+        labels = None if symmetry is None else assign_blocks_weakly (loc2emb, symmetry)
+        if self.verbose: print ("Tracking Schmidt decomposition: {} bath orbitals; impurity rotated by {:.3e} (accumulated {:.3e}) since the last step".format (
+            norbs_bath, drift, self.drift))
+        return (loc2emb, norbs_bath, nelec_imp, labels), None
+
 def Schmidt_decomposition_idempotent_wrapper (working_1RDM, loc2wfrag, norbs_bath_max, symmetry=None, fock_helper=None, enforce_symmetry=False,
-        bath_tol=params.num_zero_atol, idempotize_thresh=0, num_zero_atol=params.num_zero_atol):
+        bath_tol=params.num_zero_atol, idempotize_thresh=0, num_zero_atol=params.num_zero_atol, tracker=None):
     norbs_tot = loc2wfrag.shape[0]
     norbs_wfrag = loc2wfrag.shape[1]
-    loc2wemb, norbs_wbath, nelec_wimp, labels = Schmidt_decompose_1RDM (working_1RDM, loc2wfrag, norbs_bath_max, fock_helper=fock_helper,
+    decompose = Schmidt_decompose_1RDM if tracker is None else tracker.decompose
+    loc2wemb, norbs_wbath, nelec_wimp, labels = decompose (working_1RDM, loc2wfrag, norbs_bath_max, fock_helper=fock_helper,
         bath_tol=bath_tol, symmetry=symmetry, enforce_symmetry=enforce_symmetry)
     norbs_wimp  = norbs_wfrag + norbs_wbath
     norbs_wcore = norbs_tot - norbs_wimp
@@ -201,6 +299,52 @@ def Schmidt_decomposition_idempotent_wrapper (working_1RDM, loc2wfrag, norbs_bat
         raise RuntimeError ("Can't solve impurity problems without integer number of electrons! nelec_wimp={0}".format (nelec_wimp))
     return loc2wemb, norbs_wbath, int (round (nelec_wimp)), working_1RDM_core, labels
 
+class twoCDM_store:
+    ''' Two-body cumulant kept as a sum of blocks, each in its own (small) basis: L_pqrs = sum_b L^b_ijkl C^b_pi C^b_qj C^b_rk C^b_sl,
+        where C^b = loc2tb[b] has orthonormal columns in the localized basis (e.g., the active orbitals of each fragment).
+        The contractions below go block by block, so no four-index array bigger than a block (or than the requested
+        basis, for project) is ever formed, and the cost scales with the block sizes instead of with norbs_tot**4. '''
+
+    def __init__(self, loc2tb=[], twoCDM_tb=[]):
+        self.blocks = []
+        for l2b, L in zip (loc2tb, twoCDM_tb):
+            self.append (l2b, L)
+
+    def append (self, loc2tb, twoCDM_tb):
+        if loc2tb.shape[1] == 0: return
+        assert (twoCDM_tb.shape == (loc2tb.shape[1],)*4), "{} {}".format (loc2tb.shape, twoCDM_tb.shape)
+        self.blocks.append ((loc2tb, twoCDM_tb))
+
+    @property
+    def nbytes (self):
+        return sum ([l2b.nbytes + L.nbytes for l2b, L in self.blocks])
+
+    def project (self, *bases):
+        ''' The cumulant in the basis (or bases, one per index) given, with blocks that don't overlap it skipped '''
+        bases = bases if len (bases) == 4 else [bases[0] for i in range (4)]
+        twoCDM = np.zeros (tuple ([basis.shape[1] for basis in bases]))
+        for loc2tb, L in self.blocks:
+            tb2bs = [np.dot (loc2tb.conjugate ().T, basis) for basis in bases]
+            if any ([np.amax (np.abs (tb2b)) < params.num_zero_atol for tb2b in tb2bs if tb2b.size]): continue
+            twoCDM += represent_operator_in_basis (L, *tb2bs)
+        return twoCDM
+
+    def contract_eri (self, eri, *loc2eri):
+        ''' sum_pqrs (pq|rs) L_pqrs. eri is either a callable returning the (pq|rs) in any orthonormal basis in any pyscf
+            packing, such as ints.dmet_tei, or a four-index array in the basis (or bases, one per index) loc2eri, in which
+            case the parts of the blocks outside of loc2eri are dropped '''
+        loc2eri = loc2eri if len (loc2eri) == 4 else [loc2eri[0] for i in range (4)] if len (loc2eri) else []
+        E = 0.0
+        for loc2tb, L in self.blocks:
+            if callable (eri):
+                V = eri (loc2tb)
+            else:
+                eri2tb = [np.dot (l2e.conjugate ().T, loc2tb) for l2e in loc2eri]
+                if any ([np.amax (np.abs (e2t)) < params.num_zero_atol for e2t in eri2tb if e2t.size]): continue
+                V = represent_operator_in_basis (eri, *eri2tb)
+            E += contract_eri_2cdm (V, L)
+        return E
+
 def get_2CDM_from_2RDM (twoRDM, oneRDMs):
     oneRDMs = np.asarray (oneRDMs)
     if len (oneRDMs.shape) < 3:
@@ -27,3 +27,29 @@ def symmetrize_tensor_elec (tensor):
 def symmetrize_tensor (tensor):
     return symmetrize_tensor_elec (symmetrize_tensor_conj (tensor))
 
+
+def pack_2cdm (twoCDM, symmetry=8):
+    ''' Fold a four-index 2CDM (or any (pq|rs)-ordered tensor) into the packed format of pyscf eris with the given
+        permutational symmetry (4: (npair,npair) array; 8: 1d array), with the weights of the folded-away elements included,
+        so that sum_pqrs (pq|rs) G_pqrs = (eri_packed * pack_2cdm (G, symmetry)).sum () '''
+    norb = twoCDM.shape[0]
+    idx = np.arange (norb)
+    tril = np.tril_indices (norb)
+    G = twoCDM + twoCDM.transpose (1,0,2,3)
+    G[idx,idx] *= 0.5
+    G = G[tril].transpose (1,2,0) # rs,PQ
+    G = G + G.transpose (1,0,2)
+    G[idx,idx] *= 0.5
+    G = G[tril].T # PQ,RS
+    if symmetry == 4: return G
+    assert (symmetry == 8), "unknown eri symmetry {}".format (symmetry)
+    npair = G.shape[0]
+    G = G + G.T
+    G[np.diag_indices (npair)] *= 0.5
+    return G[np.tril_indices (npair)]
+
+def contract_eri_2cdm (eri, twoCDM):
+    ''' sum_pqrs (pq|rs) twoCDM_pqrs, with eri in any pyscf format (4-index, s4 (npair,npair), or s8 1d). The eris are never
+        unpacked; the 2CDM is folded instead (see pack_2cdm). '''
+    if eri.ndim == 4: return np.tensordot (eri, twoCDM, axes=4)
+    return np.dot (np.ravel (eri), np.ravel (pack_2cdm (twoCDM, symmetry=(4 if eri.ndim == 2 else 8))))